@@ -0,0 +1,306 @@
+"""Hot/cold tiering for finished bookings, trips, payments and payouts.
+
+Documents in a terminal state whose ``created_at`` is older than
+``ARCHIVE_AFTER_DAYS`` are moved out of the hot collections in batches of
+``ARCHIVE_BATCH_SIZE``, pausing ``ARCHIVE_BATCH_PAUSE_SECONDS`` between
+batches so the move never competes with live traffic for long.  They go to
+either:
+
+* ``collections`` (default) – ``<name>_archive`` with the same indexes,
+  served by read routes that pass ``?include_archived=true``;
+* ``files`` – gzipped NDJSON under ``ARCHIVE_DIR/<name>/dt=YYYY-MM-DD/``,
+  one file per batch and day.  Files are cold storage only; the API does
+  not read them back.
+
+Archived payments leave their gateway ``transaction_id`` behind in
+``archived_payment_transactions`` so replayed settlement files are still
+recognised as duplicates.
+
+Each batch is checkpointed in ``archive_checkpoints`` before it is copied
+and marked copied before the originals are deleted.  Copies are keyed by
+document id (or by batch number for files), so a batch interrupted at any
+point is simply redone on the next run.
+
+Dashboard counters are totals and are left alone, so archived documents
+still count toward them; ``counters.rebuild_counters`` reads the archive
+collections too, and ``/api/admin/stats`` sums both tiers by default.  In
+``files`` mode archived rows drop out of admin stats, which can only read
+collections.  Bookings that completed without a settled payment stay
+hot until they are paid.
+
+Usage::
+
+    python archive.py run [--dry-run]
+"""
+import asyncio
+import gzip
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import orjson
+from fastapi import HTTPException
+from pymongo import ReplaceOne
+
+import cache
+from models import BookingStatus, PaymentStatus, PayoutStatus, TripStatus
+from settings import env_bool
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).parent
+
+ARCHIVE_ENABLED = env_bool("ARCHIVE_ENABLED")
+ARCHIVE_TARGET = os.environ.get("ARCHIVE_TARGET", "collections")
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 180))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 500))
+ARCHIVE_BATCH_PAUSE_SECONDS = float(os.environ.get("ARCHIVE_BATCH_PAUSE_SECONDS", 0.5))
+ARCHIVE_INTERVAL_SECONDS = float(os.environ.get("ARCHIVE_INTERVAL_SECONDS", 3600))
+ARCHIVE_DIR = Path(os.environ.get("ARCHIVE_DIR", ROOT_DIR / "archive"))
+
+CHECKPOINTS_COLLECTION = "archive_checkpoints"
+# Gateway transaction ids of archived payments, kept hot for deduplication
+ARCHIVED_TRANSACTIONS_COLLECTION = "archived_payment_transactions"
+ARCHIVE_SUFFIX = "_archive"
+
+# What counts as finished for each collection
+POLICIES: Dict[str, dict] = {
+    "bookings": {"$or": [
+        {"status": BookingStatus.CANCELLED.value},
+        {"status": BookingStatus.COMPLETED.value, "payment_status": {"$ne": PaymentStatus.PENDING.value}},
+    ]},
+    "trips": {"status": {"$in": [TripStatus.COMPLETED.value, TripStatus.CANCELLED.value]}},
+    "payments": {"status": {"$in": [
+        PaymentStatus.COMPLETED.value, PaymentStatus.FAILED.value, PaymentStatus.REFUNDED.value
+    ]}},
+    "payouts": {"status": {"$in": [PayoutStatus.PROCESSED.value, PayoutStatus.FAILED.value]}},
+}
+
+# Cached by id in the hot path (see cache.py)
+CACHE_NAMESPACES = {"bookings": cache.BOOKINGS, "trips": cache.TRIPS}
+
+
+def archive_collection(collection: str) -> str:
+    return collection + ARCHIVE_SUFFIX
+
+
+def archive_queryable() -> bool:
+    return ARCHIVE_TARGET == "collections"
+
+
+def sources(db, collection: str, include_archived: bool) -> list:
+    """Collections a read route should query, hot first."""
+    if not include_archived:
+        return [db[collection]]
+    if not archive_queryable():
+        raise HTTPException(status_code=400, detail="Archived records are kept in files and cannot be queried")
+    return [db[collection], db[archive_collection(collection)]]
+
+
+async def find_one(db, collection: str, query: dict, include_archived: bool) -> Optional[dict]:
+    for source in sources(db, collection, include_archived):
+        doc = await source.find_one(query, {"_id": 0})
+        if doc:
+            return doc
+    return None
+
+
+async def archived_transactions(db, transaction_ids: List[str]) -> Dict[str, str]:
+    """Payment ids of archived payments by ``transaction_id``, in either target."""
+    return {
+        doc["_id"]: doc["payment_id"]
+        async for doc in db[ARCHIVED_TRANSACTIONS_COLLECTION].find({"_id": {"$in": transaction_ids}})
+    }
+
+
+def _partition_path(collection: str, day: str, sequence: int) -> Path:
+    return ARCHIVE_DIR / collection / f"dt={day}" / f"batch-{sequence:08d}.ndjson.gz"
+
+
+def _write_files(collection: str, sequence: int, docs: List[dict]) -> List[str]:
+    by_day = defaultdict(list)
+    for doc in docs:
+        created_at = doc.get("created_at")
+        day = created_at.date().isoformat() if isinstance(created_at, datetime) else str(created_at)[:10]
+        by_day[day].append(doc)
+    written = []
+    for day, rows in by_day.items():
+        path = _partition_path(collection, day, sequence)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(path.name + ".partial")
+        with gzip.open(partial, "wb") as handle:
+            for row in rows:
+                handle.write(orjson.dumps(row) + b"\n")
+        # Renamed into place so a file that exists is complete
+        os.replace(partial, path)
+        written.append(str(path))
+    return written
+
+
+class Archiver:
+    def __init__(self, after_days: int, batch_size: int, pause: float, interval: float, target: str):
+        if target not in ("collections", "files"):
+            raise ValueError(f"Unknown ARCHIVE_TARGET {target!r}")
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.target = target
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "runs": 0,
+            "batches": 0,
+            "archived": defaultdict(int),
+            "errors": 0,
+            "last_run": None
+        }
+
+    def _selection(self, collection: str) -> dict:
+        cutoff = datetime.utcnow() - timedelta(days=self.after_days)
+        return {**POLICIES[collection], "created_at": {"$lt": cutoff}}
+
+    async def _copy(self, db, collection: str, sequence: int, docs: List[dict]) -> None:
+        if collection == "payments":
+            # Recorded before the originals go, so a replayed settlement file
+            # still finds them (see payment_ingest)
+            ledger = [
+                ReplaceOne({"_id": doc["transaction_id"]}, {"payment_id": doc["id"]}, upsert=True)
+                for doc in docs if isinstance(doc.get("transaction_id"), str)
+            ]
+            if ledger:
+                await db[ARCHIVED_TRANSACTIONS_COLLECTION].bulk_write(ledger, ordered=False)
+        if self.target == "files":
+            await asyncio.to_thread(_write_files, collection, sequence, docs)
+        else:
+            await db[archive_collection(collection)].bulk_write(
+                [ReplaceOne({"id": doc["id"]}, doc, upsert=True) for doc in docs], ordered=False
+            )
+
+    async def _finish(self, db, collection: str, ids: List[str]) -> int:
+        # The policy filter keeps anything that changed since it was copied
+        result = await db[collection].delete_many({**POLICIES[collection], "id": {"$in": ids}})
+        if collection in CACHE_NAMESPACES:
+            await cache.document_cache.invalidate(CACHE_NAMESPACES[collection], *ids)
+        await db[CHECKPOINTS_COLLECTION].update_one(
+            {"_id": collection},
+            {"$set": {"pending": None, "last_batch_at": datetime.utcnow()}, "$inc": {"archived": result.deleted_count}}
+        )
+        self.stats["batches"] += 1
+        self.stats["archived"][collection] += result.deleted_count
+        return result.deleted_count
+
+    async def _resume(self, db, collection: str, pending: dict) -> int:
+        if not pending["copied"]:
+            docs = await db[collection].find({"id": {"$in": pending["ids"]}}, {"_id": 0}).to_list(None)
+            if docs:
+                await self._copy(db, collection, pending["sequence"], docs)
+            await db[CHECKPOINTS_COLLECTION].update_one({"_id": collection}, {"$set": {"pending.copied": True}})
+        return await self._finish(db, collection, pending["ids"])
+
+    async def archive_batch(self, db, collection: str) -> int:
+        """Move one batch; returns how many documents left the hot collection."""
+        checkpoint = await db[CHECKPOINTS_COLLECTION].find_one({"_id": collection}) or {}
+        if checkpoint.get("pending"):
+            # An interrupted batch is finished before a new one is taken
+            return await self._resume(db, collection, checkpoint["pending"])
+
+        docs = await db[collection].find(self._selection(collection), {"_id": 0}).sort(
+            [("created_at", 1), ("id", 1)]
+        ).limit(self.batch_size).to_list(self.batch_size)
+        if not docs:
+            return 0
+
+        sequence = checkpoint.get("sequence", 0) + 1
+        ids = [doc["id"] for doc in docs]
+        await db[CHECKPOINTS_COLLECTION].update_one(
+            {"_id": collection},
+            {"$set": {"sequence": sequence, "pending": {"sequence": sequence, "ids": ids, "copied": False}}},
+            upsert=True
+        )
+        await self._copy(db, collection, sequence, docs)
+        await db[CHECKPOINTS_COLLECTION].update_one({"_id": collection}, {"$set": {"pending.copied": True}})
+        return await self._finish(db, collection, ids)
+
+    async def run_once(self, db, max_batches: Optional[int] = None) -> Dict[str, int]:
+        moved = {}
+        for collection in POLICIES:
+            moved[collection] = 0
+            batches = 0
+            while max_batches is None or batches < max_batches:
+                count = await self.archive_batch(db, collection)
+                if not count:
+                    break
+                moved[collection] += count
+                batches += 1
+                await asyncio.sleep(self.pause)
+        self.stats["runs"] += 1
+        self.stats["last_run"] = {"at": datetime.utcnow(), "moved": moved}
+        return moved
+
+    async def pending_counts(self, db) -> Dict[str, int]:
+        return {
+            collection: await db[collection].count_documents(self._selection(collection))
+            for collection in POLICIES
+        }
+
+    async def _run(self, db) -> None:
+        while True:
+            try:
+                await self.run_once(db)
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("Archive run failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self, db) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(db))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "archived": dict(self.stats["archived"]),
+            "enabled": self._task is not None,
+            "target": self.target,
+            "after_days": self.after_days
+        }
+
+
+archiver = Archiver(
+    ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_BATCH_PAUSE_SECONDS, ARCHIVE_INTERVAL_SECONDS, ARCHIVE_TARGET
+)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import client, db
+
+    parser = argparse.ArgumentParser(description="Move finished documents out of the hot collections")
+    parser.add_argument("command", choices=["run"])
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be moved")
+    parser.add_argument("--max-batches", type=int, help="per collection")
+    args = parser.parse_args()
+
+    async def main() -> None:
+        if args.dry_run:
+            for collection, count in (await archiver.pending_counts(db)).items():
+                print(f"{collection:<10} {count} to archive")
+            return
+        for collection, count in (await archiver.run_once(db, args.max_batches)).items():
+            print(f"{collection:<10} {count} archived")
+
+    asyncio.run(main())
+    client.close()
@@ -1,17 +1,38 @@
 import os
+import asyncio
+import hashlib
+import threading
+import time
 import jwt
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
 from passlib.context import CryptContext
 from fastapi import HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import database
 from models import UserRole
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 4))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 64))
+
+# Hashes made with a different cost factor are replaced on the next
+# successful login (see PasswordHasher.verify_and_update)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 security = HTTPBearer()
+# For routes that also accept credentials some other way
+optional_security = HTTPBearer(auto_error=False)
 
 JWT_SECRET = os.environ.get("JWT_SECRET", "your-secret-key-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24 * 7  # 7 days
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get("TOKEN_CACHE_MAX_ENTRIES", 10_000))
+# How long a worker trusts a verified token before checking revocations again
+TOKEN_CACHE_TTL_SECONDS = float(os.environ.get("TOKEN_CACHE_TTL_SECONDS", 60))
+
+REVOKED_TOKENS_COLLECTION = "revoked_tokens"
 
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -19,14 +40,98 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-def create_access_token(user_id: str, email: str, role: str) -> str:
+class PasswordHasher:
+    """Runs bcrypt in a worker pool so it never blocks the event loop.
+
+    bcrypt releases the GIL while hashing, so threads give real parallelism.
+    At most ``max_pending`` calls may be queued or running; beyond that
+    callers get a 503 instead of an ever-growing queue.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._pending = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+        self._worker_stats = defaultdict(lambda: {"calls": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self._worker_stats[threading.current_thread().name]
+                stats["calls"] += 1
+                stats["total_seconds"] += elapsed
+                stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+
+    async def _run(self, fn, *args):
+        # Only touched from the event loop thread, so no lock is needed
+        if self._pending >= self.max_pending:
+            self._rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication is busy, please retry",
+                headers={"Retry-After": "1"}
+            )
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._timed, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """Verify a password, returning a replacement hash if the cost factor changed."""
+        return await self._run(pwd_context.verify_and_update, plain_password, hashed_password)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            workers = {
+                name: {**stats, "avg_seconds": stats["total_seconds"] / stats["calls"]}
+                for name, stats in self._worker_stats.items()
+            }
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "rejected": self._rejected,
+            "per_worker": workers
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
+def create_access_token(
+    user_id: str,
+    email: str,
+    role: str,
+    driver_id: Optional[str] = None,
+    dealer_id: Optional[str] = None
+) -> str:
     expire = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     to_encode = {
         "user_id": user_id,
         "email": email,
         "role": role,
+        # Sub-second issue time so tokens minted right after a revocation stay valid
+        "iat": time.time(),
         "exp": expire
     }
+    # Profile ids let routes scope queries without a drivers/dealers lookup
+    if driver_id:
+        to_encode["driver_id"] = driver_id
+    if dealer_id:
+        to_encode["dealer_id"] = dealer_id
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
@@ -39,10 +144,162 @@ def decode_token(token: str) -> dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+class TokenCache:
+    """Bounded LRU of already-verified token payloads.
+
+    Entries are keyed by a SHA-256 digest of the token and dropped after
+    ``ttl`` seconds or once the token's ``exp`` passes, whichever is first.
+    Revocations are written to ``revoked_tokens`` (see :func:`revoke_token`)
+    and mirrored here; a cache miss reloads the ones that apply to the token,
+    so a revocation made on another worker is seen within ``ttl``.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # digest -> (payload, trusted until)
+        self._entries: "OrderedDict[bytes, Tuple[dict, float]]" = OrderedDict()
+        self._revoked_tokens: Dict[bytes, float] = {}
+        self._revoked_users: Dict[str, float] = {}
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, digest: bytes) -> Optional[dict]:
+        entry = self._entries.get(digest)
+        if entry is None or entry[1] <= time.time():
+            if entry is not None:
+                del self._entries[digest]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, digest: bytes, payload: dict) -> None:
+        self._entries[digest] = (payload, min(payload["exp"], time.time() + self.ttl))
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def is_revoked(self, digest: bytes, payload: dict) -> bool:
+        if digest in self._revoked_tokens:
+            return True
+        revoked_before = self._revoked_users.get(payload["user_id"])
+        return revoked_before is not None and payload.get("iat", 0) < revoked_before
+
+    def revoke_token(self, token: str, expires_at: float) -> None:
+        self._mark_token(self.digest(token), expires_at)
+        self._purge_revocations()
+
+    def revoke_user(self, user_id: str, revoked_before: Optional[float] = None) -> None:
+        """Reject every token issued to ``user_id`` up to now, e.g. after a role change."""
+        self._mark_user(user_id, revoked_before or time.time())
+        self._purge_revocations()
+
+    async def load_revocations(self, db, digest: bytes, user_id: str) -> None:
+        """Mirror the stored revocations that could apply to this token."""
+        keys = [_token_key(digest), _user_key(user_id)]
+        async for doc in db[REVOKED_TOKENS_COLLECTION].find({"_id": {"$in": keys}}):
+            if doc["_id"] == keys[0]:
+                self._mark_token(digest, doc["exp"].replace(tzinfo=timezone.utc).timestamp())
+            else:
+                self._mark_user(user_id, doc["revoked_before"])
+
+    def _mark_token(self, digest: bytes, expires_at: float) -> None:
+        self._entries.pop(digest, None)
+        self._revoked_tokens[digest] = expires_at
+
+    def _mark_user(self, user_id: str, revoked_before: float) -> None:
+        if revoked_before <= self._revoked_users.get(user_id, 0):
+            return
+        self._revoked_users[user_id] = revoked_before
+        for digest in [d for d, (payload, _) in self._entries.items() if payload["user_id"] == user_id]:
+            del self._entries[digest]
+
+    def _purge_revocations(self) -> None:
+        now = time.time()
+        for digest in [d for d, exp in self._revoked_tokens.items() if exp <= now]:
+            del self._revoked_tokens[digest]
+        oldest_live = now - JWT_EXPIRATION_HOURS * 3600
+        for user_id in [u for u, at in self._revoked_users.items() if at <= oldest_live]:
+            del self._revoked_users[user_id]
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "revoked_tokens": len(self._revoked_tokens),
+            "revoked_users": len(self._revoked_users)
+        }
+
+token_cache = TokenCache(TOKEN_CACHE_MAX_ENTRIES, TOKEN_CACHE_TTL_SECONDS)
+
+def _token_key(digest: bytes) -> str:
+    return f"token:{digest.hex()}"
+
+def _user_key(user_id: str) -> str:
+    return f"user:{user_id}"
+
+def _utc(timestamp: float) -> datetime:
+    # Naive UTC to match how the rest of the collections store timestamps
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+async def revoke_token(db, token: str, expires_at: float) -> None:
+    """Reject ``token`` on every worker until it expires; the TTL index drops the record then."""
+    digest = token_cache.digest(token)
+    await db[REVOKED_TOKENS_COLLECTION].update_one(
+        {"_id": _token_key(digest)}, {"$set": {"exp": _utc(expires_at)}}, upsert=True
+    )
+    token_cache.revoke_token(token, expires_at)
+
+async def revoke_user(db, user_id: str) -> None:
+    """Reject every token issued to ``user_id`` up to now, on every worker."""
+    now = time.time()
+    # Kept until the last token it can reject has expired
+    await db[REVOKED_TOKENS_COLLECTION].update_one(
+        {"_id": _user_key(user_id)},
+        {"$max": {"revoked_before": now, "exp": _utc(now + JWT_EXPIRATION_HOURS * 3600)}},
+        upsert=True
+    )
+    token_cache.revoke_user(user_id, now)
+
+def authenticate_token(token: str) -> dict:
+    """Verify a bearer token against the revocations this worker knows of.
+
+    Only for callers that cannot wait on the database, such as rate limit
+    bucket keys; requests are authenticated with :func:`authenticate`.
+    """
+    digest = token_cache.digest(token)
+    payload = token_cache.get(digest)
+    if payload is None:
+        payload = decode_token(token)
+    if token_cache.is_revoked(digest, payload):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return dict(payload)
+
+async def authenticate(db, token: str) -> dict:
+    """Verify a bearer token (through the cache) and return its claims."""
+    digest = token_cache.digest(token)
+    payload = token_cache.get(digest)
+    if payload is None:
+        payload = decode_token(token)
+        await token_cache.load_revocations(db, digest, payload["user_id"])
+        token_cache.put(digest, payload)
+    if token_cache.is_revoked(digest, payload):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return dict(payload)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
-    payload = decode_token(token)
-    return payload
+    return await authenticate(database.db, credentials.credentials)
 
 def require_role(required_roles: list[UserRole]):
     async def role_checker(current_user: dict = Depends(get_current_user)):
@@ -0,0 +1,214 @@
+"""Read-through cache for documents fetched by id.
+
+``document_cache.get(namespace, key, loader)`` returns the cached document
+or awaits ``loader`` and caches what it returns (misses are not cached).
+Every write path that changes a cached document calls ``invalidate``
+afterwards, so within a worker a read never returns data older than the
+last write.  Loads that began before an invalidation of the same key are
+not stored, which closes the read-during-write race.
+
+Backends, chosen with ``CACHE_BACKEND``:
+
+* ``local`` (default) – an LRU with a TTL in each worker.  Invalidation
+  only reaches the worker that made the write, so other workers can serve
+  a document up to ``CACHE_TTL_SECONDS`` old.
+* ``shared`` – documents are BSON-encoded into a store every worker
+  reads, so invalidation is global.  ``LocalSharedStore`` stands in for
+  the networked store; anything with the same async ``get``/``set``/
+  ``delete`` methods can replace it.
+* ``off`` – always load.
+
+Cached documents are shared between requests and must not be mutated.
+"""
+import os
+import time
+from collections import OrderedDict, defaultdict
+from itertools import count
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+import bson
+
+import metrics
+
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "local").lower()
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", 30))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 50_000))
+# Recent invalidations remembered for the race check above
+INVALIDATION_HISTORY = 10_000
+
+BOOKINGS = "bookings"
+TRIPS = "trips"
+DRIVERS = "drivers"
+
+# (stored_at wall-clock seconds, document)
+Entry = Tuple[float, dict]
+
+
+class LocalBackend:
+    """Per-process LRU whose entries expire after ``ttl`` seconds."""
+
+    shared = False
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Entry]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] + self.ttl <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def set(self, key: str, doc: dict) -> None:
+        self._entries[key] = (time.time(), doc)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class LocalSharedStore:
+    """In-process stand-in for a networked key-value store with expiry."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._values: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        item = self._values.get(key)
+        if item is None or item[0] <= time.time():
+            self._values.pop(key, None)
+            return None
+        return item[1]
+
+    async def set(self, key: str, value: bytes, ex: float) -> None:
+        self._values[key] = (time.time() + ex, value)
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_entries:
+            self._values.popitem(last=False)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._values.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+
+class SharedBackend:
+    """Stores BSON so datetimes survive the round trip."""
+
+    shared = True
+
+    def __init__(self, store, ttl: float):
+        self.store = store
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[Entry]:
+        raw = await self.store.get(key)
+        if raw is None:
+            return None
+        wrapped = bson.decode(raw)
+        return wrapped["stored_at"], wrapped["doc"]
+
+    async def set(self, key: str, doc: dict) -> None:
+        await self.store.set(key, bson.encode({"stored_at": time.time(), "doc": doc}), ex=self.ttl)
+
+    async def delete(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if keys:
+            await self.store.delete(*keys)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+
+class DocumentCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"hits": 0, "misses": 0, "invalidations": 0, "skipped_stores": 0, "max_hit_age_seconds": 0.0}
+        )
+        self._sequence = count(1)
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        # Loads that started before this sequence may predate a forgotten invalidation
+        self._forgotten_before = 0
+
+    async def get(self, namespace: str, key: str, loader: Callable[[], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        stats = self.stats[namespace]
+        if self.backend is None:
+            return await loader()
+
+        cache_key = f"{namespace}:{key}"
+        entry = await self.backend.get(cache_key)
+        if entry is not None:
+            age = max(time.time() - entry[0], 0.0)
+            stats["hits"] += 1
+            stats["max_hit_age_seconds"] = max(stats["max_hit_age_seconds"], age)
+            metrics.CACHE_LOOKUPS.inc((("cache", namespace), ("result", "hit")))
+            metrics.CACHE_HIT_AGE.observe((("cache", namespace),), age)
+            return entry[1]
+
+        stats["misses"] += 1
+        metrics.CACHE_LOOKUPS.inc((("cache", namespace), ("result", "miss")))
+        started = next(self._sequence)
+        doc = await loader()
+        if doc is not None:
+            if started < self._forgotten_before or self._invalidated.get(cache_key, 0) > started:
+                # Written while we were loading; what we read may already be old
+                stats["skipped_stores"] += 1
+            else:
+                await self.backend.set(cache_key, doc)
+        return doc
+
+    async def invalidate(self, namespace: str, *keys: str) -> None:
+        if self.backend is None or not keys:
+            return
+        cache_keys = [f"{namespace}:{key}" for key in keys]
+        sequence = next(self._sequence)
+        for cache_key in cache_keys:
+            self._invalidated[cache_key] = sequence
+            self._invalidated.move_to_end(cache_key)
+        while len(self._invalidated) > INVALIDATION_HISTORY:
+            _, forgotten = self._invalidated.popitem(last=False)
+            self._forgotten_before = max(self._forgotten_before, forgotten + 1)
+        self.stats[namespace]["invalidations"] += len(cache_keys)
+        await self.backend.delete(cache_keys)
+
+    def metrics(self) -> dict:
+        namespaces = {}
+        for namespace, stats in self.stats.items():
+            lookups = stats["hits"] + stats["misses"]
+            namespaces[namespace] = {**stats, "hit_ratio": stats["hits"] / lookups if lookups else 0.0}
+        return {
+            "backend": CACHE_BACKEND,
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "ttl_seconds": CACHE_TTL_SECONDS,
+            # Worst case for a read on a worker that did not make the write
+            "max_staleness_seconds": 0.0 if self.backend is None or self.backend.shared else CACHE_TTL_SECONDS,
+            "namespaces": namespaces
+        }
+
+
+def _make_backend():
+    if CACHE_BACKEND == "off":
+        return None
+    if CACHE_BACKEND == "shared":
+        return SharedBackend(LocalSharedStore(CACHE_MAX_ENTRIES), CACHE_TTL_SECONDS)
+    if CACHE_BACKEND == "local":
+        return LocalBackend(CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)
+    raise ValueError(f"Unknown CACHE_BACKEND {CACHE_BACKEND!r}")
+
+
+document_cache = DocumentCache(_make_backend())
@@ -0,0 +1,183 @@
+"""Incrementally maintained per-principal dashboard counters.
+
+Every customer, driver and dealer owns one document in the
+``dashboard_counters`` collection, keyed ``"<kind>:<id>"``.  Write paths
+describe each document they touch as a set of counter *contributions*; the
+difference between the contributions before and after a write is applied
+with a single ``$inc`` per principal, so the stats routes become one
+``find_one``.
+
+``python counters.py rebuild`` recomputes every document from the source
+collections to repair drift.
+"""
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from pymongo import ReplaceOne, UpdateOne
+
+from archive import archive_collection
+from models import BookingStatus, TripStatus, PaymentStatus, PayoutStatus
+
+COUNTERS_COLLECTION = "dashboard_counters"
+
+CUSTOMER = "customer"
+DRIVER = "driver"
+DEALER = "dealer"
+
+ACTIVE_BOOKING_STATUSES = {BookingStatus.ACCEPTED.value, BookingStatus.IN_PROGRESS.value}
+
+Contributions = Dict[str, Dict[str, float]]
+
+
+def counter_id(kind: str, principal_id: str) -> str:
+    return f"{kind}:{principal_id}"
+
+
+def _value(value):
+    return getattr(value, "value", value)
+
+
+def booking_contributions(booking: dict) -> Contributions:
+    status = _value(booking["status"])
+    per_booking = {"total_bookings": 1, f"bookings_by_status.{status}": 1}
+    contributions = {counter_id(CUSTOMER, booking["user_id"]): dict(per_booking)}
+    for kind, key in ((DRIVER, "driver_id"), (DEALER, "dealer_id")):
+        if booking.get(key):
+            contributions[counter_id(kind, booking[key])] = {
+                **per_booking,
+                "active_trips": 1 if status in ACTIVE_BOOKING_STATUSES else 0
+            }
+    return contributions
+
+
+def trip_contributions(trip: dict) -> Contributions:
+    active = 1 if _value(trip["status"]) == TripStatus.ACTIVE.value else 0
+    return {counter_id(CUSTOMER, trip["user_id"]): {"active_trips": active}}
+
+
+def payment_contributions(payment: dict) -> Contributions:
+    completed = _value(payment["status"]) == PaymentStatus.COMPLETED.value
+    return {counter_id(CUSTOMER, payment["user_id"]): {"total_spent": payment["amount"] if completed else 0}}
+
+
+def payout_contributions(payout: dict) -> Contributions:
+    processed = _value(payout["status"]) == PayoutStatus.PROCESSED.value
+    contributions = {}
+    for kind, key, amount_key in ((DRIVER, "driver_id", "driver_amount"), (DEALER, "dealer_id", "dealer_amount")):
+        if payout.get(key):
+            amount = payout.get(amount_key, 0.0)
+            contributions[counter_id(kind, payout[key])] = {
+                "total_earnings": amount,
+                "total_paid_out": amount if processed else 0
+            }
+    return contributions
+
+
+def counter_deltas(
+    contributions: Callable[[dict], Contributions],
+    before: Optional[dict],
+    after: Optional[dict]
+) -> Contributions:
+    deltas = defaultdict(lambda: defaultdict(int))
+    for doc, sign in ((after, 1), (before, -1)):
+        if doc:
+            for cid, fields in contributions(doc).items():
+                for field, amount in fields.items():
+                    deltas[cid][field] += sign * amount
+    return {
+        cid: {field: amount for field, amount in fields.items() if amount}
+        for cid, fields in deltas.items()
+        if any(fields.values())
+    }
+
+
+async def record_change(
+    db,
+    contributions: Callable[[dict], Contributions],
+    before: Optional[dict] = None,
+    after: Optional[dict] = None
+) -> None:
+    """Apply the counter delta between two versions of a document."""
+    await record_changes(db, contributions, [(before, after)])
+
+
+async def record_changes(
+    db,
+    contributions: Callable[[dict], Contributions],
+    changes: Iterable[Tuple[Optional[dict], Optional[dict]]]
+) -> None:
+    """Apply many ``(before, after)`` changes with one ``$inc`` per principal."""
+    totals = defaultdict(lambda: defaultdict(int))
+    for before, after in changes:
+        for cid, fields in counter_deltas(contributions, before, after).items():
+            for field, amount in fields.items():
+                totals[cid][field] += amount
+    ops = [
+        UpdateOne({"_id": cid}, {"$inc": dict(inc)}, upsert=True)
+        for cid, inc in totals.items()
+    ]
+    if ops:
+        await db[COUNTERS_COLLECTION].bulk_write(ops, ordered=False)
+
+
+async def get_counters(db, kind: str, principal_id: str) -> dict:
+    return await db[COUNTERS_COLLECTION].find_one({"_id": counter_id(kind, principal_id)}) or {}
+
+
+REBUILD_SOURCES = (
+    ("trips", trip_contributions, {"user_id": 1, "status": 1}),
+    ("bookings", booking_contributions, {"user_id": 1, "driver_id": 1, "dealer_id": 1, "status": 1}),
+    ("payments", payment_contributions, {"user_id": 1, "amount": 1, "status": 1}),
+    ("payouts", payout_contributions, {
+        "driver_id": 1, "dealer_id": 1, "driver_amount": 1, "dealer_amount": 1, "status": 1
+    }),
+)
+
+
+def _nest(fields: dict) -> dict:
+    doc = {}
+    for field, amount in fields.items():
+        parent, _, child = field.partition(".")
+        if child:
+            doc.setdefault(parent, {})[child] = amount
+        else:
+            doc[field] = amount
+    return doc
+
+
+async def rebuild_counters(db, batch_size: int = 1000) -> int:
+    """Recompute every counter document from scratch; returns the number written."""
+    totals = defaultdict(lambda: defaultdict(int))
+    for collection, contributions, projection in REBUILD_SOURCES:
+        # Archived documents still count toward the totals
+        for source in (collection, archive_collection(collection)):
+            cursor = db[source].find({}, {"_id": 0, **projection}).batch_size(batch_size)
+            async for doc in cursor:
+                for cid, fields in contributions(doc).items():
+                    for field, amount in fields.items():
+                        totals[cid][field] += amount
+
+    # Principals that no longer contribute anything are reset to empty documents
+    async for doc in db[COUNTERS_COLLECTION].find({}, {"_id": 1}):
+        totals.setdefault(doc["_id"], defaultdict(int))
+
+    ops = [ReplaceOne({"_id": cid}, {"_id": cid, **_nest(fields)}, upsert=True) for cid, fields in totals.items()]
+    for start in range(0, len(ops), batch_size):
+        await db[COUNTERS_COLLECTION].bulk_write(ops[start:start + batch_size], ordered=False)
+    return len(ops)
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    from database import client, db
+
+    parser = argparse.ArgumentParser(description="Maintain dashboard counters")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    written = asyncio.run(rebuild_counters(db, batch_size=args.batch_size))
+    print(f"Rebuilt {written} counter documents")
+    client.close()
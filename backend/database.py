@@ -0,0 +1,102 @@
+"""MongoDB client, pool settings and read routing.
+
+Pool and timeout settings come from the environment and are only passed
+on when set, so unset ones keep the driver defaults:
+
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS,
+    MONGO_WAIT_QUEUE_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    MONGO_COMPRESSORS (e.g. "zstd,snappy,zlib")
+
+Everything reads from the primary by default.  Read-only routes belong to
+a route class (``dashboard`` for the stats endpoints, ``list`` for the
+paginated listings, ``export`` for the admin exports) and use that class's
+handle, which can be pointed at secondaries:
+
+    MONGO_DASHBOARD_READ_PREFERENCE=secondaryPreferred
+    MONGO_DASHBOARD_MAX_STALENESS_SECONDS=120
+
+A secondary read may miss the caller's own latest writes, by at most the
+staleness budget (``-1`` means no limit, otherwise at least 90 seconds).
+"""
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.read_preferences import (
+    Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+)
+import os
+from pathlib import Path
+
+import metrics
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+POOL_SETTINGS = {
+    "maxPoolSize": ("MONGO_MAX_POOL_SIZE", int),
+    "minPoolSize": ("MONGO_MIN_POOL_SIZE", int),
+    "maxIdleTimeMS": ("MONGO_MAX_IDLE_TIME_MS", int),
+    "waitQueueTimeoutMS": ("MONGO_WAIT_QUEUE_TIMEOUT_MS", int),
+    "connectTimeoutMS": ("MONGO_CONNECT_TIMEOUT_MS", int),
+    "socketTimeoutMS": ("MONGO_SOCKET_TIMEOUT_MS", int),
+    "serverSelectionTimeoutMS": ("MONGO_SERVER_SELECTION_TIMEOUT_MS", int),
+    "compressors": ("MONGO_COMPRESSORS", str),
+}
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+# Smallest maxStalenessSeconds servers accept
+MIN_MAX_STALENESS_SECONDS = 90
+
+
+def pool_options() -> dict:
+    options = {}
+    for option, (variable, cast) in POOL_SETTINGS.items():
+        value = os.environ.get(variable)
+        if value:
+            options[option] = cast(value)
+    return options
+
+
+def read_preference(route_class: str):
+    prefix = f"MONGO_{route_class.upper()}"
+    mode = os.environ.get(f"{prefix}_READ_PREFERENCE", "primary")
+    max_staleness = int(os.environ.get(f"{prefix}_MAX_STALENESS_SECONDS", -1))
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f"{prefix}_READ_PREFERENCE must be one of {', '.join(READ_PREFERENCES)}")
+    if mode == "primary":
+        return Primary()
+    if max_staleness != -1 and max_staleness < MIN_MAX_STALENESS_SECONDS:
+        raise ValueError(f"{prefix}_MAX_STALENESS_SECONDS must be -1 or at least {MIN_MAX_STALENESS_SECONDS}")
+    return READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(
+    mongo_url,
+    event_listeners=[metrics.command_listener] if metrics.METRICS_ENABLED else [],
+    **pool_options()
+)
+db = client[os.environ['DB_NAME']]
+
+# Handles for read-only route classes; the same as ``db`` unless configured
+dashboard_db = db.with_options(read_preference=read_preference("dashboard"))
+list_db = db.with_options(read_preference=read_preference("list"))
+export_db = db.with_options(read_preference=read_preference("export"))
+
+
+def read_settings() -> dict:
+    """Effective pool options and per-class read preferences, for diagnostics."""
+    return {
+        "pool": pool_options(),
+        "reads": {
+            route_class: handle.read_preference.document
+            for route_class, handle in (("dashboard", dashboard_db), ("list", list_db), ("export", export_db))
+        }
+    }
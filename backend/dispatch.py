@@ -0,0 +1,308 @@
+"""Batched dispatch of PENDING bookings.
+
+Rather than waiting for the first driver to call ``accept_booking``, the
+dispatcher wakes every ``DISPATCH_WINDOW_SECONDS``, collects the oldest
+pending bookings that have a pickup point, and solves the assignment for
+the whole batch at once.  Candidates are the ``DISPATCH_CANDIDATES_PER_BOOKING``
+nearest idle, recently-located drivers within ``DISPATCH_MAX_PICKUP_KM`` of
+each pickup, found with ``$geoNear``.  Bookings without a pickup point are
+left for drivers to accept themselves.
+
+The cost of pairing a booking with a driver is the pickup distance in km,
+minus ``DISPATCH_DEALER_AFFINITY_KM`` when the driver belongs to the
+booking's preferred dealer.  Pairs with the wrong vehicle type or a pickup
+further than ``DISPATCH_MAX_PICKUP_KM`` are infeasible.  Small batches are
+solved optimally with the Hungarian method; larger ones greedily, cheapest
+pair first.  Winners are committed with the same conditional
+``PENDING -> ACCEPTED`` update the accept route uses, so a booking a driver
+grabbed in the meantime is simply skipped.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+
+import cache
+import counters
+import events
+from locations import DRIVER_LOCATION_MAX_AGE_SECONDS
+import transitions
+from models import BookingStatus
+from settings import env_bool
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_ENABLED = env_bool("DISPATCH_ENABLED")
+DISPATCH_WINDOW_SECONDS = float(os.environ.get("DISPATCH_WINDOW_SECONDS", 2.0))
+DISPATCH_MAX_BATCH = int(os.environ.get("DISPATCH_MAX_BATCH", 500))
+DISPATCH_MAX_DRIVERS = int(os.environ.get("DISPATCH_MAX_DRIVERS", 5000))
+DISPATCH_CANDIDATES_PER_BOOKING = int(os.environ.get("DISPATCH_CANDIDATES_PER_BOOKING", 20))
+DISPATCH_MAX_PICKUP_KM = float(os.environ.get("DISPATCH_MAX_PICKUP_KM", 15.0))
+DISPATCH_DEALER_AFFINITY_KM = float(os.environ.get("DISPATCH_DEALER_AFFINITY_KM", 2.0))
+DISPATCH_HUNGARIAN_MAX_SIZE = int(os.environ.get("DISPATCH_HUNGARIAN_MAX_SIZE", 100))
+
+EARTH_RADIUS_KM = 6371.0
+
+Pair = Tuple[int, int]
+
+
+def _point(doc: dict, field: str) -> Tuple[float, float]:
+    point = doc.get(field)
+    if not point:
+        return np.nan, np.nan
+    lng, lat = point["coordinates"]
+    return lat, lng
+
+
+def haversine_km(lat1: np.ndarray, lng1: np.ndarray, lat2: np.ndarray, lng2: np.ndarray) -> np.ndarray:
+    """Pairwise great-circle distances between two point sets, shape ``(len1, len2)``."""
+    lat1, lng1 = np.radians(lat1)[:, None], np.radians(lng1)[:, None]
+    lat2, lng2 = np.radians(lat2)[None, :], np.radians(lng2)[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def build_cost_matrix(
+    bookings: Sequence[dict],
+    drivers: Sequence[dict],
+    max_pickup_km: float = DISPATCH_MAX_PICKUP_KM,
+    affinity_km: float = DISPATCH_DEALER_AFFINITY_KM
+) -> np.ndarray:
+    """Cost of each booking/driver pair; ``inf`` marks infeasible pairs."""
+    b_lat, b_lng = np.array([_point(b, "pickup_point") for b in bookings], dtype=float).reshape(-1, 2).T
+    d_lat, d_lng = np.array([_point(d, "location") for d in drivers], dtype=float).reshape(-1, 2).T
+
+    distance = haversine_km(b_lat, b_lng, d_lat, d_lng)
+    cost = np.where(np.isnan(distance) | (distance > max_pickup_km), np.inf, distance)
+
+    wanted_type = np.array([getattr(b.get("vehicle_type"), "value", b.get("vehicle_type")) for b in bookings], dtype=object)
+    driver_type = np.array([getattr(d.get("vehicle_type"), "value", d.get("vehicle_type")) for d in drivers], dtype=object)
+    mismatch = (wanted_type[:, None] != None) & (wanted_type[:, None] != driver_type[None, :])  # noqa: E711
+    cost[mismatch] = np.inf
+
+    preferred = np.array([b.get("preferred_dealer_id") for b in bookings], dtype=object)
+    dealer = np.array([d.get("dealer_id") for d in drivers], dtype=object)
+    affinity = (preferred[:, None] != None) & (preferred[:, None] == dealer[None, :])  # noqa: E711
+    cost[affinity] -= affinity_km
+    return cost
+
+
+def solve_greedy(cost: np.ndarray) -> List[Pair]:
+    """Repeatedly take the cheapest feasible pair; ties go to the older booking."""
+    rows, cols = np.nonzero(np.isfinite(cost))
+    order = np.lexsort((rows, cost[rows, cols]))
+    row_taken = np.zeros(cost.shape[0], dtype=bool)
+    col_taken = np.zeros(cost.shape[1], dtype=bool)
+    pairs = []
+    limit = min(cost.shape)
+    for index in order:
+        r, c = rows[index], cols[index]
+        if row_taken[r] or col_taken[c]:
+            continue
+        row_taken[r] = col_taken[c] = True
+        pairs.append((int(r), int(c)))
+        if len(pairs) == limit:
+            break
+    return pairs
+
+
+def solve_hungarian(cost: np.ndarray) -> List[Pair]:
+    """Minimum-cost assignment (Hungarian method with potentials, O(n^2 m))."""
+    n, m = cost.shape
+    if n == 0 or m == 0:
+        return []
+    transposed = n > m
+    matrix = cost.T if transposed else cost
+    n, m = matrix.shape
+
+    feasible = np.isfinite(matrix)
+    if not feasible.any():
+        return []
+    finite = matrix[feasible]
+    # Infeasible pairs get a cost no feasible assignment can reach, then are dropped
+    big = (np.abs(finite).max() + 1.0) * (n + 1)
+    matrix = np.where(feasible, matrix, big)
+
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = matrix[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            used_cols = np.nonzero(used)[0]
+            u[p[used_cols]] += delta
+            v[used_cols] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    pairs = []
+    for j in range(1, m + 1):
+        if p[j] and feasible[p[j] - 1, j - 1]:
+            pair = (p[j] - 1, j - 1)
+            pairs.append((pair[1], pair[0]) if transposed else pair)
+    return sorted(pairs)
+
+
+def solve_assignment(cost: np.ndarray, hungarian_max_size: int = DISPATCH_HUNGARIAN_MAX_SIZE) -> List[Pair]:
+    if min(cost.shape) == 0:
+        return []
+    if min(cost.shape) <= hungarian_max_size:
+        return solve_hungarian(cost)
+    return solve_greedy(cost)
+
+
+class Dispatcher:
+    def __init__(
+        self, window: float, max_batch: int, max_drivers: int, candidates_per_booking: int, location_max_age: int
+    ):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_drivers = max_drivers
+        self.candidates_per_booking = candidates_per_booking
+        self.location_max_age = location_max_age
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "batches": 0,
+            "bookings_seen": 0,
+            "assigned": 0,
+            "lost_races": 0,
+            "errors": 0,
+            "last_batch": None
+        }
+
+    async def pending_bookings(self, db) -> List[dict]:
+        return await db.bookings.find(
+            {"status": BookingStatus.PENDING.value, "pickup_point": {"$ne": None}},
+            {"_id": 0, "id": 1, "user_id": 1, "pickup_point": 1, "vehicle_type": 1, "preferred_dealer_id": 1}
+        ).sort([("created_at", 1), ("id", 1)]).limit(self.max_batch).to_list(self.max_batch)
+
+    async def _nearest_drivers(self, db, booking: dict, query: dict) -> List[dict]:
+        vehicle_type = getattr(booking.get("vehicle_type"), "value", booking.get("vehicle_type"))
+        if vehicle_type:
+            query = {**query, "vehicle_type": vehicle_type}
+        return await db.drivers.aggregate([
+            {"$geoNear": {
+                "near": booking["pickup_point"],
+                "distanceField": "distance_m",
+                "maxDistance": DISPATCH_MAX_PICKUP_KM * 1000,
+                "query": query,
+                "spherical": True
+            }},
+            {"$limit": self.candidates_per_booking},
+            {"$project": {"_id": 0, "id": 1, "dealer_id": 1, "vehicle_type": 1, "location": 1}}
+        ]).to_list(self.candidates_per_booking)
+
+    async def available_drivers(self, db, bookings: Sequence[dict]) -> List[dict]:
+        query = {"is_active": True}
+        if self.location_max_age:
+            query["location_updated_at"] = {"$gte": datetime.utcnow() - timedelta(seconds=self.location_max_age)}
+        nearest = await asyncio.gather(*(self._nearest_drivers(db, booking, query) for booking in bookings))
+        drivers = list({d["id"]: d for candidates in nearest for d in candidates}.values())[:self.max_drivers]
+        if not drivers:
+            return []
+        # Drivers already on a booking are busy; the dashboard counters know which
+        busy = await db[counters.COUNTERS_COLLECTION].distinct("_id", {
+            "_id": {"$in": [counters.counter_id(counters.DRIVER, d["id"]) for d in drivers]},
+            "active_trips": {"$gt": 0}
+        })
+        busy = set(busy)
+        return [d for d in drivers if counters.counter_id(counters.DRIVER, d["id"]) not in busy]
+
+    async def commit(self, db, booking: dict, driver: dict) -> bool:
+        try:
+            previous, current = await transitions.transition(
+                db.bookings,
+                {"id": booking["id"]},
+                BookingStatus.ACCEPTED,
+                transitions.BOOKING_TRANSITIONS,
+                changes={"driver_id": driver["id"], "dealer_id": driver.get("dealer_id")}
+            )
+        except HTTPException:
+            # Accepted or cancelled since the batch was read
+            return False
+        await cache.document_cache.invalidate(cache.BOOKINGS, booking["id"])
+        await counters.record_change(db, counters.booking_contributions, previous, current)
+        events.publish_booking(events.BOOKING_UPDATED, current)
+        return True
+
+    async def run_once(self, db) -> dict:
+        bookings = await self.pending_bookings(db)
+        drivers = await self.available_drivers(db, bookings) if bookings else []
+        started = time.perf_counter()
+        pairs = solve_assignment(build_cost_matrix(bookings, drivers)) if bookings and drivers else []
+        solve_seconds = time.perf_counter() - started
+
+        results = await asyncio.gather(*(self.commit(db, bookings[r], drivers[c]) for r, c in pairs))
+        assigned = sum(results)
+        batch = {
+            "bookings": len(bookings),
+            "drivers": len(drivers),
+            "matched": len(pairs),
+            "assigned": assigned,
+            "solve_seconds": solve_seconds
+        }
+        self.stats["batches"] += 1
+        self.stats["bookings_seen"] += len(bookings)
+        self.stats["assigned"] += assigned
+        self.stats["lost_races"] += len(pairs) - assigned
+        self.stats["last_batch"] = batch
+        return batch
+
+    async def _run(self, db) -> None:
+        while True:
+            await asyncio.sleep(self.window)
+            try:
+                await self.run_once(db)
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("Dispatch batch failed")
+
+    def start(self, db) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(db))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def metrics(self) -> dict:
+        return {**self.stats, "enabled": self._task is not None, "window_seconds": self.window}
+
+
+dispatcher = Dispatcher(
+    DISPATCH_WINDOW_SECONDS,
+    DISPATCH_MAX_BATCH,
+    DISPATCH_MAX_DRIVERS,
+    DISPATCH_CANDIDATES_PER_BOOKING,
+    DRIVER_LOCATION_MAX_AGE_SECONDS
+)
@@ -0,0 +1,294 @@
+"""Booking and payout change events pushed over Server-Sent Events.
+
+Write paths publish to ``hub``, an in-process fan-out keyed by audience:
+``user:<id>`` for the booking's customer, ``driver:<id>``, ``dealer:<id>``
+and ``admin``, mirroring what each role sees from ``GET /api/bookings``.
+Every event is encoded once and queued for the subscribers whose keys it
+matches, so an idle subscriber costs a small queue and nothing per
+publish.
+
+Recent events stay in a ring buffer.  A client reconnecting with
+``Last-Event-ID`` gets what it missed; if that id has aged out (or came from
+another process) it gets a ``resync`` event and should refetch.
+
+With ``EVENTS_CHANGE_STREAMS=true`` each worker feeds its hub from a MongoDB
+change stream instead (replica set required), so writes made by any worker
+reach every subscriber.  Event ids are then the change stream resume
+tokens, which are the same on every worker.  If the stream fails, the
+worker falls back to publishing its own writes until it reconnects.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from collections import deque
+from itertools import count
+from typing import AsyncIterator, Deque, Dict, Iterable, List, NamedTuple, Optional, Set
+
+import orjson
+from pymongo.errors import PyMongoError
+
+from models import Booking, Payout, UserRole
+from settings import env_bool
+
+logger = logging.getLogger(__name__)
+
+EVENTS_CHANGE_STREAMS = env_bool("EVENTS_CHANGE_STREAMS")
+EVENT_BUFFER_SIZE = int(os.environ.get("EVENT_BUFFER_SIZE", 10_000))
+SSE_QUEUE_SIZE = int(os.environ.get("SSE_QUEUE_SIZE", 256))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", 15))
+SSE_MAX_SUBSCRIBERS = int(os.environ.get("SSE_MAX_SUBSCRIBERS", 10_000))
+SSE_RETRY_MS = 3000
+CHANGE_STREAM_RETRY_SECONDS = 5.0
+
+BOOKING_CREATED = "booking.created"
+BOOKING_UPDATED = "booking.updated"
+PAYOUT_CREATED = "payout.created"
+PAYOUT_UPDATED = "payout.updated"
+RESYNC = "resync"
+
+ADMIN = "admin"
+
+BOOKING_FIELDS = tuple(Booking.model_fields)
+PAYOUT_FIELDS = tuple(Payout.model_fields)
+
+
+class Event(NamedTuple):
+    id: str
+    audience: frozenset
+    encoded: bytes
+
+
+def encode(event_id: Optional[str], event_type: str, payload: dict) -> bytes:
+    lines = [f"id: {event_id}"] if event_id else []
+    lines.append(f"event: {event_type}")
+    return ("\n".join(lines) + "\ndata: ").encode() + orjson.dumps(payload) + b"\n\n"
+
+
+HEARTBEAT = b": keepalive\n\n"
+# Sent in place of an event when a subscriber fell too far behind
+_OVERFLOW = object()
+
+
+class Subscriber:
+    __slots__ = ("keys", "queue")
+
+    def __init__(self, keys: Set[str]):
+        self.keys = keys
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+
+
+class EventHub:
+    def __init__(self, buffer_size: int, max_subscribers: int):
+        self.max_subscribers = max_subscribers
+        self.local_publishing = True
+        self._buffer: Deque[Event] = deque(maxlen=buffer_size)
+        self._by_key: Dict[str, Set[Subscriber]] = {}
+        self._subscribers = 0
+        self._boot = uuid.uuid4().hex[:8]
+        self._sequence = count(1)
+        self.stats = {"published": 0, "delivered": 0, "overflowed": 0}
+
+    def __len__(self) -> int:
+        return self._subscribers
+
+    def subscribe(self, keys: Set[str]) -> Optional[Subscriber]:
+        if self._subscribers >= self.max_subscribers:
+            return None
+        subscriber = Subscriber(keys)
+        for key in keys:
+            self._by_key.setdefault(key, set()).add(subscriber)
+        self._subscribers += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        removed = False
+        for key in subscriber.keys:
+            members = self._by_key.get(key)
+            if members and subscriber in members:
+                members.discard(subscriber)
+                removed = True
+                if not members:
+                    del self._by_key[key]
+        if removed:
+            self._subscribers -= 1
+
+    def publish(self, event_type: str, audience: Iterable[str], payload: dict, event_id: Optional[str] = None) -> None:
+        event_id = event_id or f"{self._boot}-{next(self._sequence)}"
+        audience = frozenset(audience)
+        event = Event(event_id, audience, encode(event_id, event_type, payload))
+        self._buffer.append(event)
+        self.stats["published"] += 1
+
+        targets = set()
+        for key in audience:
+            targets.update(self._by_key.get(key, ()))
+        for subscriber in targets:
+            try:
+                subscriber.queue.put_nowait(event)
+                self.stats["delivered"] += 1
+            except asyncio.QueueFull:
+                # Too slow to keep up: drop its backlog and make it reconnect,
+                # which replays from the buffer
+                self.stats["overflowed"] += 1
+                self.unsubscribe(subscriber)
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(_OVERFLOW)
+
+    def replay_after(self, last_event_id: str, keys: Set[str]) -> Optional[List[Event]]:
+        """Buffered events after ``last_event_id``, or ``None`` if it is unknown."""
+        missed = []
+        for event in reversed(self._buffer):
+            if event.id == last_event_id:
+                missed.reverse()
+                return missed
+            if event.audience & keys:
+                missed.append(event)
+        return None
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "subscribers": self._subscribers,
+            "buffered": len(self._buffer),
+            "local_publishing": self.local_publishing,
+        }
+
+
+hub = EventHub(EVENT_BUFFER_SIZE, SSE_MAX_SUBSCRIBERS)
+
+
+def subscriber_keys(current_user: dict, driver: Optional[dict], dealer: Optional[dict]) -> Set[str]:
+    """The audience keys a caller may see, matching ``GET /api/bookings``."""
+    role = current_user["role"]
+    if role == UserRole.ADMIN.value:
+        return {ADMIN}
+    if role == UserRole.DRIVER.value and driver:
+        return {f"driver:{driver['id']}"}
+    if role == UserRole.DEALER.value and dealer:
+        return {f"dealer:{dealer['id']}"}
+    return {f"user:{current_user['user_id']}"}
+
+
+def _audience(doc: dict, include_customer: bool) -> Set[str]:
+    audience = {ADMIN}
+    if include_customer and doc.get("user_id"):
+        audience.add(f"user:{doc['user_id']}")
+    for kind in ("driver", "dealer"):
+        if doc.get(f"{kind}_id"):
+            audience.add(f"{kind}:{doc[f'{kind}_id']}")
+    return audience
+
+
+def _project(doc: dict, fields: Iterable[str]) -> dict:
+    return {field: doc[field] for field in fields if field in doc}
+
+
+def publish_booking(event_type: str, booking: dict) -> None:
+    if hub.local_publishing:
+        hub.publish(event_type, _audience(booking, True), {"booking": _project(booking, BOOKING_FIELDS)})
+
+
+def publish_payout(event_type: str, payout: dict) -> None:
+    # Payouts are between the platform, drivers and dealers
+    if hub.local_publishing:
+        hub.publish(event_type, _audience(payout, False), {"payout": _project(payout, PAYOUT_FIELDS)})
+
+
+async def publish_bookings(db, booking_ids: Iterable[str]) -> None:
+    """Publish updates for bookings changed in bulk, if anyone is listening."""
+    booking_ids = list(booking_ids)
+    if not booking_ids or not hub.local_publishing or not len(hub):
+        return
+    async for booking in db.bookings.find({"id": {"$in": booking_ids}}, {"_id": 0}):
+        publish_booking(BOOKING_UPDATED, booking)
+
+
+async def stream(subscriber: Subscriber, backlog: Optional[List[Event]]) -> AsyncIterator[bytes]:
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n".encode()
+        if backlog is None:
+            yield encode(None, RESYNC, {})
+        else:
+            for event in backlog:
+                yield event.encoded
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield HEARTBEAT
+                continue
+            if event is _OVERFLOW:
+                return
+            yield event.encoded
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+CHANGE_EVENTS = {
+    ("bookings", "insert"): (BOOKING_CREATED, BOOKING_FIELDS, "booking", True),
+    ("bookings", "update"): (BOOKING_UPDATED, BOOKING_FIELDS, "booking", True),
+    ("bookings", "replace"): (BOOKING_UPDATED, BOOKING_FIELDS, "booking", True),
+    ("payouts", "insert"): (PAYOUT_CREATED, PAYOUT_FIELDS, "payout", False),
+    ("payouts", "update"): (PAYOUT_UPDATED, PAYOUT_FIELDS, "payout", False),
+    ("payouts", "replace"): (PAYOUT_UPDATED, PAYOUT_FIELDS, "payout", False),
+}
+
+
+class ChangeStreamRelay:
+    """Feeds ``hub`` from a database change stream."""
+
+    def __init__(self, target: EventHub):
+        self.hub = target
+        self._task: Optional[asyncio.Task] = None
+        self._resume_token = None
+
+    async def _run(self, db) -> None:
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": ["bookings", "payouts"]},
+            "operationType": {"$in": ["insert", "update", "replace"]},
+        }}]
+        while True:
+            try:
+                async with db.watch(
+                    pipeline, full_document="updateLookup", resume_after=self._resume_token
+                ) as changes:
+                    self.hub.local_publishing = False
+                    async for change in changes:
+                        self._resume_token = changes.resume_token
+                        self._relay(change)
+            except PyMongoError:
+                logger.exception("Change stream failed; publishing local writes until it recovers")
+                self.hub.local_publishing = True
+                await asyncio.sleep(CHANGE_STREAM_RETRY_SECONDS)
+
+    def _relay(self, change: dict) -> None:
+        spec = CHANGE_EVENTS.get((change["ns"]["coll"], change["operationType"]))
+        doc = change.get("fullDocument")
+        if spec is None or doc is None:
+            return
+        event_type, fields, name, include_customer = spec
+        self.hub.publish(
+            event_type,
+            _audience(doc, include_customer),
+            {name: _project(doc, fields)},
+            event_id=change["_id"]["_data"]
+        )
+
+    def start(self, db) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(db))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.hub.local_publishing = True
+
+
+change_stream_relay = ChangeStreamRelay(hub)
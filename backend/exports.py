@@ -0,0 +1,144 @@
+"""Streaming CSV and NDJSON exports of bookings, payments and payouts.
+
+Rows are read from the Motor cursor ``EXPORT_BATCH_SIZE`` at a time in the
+same newest-first keyset order as the list endpoints.  Each batch is encoded
+(and gzipped, with ``gzip=true``) and written before the next one is
+fetched, so a worker holds one batch at a time however large the export.
+
+Every row carries the keyset cursor of that row: the last CSV column, or
+``_cursor`` in NDJSON.  A client whose download breaks off passes the cursor
+of the last complete row it received as ``?cursor=`` and carries on from the
+next row.  A cursor from a list endpoint's ``X-Next-Cursor`` header works
+the same way.  Rows created after the export started sort before its first
+row, so they never appear halfway through; export again with ``from`` to
+pick them up.
+
+Exports read through the ``export`` route class, which can be sent to a
+secondary (see database.py).
+"""
+import csv
+import io
+import os
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Type
+
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+import archive
+import pagination
+from models import Booking, Payment, Payout
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+
+CSV = "csv"
+NDJSON = "ndjson"
+MEDIA_TYPES = {CSV: "text/csv; charset=utf-8", NDJSON: pagination.NDJSON_MEDIA_TYPE}
+GZIP_MEDIA_TYPE = "application/gzip"
+CURSOR_COLUMN = "_cursor"
+
+EXPORTS: Dict[str, Type[BaseModel]] = {"bookings": Booking, "payments": Payment, "payouts": Payout}
+
+
+def export_filter(model: Type[BaseModel], filters: Dict[str, Optional[str]]) -> dict:
+    """Equality filters, rejecting fields ``model`` does not have."""
+    filters = {field: value for field, value in filters.items() if value is not None}
+    unknown = [field for field in filters if field not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot filter {model.__name__} exports by {', '.join(unknown)}")
+    return filters
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value).decode()
+    return value
+
+
+async def _batches(docs: AsyncIterator[dict], batch_size: int) -> AsyncIterator[List[dict]]:
+    batch = []
+    async for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _csv_chunks(docs: AsyncIterator[dict], columns: List[str], batch_size: int) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns + [CURSOR_COLUMN])
+    yield buffer.getvalue().encode()
+    buffer.seek(0)
+    buffer.truncate()
+    async for batch in _batches(docs, batch_size):
+        for doc in batch:
+            writer.writerow([_csv_value(doc.get(column)) for column in columns] + [pagination.encode_cursor(doc)])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+async def _ndjson_chunks(docs: AsyncIterator[dict], columns: List[str], batch_size: int) -> AsyncIterator[bytes]:
+    async for batch in _batches(docs, batch_size):
+        yield b"".join(
+            orjson.dumps({**{column: doc.get(column) for column in columns}, CURSOR_COLUMN: pagination.encode_cursor(doc)})
+            + b"\n"
+            for doc in batch
+        )
+
+
+async def _gzipped(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # wbits=31 writes a gzip container rather than a bare zlib stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(
+    db,
+    collection: str,
+    fmt: str,
+    created_range: dict,
+    filters: Dict[str, Optional[str]],
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_archived: bool = False,
+    gzip: bool = False,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> StreamingResponse:
+    if collection not in EXPORTS:
+        raise HTTPException(status_code=404, detail=f"Exports are available for {', '.join(EXPORTS)}")
+    if fmt not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(MEDIA_TYPES)}")
+    model = EXPORTS[collection]
+    query = {**created_range, **export_filter(model, filters)}
+
+    # Cursors are checked here, before the response starts
+    docs = pagination.keyset_stream(
+        archive.sources(db, collection, include_archived), query, model, cursor, limit, batch_size
+    )
+    columns = list(model.model_fields)
+    chunks = (_csv_chunks if fmt == CSV else _ndjson_chunks)(docs, columns, batch_size)
+    filename = f"{collection}-{datetime.utcnow():%Y%m%dT%H%M%S}.{fmt}"
+    if gzip:
+        chunks = _gzipped(chunks)
+        filename += ".gz"
+    return StreamingResponse(
+        chunks,
+        media_type=GZIP_MEDIA_TYPE if gzip else MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
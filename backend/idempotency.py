@@ -0,0 +1,92 @@
+"""``Idempotency-Key`` support for write routes.
+
+The first request with a key claims ``idempotency_keys/<user_id>:<key>``
+(the ``_id`` index makes the claim atomic) and stores its response when it
+finishes.  A retry with the same key and body gets that response back
+instead of repeating the write; a retry while the original is still running
+gets 409.  Claims left behind by a crashed request can be taken over after
+``IDEMPOTENCY_LOCK_SECONDS``.  Keys expire through a TTL index on
+``created_at``.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 24 * 3600))
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", 60))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+IDEMPOTENCY_COLLECTION = "idempotency_keys"
+
+IN_PROGRESS = "IN_PROGRESS"
+DONE = "DONE"
+
+
+def _fingerprint(scope: str, payload: dict) -> str:
+    body = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(f"{scope}\n{body}".encode()).hexdigest()
+
+
+async def begin(db, user_id: str, key: str, scope: str, payload: dict) -> Optional[dict]:
+    """Claim ``key`` for this request.
+
+    Returns the stored response when the key was already used for the same
+    request, otherwise ``None`` and the caller must :func:`complete` or
+    :func:`release` the key.
+    """
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key")
+
+    # Naive UTC to match how the rest of the collections store timestamps
+    now = datetime.utcnow()
+    record_id = f"{user_id}:{key}"
+    fingerprint = _fingerprint(scope, payload)
+    try:
+        await db[IDEMPOTENCY_COLLECTION].insert_one({
+            "_id": record_id,
+            "fingerprint": fingerprint,
+            "status": IN_PROGRESS,
+            "locked_at": now,
+            "created_at": now
+        })
+        return None
+    except DuplicateKeyError:
+        pass
+
+    record = await db[IDEMPOTENCY_COLLECTION].find_one({"_id": record_id})
+    if record is None:
+        # Expired between the insert and the read; treat as a fresh key
+        return await begin(db, user_id, key, scope, payload)
+    if record["fingerprint"] != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    if record["status"] == DONE:
+        return record["response"]
+
+    taken_over = await db[IDEMPOTENCY_COLLECTION].update_one(
+        {"_id": record_id, "status": IN_PROGRESS, "locked_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}},
+        {"$set": {"locked_at": now}}
+    )
+    if taken_over.modified_count:
+        return None
+    raise HTTPException(
+        status_code=409,
+        detail="A request with this Idempotency-Key is still in progress",
+        headers={"Retry-After": "1"}
+    )
+
+
+async def complete(db, user_id: str, key: str, response: dict) -> None:
+    await db[IDEMPOTENCY_COLLECTION].update_one(
+        {"_id": f"{user_id}:{key}"},
+        {"$set": {"status": DONE, "response": response}}
+    )
+
+
+async def release(db, user_id: str, key: str) -> None:
+    """Forget a claim whose request failed so the client can retry it."""
+    await db[IDEMPOTENCY_COLLECTION].delete_one({"_id": f"{user_id}:{key}", "status": IN_PROGRESS})
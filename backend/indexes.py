@@ -0,0 +1,248 @@
+"""Declarative index registry and query-plan audit.
+
+``INDEXES`` lists every index the routes rely on; ``ensure_indexes`` applies
+it on startup.  ``QUERY_SHAPES`` mirrors the filters and sorts the routes
+issue, and ``explain_report`` asks the query planner how each one would run
+so that collection scans and in-memory sorts show up before they hurt.
+
+Usage::
+
+    python indexes.py ensure
+    python indexes.py explain
+"""
+import logging
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel
+from pymongo.errors import OperationFailure
+
+from archive import POLICIES, archive_collection
+from idempotency import IDEMPOTENCY_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def _unique_id() -> IndexModel:
+    return IndexModel([("id", ASCENDING)], unique=True, name="id_unique")
+
+
+def _keyset(*prefix: str) -> IndexModel:
+    # Equality prefix followed by the (created_at, id) keyset pagination order
+    keys = [(field, ASCENDING) for field in prefix] + [("created_at", DESCENDING), ("id", DESCENDING)]
+    return IndexModel(keys, name="_".join(prefix + ("created_at", "id")))
+
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        _unique_id(),
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+        _keyset(),
+    ],
+    "dealers": [
+        _unique_id(),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+    ],
+    "drivers": [
+        _unique_id(),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        _keyset("dealer_id"),
+        _keyset("is_active"),
+        _keyset("is_active", "vehicle_type"),
+        IndexModel(
+            [("location", GEOSPHERE), ("is_active", ASCENDING), ("vehicle_type", ASCENDING)],
+            name="location_2dsphere_is_active_vehicle_type"
+        ),
+    ],
+    "trips": [
+        _unique_id(),
+        _keyset("user_id"),
+        _keyset("status"),
+    ],
+    "bookings": [
+        _unique_id(),
+        _keyset("user_id"),
+        _keyset("driver_id"),
+        _keyset("dealer_id"),
+        _keyset("city"),
+        _keyset("status"),
+        _keyset(),
+    ],
+    "payments": [
+        _unique_id(),
+        IndexModel(
+            [("transaction_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"transaction_id": {"$type": "string"}},
+            name="transaction_id_unique"
+        ),
+        _keyset("user_id"),
+        _keyset("status"),
+        _keyset(),
+    ],
+    "payouts": [
+        _unique_id(),
+        IndexModel([("booking_id", ASCENDING)], unique=True, name="booking_id_unique"),
+        IndexModel([("batch_id", ASCENDING)], sparse=True, name="batch_id"),
+        _keyset("status"),
+        _keyset("driver_id"),
+        _keyset("dealer_id"),
+        _keyset("city"),
+        _keyset(),
+    ],
+    "payout_batches": [
+        _unique_id(),
+    ],
+    "payout_batch_applications": [
+        IndexModel(
+            [("batch_id", ASCENDING), ("target", ASCENDING), ("recipient", ASCENDING)],
+            unique=True,
+            name="batch_id_target_recipient_unique"
+        ),
+    ],
+    "idempotency_keys": [
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS, name="created_at_ttl"),
+    ],
+    "revoked_tokens": [
+        # Records carry the expiry of the last token they can reject
+        IndexModel([("exp", ASCENDING)], expireAfterSeconds=0, name="exp_ttl"),
+    ],
+}
+
+# Archives are read with the same filters and sorts as the hot collections
+for _collection in POLICIES:
+    INDEXES[archive_collection(_collection)] = INDEXES[_collection]
+
+
+async def ensure_indexes(db) -> None:
+    """Create every registered index; failures are logged, not raised."""
+    for collection, models in INDEXES.items():
+        try:
+            await db[collection].create_indexes(models)
+        except OperationFailure as exc:
+            # Usually duplicate data blocking a unique index; the app still runs
+            logger.error("Could not create indexes on %s: %s", collection, exc)
+
+
+KEYSET = {"created_at": -1, "id": -1}
+
+
+class QueryShape(NamedTuple):
+    name: str
+    collection: str
+    filter: dict
+    sort: Optional[dict] = None
+
+
+_RANGE = {"$gte": datetime(2000, 1, 1), "$lt": datetime(2100, 1, 1)}
+
+QUERY_SHAPES: List[QueryShape] = [
+    QueryShape("register/login", "users", {"email": ""}),
+    QueryShape("auth/me", "users", {"id": ""}),
+    QueryShape("admin/users", "users", {}, KEYSET),
+    QueryShape("admin/stats users", "users", {"created_at": _RANGE}),
+    QueryShape("dealer profile", "dealers", {"user_id": ""}),
+    QueryShape("driver profile", "drivers", {"user_id": ""}),
+    QueryShape("driver by id", "drivers", {"id": ""}),
+    QueryShape("drivers/available", "drivers", {"is_active": True}, KEYSET),
+    QueryShape("drivers/available by type", "drivers", {"is_active": True, "vehicle_type": ""}, KEYSET),
+    QueryShape("drivers/available nearest", "drivers", {
+        "location": {"$nearSphere": {
+            "$geometry": {"type": "Point", "coordinates": [0.0, 0.0]}, "$maxDistance": 5000
+        }},
+        "is_active": True
+    }),
+    QueryShape("dealers/drivers", "drivers", {"dealer_id": ""}, KEYSET),
+    QueryShape("trips list", "trips", {"user_id": ""}, KEYSET),
+    QueryShape("trip by id", "trips", {"id": "", "user_id": ""}),
+    QueryShape("bookings customer", "bookings", {"user_id": ""}, KEYSET),
+    QueryShape("bookings driver", "bookings", {"driver_id": ""}, KEYSET),
+    QueryShape("bookings dealer", "bookings", {"dealer_id": ""}, KEYSET),
+    QueryShape("bookings admin", "bookings", {}, KEYSET),
+    QueryShape("booking by id", "bookings", {"id": ""}),
+    QueryShape("booking accept", "bookings", {"id": "", "status": ""}),
+    QueryShape("dispatch pending", "bookings", {"status": ""}, {"created_at": 1, "id": 1}),
+    QueryShape("admin/stats bookings", "bookings", {"created_at": _RANGE}),
+    QueryShape("admin/stats bookings by city", "bookings", {"city": "", "created_at": _RANGE}),
+    QueryShape("payments customer", "payments", {"user_id": ""}, KEYSET),
+    QueryShape("payments by transaction", "payments", {"transaction_id": {"$in": [""], "$type": "string"}}),
+    QueryShape("payments admin", "payments", {}, KEYSET),
+    QueryShape("payouts admin", "payouts", {}, KEYSET),
+    QueryShape("payouts driver", "payouts", {"driver_id": ""}, KEYSET),
+    QueryShape("payouts dealer", "payouts", {"dealer_id": ""}, KEYSET),
+    QueryShape("payout by id", "payouts", {"id": ""}),
+    QueryShape("payout by booking", "payouts", {"booking_id": ""}),
+    QueryShape("payout batch selection", "payouts", {"status": "PENDING"}, {"created_at": 1, "id": 1}),
+    QueryShape("payouts by batch", "payouts", {"batch_id": ""}),
+    QueryShape("admin/stats payouts by city", "payouts", {"city": "", "created_at": _RANGE}),
+] + [
+    QueryShape(f"archive {collection}", collection, {**policy, "created_at": {"$lt": datetime(2000, 1, 1)}},
+               {"created_at": 1, "id": 1})
+    for collection, policy in POLICIES.items()
+]
+
+
+def _plan_stages(plan) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+
+async def explain_shape(db, shape: QueryShape) -> dict:
+    command = {"find": shape.collection, "filter": shape.filter, "limit": 100}
+    if shape.sort:
+        command["sort"] = shape.sort
+    explained = await db.command({"explain": command, "verbosity": "queryPlanner"})
+    stages = _plan_stages(explained["queryPlanner"]["winningPlan"])
+
+    issues = []
+    if "COLLSCAN" in stages:
+        issues.append("COLLSCAN")
+    if "SORT" in stages:
+        issues.append("in-memory SORT")
+    return {
+        "name": shape.name,
+        "collection": shape.collection,
+        "filter": shape.filter,
+        "sort": shape.sort,
+        "stages": stages,
+        "issues": issues,
+    }
+
+
+async def explain_report(db) -> List[dict]:
+    return [await explain_shape(db, shape) for shape in QUERY_SHAPES]
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import sys
+
+    from database import client, db
+
+    parser = argparse.ArgumentParser(description="Manage and audit MongoDB indexes")
+    parser.add_argument("command", choices=["ensure", "explain"])
+    args = parser.parse_args()
+
+    async def main() -> int:
+        if args.command == "ensure":
+            await ensure_indexes(db)
+            return 0
+        flagged = 0
+        for row in await explain_report(db):
+            status = ", ".join(row["issues"]) or "ok"
+            flagged += bool(row["issues"])
+            print(f"{row['collection']:<10} {row['name']:<32} {' > '.join(row['stages']):<40} {status}")
+        return 1 if flagged else 0
+
+    exit_code = asyncio.run(main())
+    client.close()
+    sys.exit(exit_code)
@@ -0,0 +1,237 @@
+"""High-rate driver location ingestion.
+
+Drivers stream positions over a WebSocket.  Each frame updates two things:
+
+* ``HotLocationStore`` – a grid of the latest position per online driver,
+  kept in-process so nearest-driver matching needs no database round trip.
+* ``LocationIngestor`` – a last-write-wins buffer that is flushed to Mongo
+  with one unordered ``bulk_write`` per interval.
+
+The buffer holds at most one entry per driver and at most ``max_pending``
+drivers, so a slow database cannot grow memory without bound: frames from
+new drivers are refused (and the socket told to back off) while it is full,
+and entries that sat in the buffer longer than ``stale_after`` seconds are
+dropped at flush time because a newer frame will follow.
+"""
+import asyncio
+import heapq
+import logging
+import math
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+import cache
+from settings import env_bool
+
+logger = logging.getLogger(__name__)
+
+LOCATION_FLUSH_INTERVAL_SECONDS = float(os.environ.get("LOCATION_FLUSH_INTERVAL_SECONDS", 1.0))
+LOCATION_MAX_PENDING = int(os.environ.get("LOCATION_MAX_PENDING", 50_000))
+LOCATION_STALE_AFTER_SECONDS = float(os.environ.get("LOCATION_STALE_AFTER_SECONDS", 30))
+LOCATION_GRID_CELL_DEGREES = float(os.environ.get("LOCATION_GRID_CELL_DEGREES", 0.01))
+DRIVER_LOCATION_MAX_AGE_SECONDS = int(os.environ.get("DRIVER_LOCATION_MAX_AGE_SECONDS", 300))
+# Serve nearest-driver queries from this process's hot store instead of $geoNear.
+# Only correct when every driver socket lands on the same worker.
+DRIVER_LOCATION_HOT_MATCHING = env_bool("DRIVER_LOCATION_HOT_MATCHING")
+
+EARTH_RADIUS_M = 6_371_000.0
+METERS_PER_DEGREE = 111_320.0
+
+
+def haversine_m(lng1: float, lat1: float, lng2: float, lat2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class HotLocationStore:
+    """Latest position of each online driver, bucketed into a lat/lng grid."""
+
+    def __init__(self, cell_degrees: float, max_age: float):
+        self.cell_degrees = cell_degrees
+        self.max_age = max_age
+        # driver_id -> (lng, lat, reported_at, vehicle_type)
+        self._positions: Dict[str, Tuple[float, float, float, str]] = {}
+        self._cells: Dict[Tuple[int, int], Set[str]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def _cell(self, lng: float, lat: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def _discard(self, driver_id: str, lng: float, lat: float) -> None:
+        cell = self._cell(lng, lat)
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(driver_id)
+            if not members:
+                del self._cells[cell]
+
+    def update(self, driver_id: str, lng: float, lat: float, reported_at: float, vehicle_type: str) -> None:
+        previous = self._positions.get(driver_id)
+        if previous is not None and self._cell(previous[0], previous[1]) != self._cell(lng, lat):
+            self._discard(driver_id, previous[0], previous[1])
+        self._cells[self._cell(lng, lat)].add(driver_id)
+        self._positions[driver_id] = (lng, lat, reported_at, vehicle_type)
+
+    def remove(self, driver_id: str) -> None:
+        previous = self._positions.pop(driver_id, None)
+        if previous is not None:
+            self._discard(driver_id, previous[0], previous[1])
+
+    def prune(self, now: Optional[float] = None) -> int:
+        cutoff = (now or time.time()) - self.max_age
+        stale = [driver_id for driver_id, position in self._positions.items() if position[2] < cutoff]
+        for driver_id in stale:
+            self.remove(driver_id)
+        return len(stale)
+
+    def position(self, driver_id: str) -> Optional[Tuple[float, float, float, str]]:
+        return self._positions.get(driver_id)
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        radius_m: float,
+        k: int,
+        vehicle_type: Optional[str] = None,
+        now: Optional[float] = None
+    ) -> List[Tuple[float, str]]:
+        """Return up to ``k`` ``(distance_m, driver_id)`` pairs, closest first."""
+        cutoff = (now or time.time()) - self.max_age
+        lat_span = radius_m / METERS_PER_DEGREE
+        lng_span = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        min_row, min_col = self._cell(lng - lng_span, lat - lat_span)
+        max_row, max_col = self._cell(lng + lng_span, lat + lat_span)
+
+        candidates = []
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                for driver_id in self._cells.get((row, col), ()):
+                    d_lng, d_lat, reported_at, d_type = self._positions[driver_id]
+                    if reported_at < cutoff or (vehicle_type and d_type != vehicle_type):
+                        continue
+                    distance = haversine_m(lng, lat, d_lng, d_lat)
+                    if distance <= radius_m:
+                        candidates.append((distance, driver_id))
+        return heapq.nsmallest(k, candidates)
+
+
+class LocationIngestor:
+    """Coalesces location frames and flushes them to Mongo in batches."""
+
+    def __init__(self, store: HotLocationStore, flush_interval: float, max_pending: int, stale_after: float):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.stale_after = stale_after
+        # driver_id -> (lng, lat, reported_at)
+        self._pending: Dict[str, Tuple[float, float, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "received": 0,
+            "coalesced": 0,
+            "dropped_backpressure": 0,
+            "dropped_stale": 0,
+            "written": 0,
+            "flushes": 0,
+            "flush_errors": 0,
+            "requeued": 0,
+            "last_flush_seconds": 0.0
+        }
+
+    def offer(self, driver_id: str, lng: float, lat: float, vehicle_type: Optional[str]) -> bool:
+        """Accept a frame; returns False when the buffer is full and the sender should back off."""
+        reported_at = time.time()
+        self.stats["received"] += 1
+        if vehicle_type is not None:
+            self.store.update(driver_id, lng, lat, reported_at, vehicle_type)
+        if driver_id in self._pending:
+            self.stats["coalesced"] += 1
+        elif len(self._pending) >= self.max_pending:
+            self.stats["dropped_backpressure"] += 1
+            return False
+        self._pending[driver_id] = (lng, lat, reported_at)
+        return True
+
+    async def flush(self, db) -> int:
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        cutoff = time.time() - self.stale_after
+        ops, written = [], []
+        for driver_id, (lng, lat, reported_at) in batch.items():
+            if reported_at < cutoff:
+                self.stats["dropped_stale"] += 1
+                continue
+            written.append(driver_id)
+            ops.append(UpdateOne(
+                {"id": driver_id},
+                {"$set": {
+                    "location": {"type": "Point", "coordinates": [lng, lat]},
+                    "location_updated_at": datetime.fromtimestamp(reported_at, timezone.utc)
+                }}
+            ))
+        if ops:
+            started = time.perf_counter()
+            try:
+                await db.drivers.bulk_write(ops, ordered=False)
+            except Exception:
+                self._requeue({driver_id: batch[driver_id] for driver_id in written})
+                raise
+            await cache.document_cache.invalidate(cache.DRIVERS, *written)
+            self.stats["last_flush_seconds"] = time.perf_counter() - started
+            self.stats["written"] += len(ops)
+        self.stats["flushes"] += 1
+        return len(ops)
+
+    def _requeue(self, batch: Dict[str, Tuple[float, float, float]]) -> None:
+        """Put back frames a failed write did not land; frames received since win."""
+        for driver_id, frame in batch.items():
+            pending = self._pending.get(driver_id)
+            if pending is None or pending[2] < frame[2]:
+                self._pending[driver_id] = frame
+        self.stats["requeued"] += len(batch)
+
+    async def _run(self, db) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # One flush at a time: while Mongo is slow, frames keep coalescing
+                await self.flush(db)
+            except Exception:
+                self.stats["flush_errors"] += 1
+                logger.exception("Location flush failed")
+            self.store.prune()
+
+    def start(self, db) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(db))
+
+    async def stop(self, db) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(db)
+
+    def metrics(self) -> dict:
+        return {**self.stats, "pending": len(self._pending), "online_drivers": len(self.store)}
+
+
+location_store = HotLocationStore(LOCATION_GRID_CELL_DEGREES, DRIVER_LOCATION_MAX_AGE_SECONDS)
+location_ingestor = LocationIngestor(
+    location_store, LOCATION_FLUSH_INTERVAL_SECONDS, LOCATION_MAX_PENDING, LOCATION_STALE_AFTER_SECONDS
+)
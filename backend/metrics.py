@@ -0,0 +1,260 @@
+"""Request latency, per-request MongoDB attribution and Prometheus export.
+
+``MetricsMiddleware`` times every HTTP request and keeps a latency
+histogram per route template.  While a request runs, a ``RequestStats``
+sits in a context variable; Motor copies the context into its executor
+threads, so ``CommandListener`` sees the same object and charges each
+command's duration and returned documents to the request that issued it.
+Commands outside a request (startup, background workers) still count
+toward the per-command totals.
+
+Requests slower than ``SLOW_REQUEST_SECONDS`` are logged with their query
+breakdown.  ``render`` produces the Prometheus text format served at
+``/api/metrics``.  Metrics are off unless ``METRICS_ENABLED=true``; when
+off, neither the middleware nor the listener is installed.  The endpoint
+answers admins, and scrapers that send ``METRICS_TOKEN`` as their bearer
+token; route templates and query shapes are not for anonymous callers.
+"""
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from settings import env_bool
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = env_bool("METRICS_ENABLED")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1.0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def is_scrape_token(token: str) -> bool:
+    return bool(METRICS_TOKEN) and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label set."""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Labels, value: float) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # One slot per bucket, then +Inf, sum
+                series = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values):
+                yield f"{self.name}_bucket{_labels(labels + (('le', repr(bound)),))} {count:g}"
+            yield f"{self.name}_bucket{_labels(labels + (('le', '+Inf'),))} {values[-2]:g}"
+            yield f"{self.name}_count{_labels(labels)} {values[-2]:g}"
+            yield f"{self.name}_sum{_labels(labels)} {values[-1]:.6f}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Labels, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Labels, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_labels(labels)} {value:g}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels) + "}"
+
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Request latency by route.")
+REQUESTS = Counter("http_requests_total", "Requests by route and status code.")
+REQUEST_DB_SECONDS = Counter("http_request_db_seconds_total", "Time spent in MongoDB commands by route.")
+REQUEST_DB_COMMANDS = Counter("http_request_db_commands_total", "MongoDB commands issued by route.")
+REQUEST_DB_DOCUMENTS = Counter("http_request_db_documents_total", "Documents returned by MongoDB by route.")
+COMMAND_SECONDS = Histogram("mongodb_command_duration_seconds", "MongoDB command latency by command.")
+COMMAND_FAILURES = Counter("mongodb_command_failures_total", "Failed MongoDB commands by command.")
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Document cache lookups by cache and result.")
+CACHE_HIT_AGE = Histogram(
+    "cache_hit_age_seconds", "Age of cached documents when served.", (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+REQUESTS_SHED = Counter("http_requests_shed_total", "Requests refused by rate limits or admission control.")
+
+REGISTRY = (
+    REQUEST_SECONDS, REQUESTS, REQUEST_DB_SECONDS, REQUEST_DB_COMMANDS, REQUEST_DB_DOCUMENTS,
+    COMMAND_SECONDS, COMMAND_FAILURES, CACHE_LOOKUPS, CACHE_HIT_AGE, REQUESTS_SHED,
+)
+
+
+class RequestStats:
+    """Mongo work charged to one request."""
+
+    __slots__ = ("commands", "db_seconds", "documents", "breakdown", "pending", "lock")
+
+    def __init__(self):
+        self.commands = 0
+        self.db_seconds = 0.0
+        self.documents = 0
+        # (command, collection) -> [count, seconds, documents]
+        self.breakdown: Dict[Tuple[str, str], List[float]] = {}
+        self.pending: Dict[int, str] = {}
+        self.lock = threading.Lock()
+
+    def record(self, command: str, collection: str, seconds: float, documents: int) -> None:
+        with self.lock:
+            self.commands += 1
+            self.db_seconds += seconds
+            self.documents += documents
+            entry = self.breakdown.setdefault((command, collection), [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += documents
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def _returned_documents(reply) -> int:
+    cursor = reply.get("cursor")
+    if cursor is not None:
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+    if "value" in reply:
+        return 1 if reply["value"] is not None else 0
+    return 0
+
+
+class CommandListener(monitoring.CommandListener):
+    def started(self, event):
+        stats = _current.get()
+        if stats is not None:
+            key = "collection" if event.command_name == "getMore" else event.command_name
+            collection = event.command.get(key)
+            with stats.lock:
+                stats.pending[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1e6
+        COMMAND_SECONDS.observe((("command", event.command_name),), seconds)
+        stats = _current.get()
+        if stats is not None:
+            with stats.lock:
+                collection = stats.pending.pop(event.request_id, "")
+            stats.record(event.command_name, collection, seconds, _returned_documents(event.reply))
+
+    def failed(self, event):
+        seconds = event.duration_micros / 1e6
+        COMMAND_SECONDS.observe((("command", event.command_name),), seconds)
+        COMMAND_FAILURES.inc((("command", event.command_name),))
+        stats = _current.get()
+        if stats is not None:
+            with stats.lock:
+                collection = stats.pending.pop(event.request_id, "")
+            stats.record(event.command_name, collection, seconds, 0)
+
+
+command_listener = CommandListener()
+
+
+def _route_template(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def _log_slow(method: str, path: str, seconds: float, stats: RequestStats) -> None:
+    breakdown = ", ".join(
+        f"{command} {collection or '-'} x{count:g} {spent * 1000:.1f}ms {docs:g} docs"
+        for (command, collection), (count, spent, docs) in sorted(
+            stats.breakdown.items(), key=lambda item: item[1][1], reverse=True
+        )
+    )
+    logger.warning(
+        "Slow request %s %s %.3fs (db %.3fs in %d commands, %d docs): %s",
+        method, path, seconds, stats.db_seconds, stats.commands, stats.documents, breakdown or "no db"
+    )
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware so streamed responses are timed to their last byte."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            seconds = time.perf_counter() - started
+            labels = (("method", scope["method"]), ("route", _route_template(scope)))
+            REQUEST_SECONDS.observe(labels, seconds)
+            REQUESTS.inc(labels + (("status", str(status)),))
+            if stats.commands:
+                REQUEST_DB_SECONDS.inc(labels, stats.db_seconds)
+                REQUEST_DB_COMMANDS.inc(labels, stats.commands)
+                REQUEST_DB_DOCUMENTS.inc(labels, stats.documents)
+            if seconds >= SLOW_REQUEST_SECONDS:
+                _log_slow(scope["method"], scope["path"], seconds, stats)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
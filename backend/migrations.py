@@ -0,0 +1,156 @@
+"""One-shot data migrations.
+
+``bson-datetimes`` rewrites timestamps that older builds stored as ISO
+strings into native BSON dates.  It walks each collection in ``_id`` order
+in small batches and records a checkpoint after every batch, so an
+interrupted run picks up where it stopped.  Each update is conditional on
+the old string value, so concurrent writers are never overwritten.
+
+``unset-stale-fields`` removes bookkeeping fields earlier builds wrote
+onto business documents and no longer read (see ``STALE_FIELDS``).
+
+Usage::
+
+    python migrations.py bson-datetimes [--batch-size 500] [--pause 0.05] [--restart]
+    python migrations.py unset-stale-fields
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_COLLECTION = "migrations"
+
+DATETIME_FIELDS: Dict[str, List[str]] = {
+    "users": ["created_at", "updated_at"],
+    "dealers": ["created_at"],
+    "drivers": ["created_at"],
+    "trips": ["created_at"],
+    "bookings": ["created_at"],
+    "payments": ["created_at"],
+    "payouts": ["created_at", "processed_at"],
+}
+
+# Collection -> fields nothing reads any more
+STALE_FIELDS: Dict[str, List[str]] = {
+    # Once-only markers, replaced by the payout_batch_applications ledger
+    "drivers": ["applied_payout_batches"],
+    "dealers": ["applied_payout_batches"],
+    "dashboard_counters": ["applied_payout_batches"],
+    "analytics_rollups": ["applied_payout_batches"],
+    # Copy of the old status kept by status transitions, now read from the
+    # document returned before the update
+    "bookings": ["previous_status"],
+    "trips": ["previous_status"],
+    "payouts": ["previous_status"],
+}
+
+
+def _parse(value: str):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+async def migrate_collection_datetimes(
+    db,
+    collection: str,
+    fields: List[str],
+    batch_size: int = 500,
+    pause: float = 0.0
+) -> int:
+    """Convert string timestamps in one collection; returns documents updated."""
+    checkpoint_id = f"bson_datetimes:{collection}"
+    checkpoint = await db[MIGRATIONS_COLLECTION].find_one({"_id": checkpoint_id}) or {}
+    if checkpoint.get("done"):
+        return 0
+
+    last_id = checkpoint.get("last_id")
+    updated = checkpoint.get("updated", 0)
+    has_string = {"$or": [{field: {"$type": "string"}} for field in fields]}
+    projection = {field: 1 for field in fields}
+
+    while True:
+        query = {**has_string, "_id": {"$gt": last_id}} if last_id is not None else has_string
+        batch = await db[collection].find(query, projection).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        ops = []
+        for doc in batch:
+            for field in fields:
+                value = doc.get(field)
+                parsed = _parse(value) if isinstance(value, str) else None
+                if parsed is None:
+                    if isinstance(value, str):
+                        logger.warning("Skipping unparseable %s.%s on %s: %r", collection, field, doc["_id"], value)
+                    continue
+                ops.append(UpdateOne({"_id": doc["_id"], field: value}, {"$set": {field: parsed}}))
+        if ops:
+            result = await db[collection].bulk_write(ops, ordered=False)
+            updated += result.modified_count
+
+        last_id = batch[-1]["_id"]
+        await db[MIGRATIONS_COLLECTION].update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"last_id": last_id, "updated": updated}},
+            upsert=True
+        )
+        if pause:
+            await asyncio.sleep(pause)
+
+    await db[MIGRATIONS_COLLECTION].update_one(
+        {"_id": checkpoint_id},
+        {"$set": {"done": True, "updated": updated, "finished_at": datetime.utcnow()}},
+        upsert=True
+    )
+    return updated
+
+
+async def migrate_bson_datetimes(db, batch_size: int = 500, pause: float = 0.0, restart: bool = False) -> Dict[str, int]:
+    if restart:
+        await db[MIGRATIONS_COLLECTION].delete_many({"_id": {"$regex": "^bson_datetimes:"}})
+    results = {}
+    for collection, fields in DATETIME_FIELDS.items():
+        results[collection] = await migrate_collection_datetimes(db, collection, fields, batch_size, pause)
+        logger.info("Converted %d %s timestamps", results[collection], collection)
+    return results
+
+
+async def unset_stale_fields(db) -> Dict[str, int]:
+    results = {}
+    for collection, fields in STALE_FIELDS.items():
+        result = await db[collection].update_many(
+            {"$or": [{field: {"$exists": True}} for field in fields]},
+            {"$unset": {field: "" for field in fields}}
+        )
+        results[collection] = result.modified_count
+        logger.info("Removed stale fields from %d %s documents", results[collection], collection)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import client, db
+
+    parser = argparse.ArgumentParser(description="Run data migrations")
+    parser.add_argument("migration", choices=["bson-datetimes", "unset-stale-fields"])
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument("--restart", action="store_true", help="ignore saved checkpoints")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.migration == "unset-stale-fields":
+        results = asyncio.run(unset_stale_fields(db))
+    else:
+        results = asyncio.run(migrate_bson_datetimes(db, args.batch_size, args.pause, args.restart))
+    for collection, count in results.items():
+        print(f"{collection}: {count} documents updated")
+    client.close()
@@ -48,6 +48,15 @@ class PayoutStatus(str, Enum):
 class BaseDBModel(BaseModel):
     model_config = ConfigDict(extra="ignore")
 
+    def to_mongo(self) -> dict:
+        """Dump for storage; datetimes stay native so they persist as BSON dates."""
+        return self.model_dump()
+
+    @classmethod
+    def from_mongo(cls, doc: dict):
+        """Build from a stored document; legacy ISO-string timestamps still parse."""
+        return cls.model_validate(doc)
+
 class User(BaseDBModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -99,6 +108,11 @@ class DealerCreate(BaseModel):
     bank_account: Optional[str] = None
     bank_ifsc: Optional[str] = None
 
+class GeoPoint(BaseModel):
+    """GeoJSON point; coordinates are ``[longitude, latitude]``."""
+    type: str = "Point"
+    coordinates: List[float]
+
 class Driver(BaseDBModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
@@ -110,8 +124,13 @@ class Driver(BaseDBModel):
     total_earnings: float = 0.0
     total_payouts: float = 0.0
     is_active: bool = True
+    location: Optional[GeoPoint] = None
+    location_updated_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class NearbyDriver(Driver):
+    distance_m: Optional[float] = None
+
 class DriverCreate(BaseModel):
     user_id: str
     dealer_id: Optional[str] = None
@@ -120,6 +139,10 @@ class DriverCreate(BaseModel):
     vehicle_number: str
     vehicle_type: VehicleType
 
+class DriverLocationUpdate(BaseModel):
+    lat: float = Field(ge=-90, le=90)
+    lng: float = Field(ge=-180, le=180)
+
 class Trip(BaseDBModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
@@ -155,6 +178,11 @@ class Booking(BaseDBModel):
     pickup_location: str
     dropoff_location: str
     booking_date: str
+    city: Optional[str] = None
+    pickup_point: Optional[GeoPoint] = None
+    vehicle_type: Optional[VehicleType] = None
+    preferred_dealer_id: Optional[str] = None
+    rate_version: Optional[str] = None
     status: BookingStatus = BookingStatus.PENDING
     payment_status: PaymentStatus = PaymentStatus.PENDING
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -166,6 +194,10 @@ class BookingCreate(BaseModel):
     dropoff_location: str
     booking_date: str
     total_days: int = 1
+    pickup_lat: Optional[float] = Field(None, ge=-90, le=90)
+    pickup_lng: Optional[float] = Field(None, ge=-180, le=180)
+    vehicle_type: Optional[VehicleType] = None
+    preferred_dealer_id: Optional[str] = None
 
 class Payment(BaseDBModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -175,6 +207,9 @@ class Payment(BaseDBModel):
     method: PaymentMethod
     transaction_id: Optional[str] = None
     status: PaymentStatus = PaymentStatus.PENDING
+    # Copied from the booking for analytics rollups
+    city: Optional[str] = None
+    vehicle_type: Optional[VehicleType] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class PaymentCreate(BaseModel):
@@ -183,6 +218,29 @@ class PaymentCreate(BaseModel):
     method: PaymentMethod
     transaction_id: Optional[str] = None
 
+class PaymentRecord(BaseModel):
+    """One settled transaction from a gateway reconciliation file."""
+    booking_id: str
+    amount: float
+    method: PaymentMethod
+    transaction_id: str = Field(min_length=1)
+    status: PaymentStatus = PaymentStatus.COMPLETED
+
+class PaymentBulkCreate(BaseModel):
+    payments: List[PaymentRecord]
+
+class PaymentBulkItem(BaseModel):
+    transaction_id: str
+    result: str
+    payment_id: Optional[str] = None
+    detail: Optional[str] = None
+
+class PaymentBulkResult(BaseModel):
+    created: int = 0
+    duplicates: int = 0
+    failed: int = 0
+    results: List[PaymentBulkItem] = []
+
 class Payout(BaseDBModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     booking_id: str
@@ -194,10 +252,55 @@ class Payout(BaseDBModel):
     dealer_id: Optional[str] = None
     driver_id: Optional[str] = None
     admin_id: Optional[str] = None
+    city: Optional[str] = None
+    vehicle_type: Optional[VehicleType] = None
     status: PayoutStatus = PayoutStatus.PENDING
     processed_at: Optional[datetime] = None
+    batch_id: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class PayoutBatchCreate(BaseModel):
+    """Either explicit ``payout_ids`` or a filter over pending payouts."""
+    batch_id: Optional[str] = None
+    payout_ids: Optional[List[str]] = None
+    driver_id: Optional[str] = None
+    dealer_id: Optional[str] = None
+    city: Optional[str] = None
+    created_before: Optional[datetime] = None
+
+class PayoutBatchFailure(BaseModel):
+    payout_id: str
+    reason: str
+
+class PayoutBatchResult(BaseModel):
+    batch_id: str
+    processed: int = 0
+    driver_total: float = 0.0
+    dealer_total: float = 0.0
+    failures: List[PayoutBatchFailure] = []
+
+class QuoteRow(BaseModel):
+    estimated_km: float = Field(ge=0)
+    total_days: int = Field(1, ge=1)
+    vehicle_type: Optional[VehicleType] = None
+    zone: Optional[str] = None
+    with_dealer: bool = False
+
+class QuoteBatchRequest(BaseModel):
+    rate_version: Optional[str] = None
+    rows: List[QuoteRow]
+
+class Quote(BaseModel):
+    fare: float
+    admin_commission: float
+    dealer_amount: float
+    dealer_commission: float
+    driver_amount: float
+
+class QuoteBatchResult(BaseModel):
+    rate_version: str
+    quotes: List[Quote]
+
 class DashboardStats(BaseModel):
     total_bookings: int = 0
     active_trips: int = 0
@@ -0,0 +1,126 @@
+"""Bulk ingestion of gateway payment records.
+
+Reconciliation files are replayed freely, so ingestion is keyed on the
+gateway ``transaction_id``: repeats inside a file, transactions already
+stored (or archived), and rows that lose a race with a concurrent replay (caught by the
+unique ``transaction_id`` index) are all reported as duplicates rather than
+stored twice.  New payments go in with one unordered ``insert_many`` and
+their bookings are marked paid with one ``bulk_write``.  Bookings this call
+moves to paid are stamped with its ``payment_ingest_id``, so exactly those
+are counted toward revenue rollups, even alongside a concurrent payment.
+"""
+import os
+import uuid
+from typing import Dict, List
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import archive
+import cache
+import counters
+import events
+import rollups
+from models import Payment, PaymentBulkCreate, PaymentBulkItem, PaymentBulkResult, PaymentStatus
+
+PAYMENT_BULK_MAX_SIZE = int(os.environ.get("PAYMENT_BULK_MAX_SIZE", 10_000))
+
+CREATED = "CREATED"
+DUPLICATE = "DUPLICATE"
+FAILED = "FAILED"
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+async def ingest(db, batch: PaymentBulkCreate) -> PaymentBulkResult:
+    records = batch.payments
+    if len(records) > PAYMENT_BULK_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {PAYMENT_BULK_MAX_SIZE} payments per request")
+
+    transaction_ids = list(dict.fromkeys(record.transaction_id for record in records))
+    # The $type clause repeats the partial index filter so the planner can use it
+    existing = {
+        doc["transaction_id"]: doc["id"]
+        async for doc in db.payments.find(
+            {"transaction_id": {"$in": transaction_ids, "$type": "string"}},
+            {"_id": 0, "id": 1, "transaction_id": 1}
+        )
+    }
+    # Archived payments are no longer in ``payments`` but were still paid
+    existing.update(await archive.archived_transactions(db, transaction_ids))
+    booking_ids = list({record.booking_id for record in records})
+    owners = {
+        doc["id"]: doc
+        async for doc in db.bookings.find(
+            {"id": {"$in": booking_ids}}, {"_id": 0, "id": 1, "user_id": 1, "city": 1, "vehicle_type": 1}
+        )
+    }
+
+    results: List[PaymentBulkItem] = []
+    docs: List[dict] = []
+    slots: List[int] = []  # index into ``results`` for each entry in ``docs``
+    seen = set()
+    for record in records:
+        txn = record.transaction_id
+        if txn in existing:
+            results.append(PaymentBulkItem(transaction_id=txn, result=DUPLICATE, payment_id=existing[txn]))
+        elif txn in seen:
+            results.append(PaymentBulkItem(transaction_id=txn, result=DUPLICATE, detail="Repeated in request"))
+        elif record.booking_id not in owners:
+            results.append(PaymentBulkItem(transaction_id=txn, result=FAILED, detail="Booking not found"))
+        else:
+            owner = owners[record.booking_id]
+            payment = Payment(
+                user_id=owner["user_id"],
+                city=owner.get("city"),
+                vehicle_type=owner.get("vehicle_type"),
+                **record.model_dump()
+            )
+            slots.append(len(results))
+            docs.append(payment.to_mongo())
+            results.append(PaymentBulkItem(transaction_id=txn, result=CREATED, payment_id=payment.id))
+        seen.add(txn)
+
+    rejected: Dict[int, dict] = {}
+    if docs:
+        try:
+            await db.payments.insert_many(docs, ordered=False)
+        except BulkWriteError as exc:
+            rejected = {error["index"]: error for error in exc.details["writeErrors"]}
+    for index, error in rejected.items():
+        item = results[slots[index]]
+        if error["code"] == DUPLICATE_KEY_ERROR:
+            item.result, item.payment_id, item.detail = DUPLICATE, None, "Stored concurrently"
+        else:
+            item.result, item.payment_id, item.detail = FAILED, None, error.get("errmsg")
+    inserted = [doc for index, doc in enumerate(docs) if index not in rejected]
+
+    await counters.record_changes(db, counters.payment_contributions, [(None, doc) for doc in inserted])
+    await rollups.record_changes(db, rollups.payment_rollup, [(None, doc) for doc in inserted])
+    paid = {doc["booking_id"] for doc in inserted if doc["status"] == PaymentStatus.COMPLETED.value}
+    if paid:
+        ingest_id = str(uuid.uuid4())
+        await db.bookings.bulk_write([
+            UpdateOne(
+                {"id": booking_id, "payment_status": {"$ne": PaymentStatus.COMPLETED.value}},
+                {"$set": {"payment_status": PaymentStatus.COMPLETED.value, "payment_ingest_id": ingest_id}}
+            )
+            for booking_id in paid
+        ], ordered=False)
+        settled = await db.bookings.find(
+            {"id": {"$in": list(paid)}, "payment_ingest_id": ingest_id},
+            {"_id": 0, "id": 1, "created_at": 1, "city": 1, "vehicle_type": 1, "final_price": 1, "payment_status": 1}
+        ).to_list(None)
+        await rollups.record_changes(db, rollups.booking_rollup, [
+            ({**booking, "payment_status": PaymentStatus.PENDING.value}, booking) for booking in settled
+        ])
+        await cache.document_cache.invalidate(cache.BOOKINGS, *paid)
+        await events.publish_bookings(db, [booking["id"] for booking in settled])
+
+    return PaymentBulkResult(
+        created=len(inserted),
+        duplicates=sum(item.result == DUPLICATE for item in results),
+        failed=sum(item.result == FAILED for item in results),
+        results=results
+    )
@@ -0,0 +1,248 @@
+"""Bulk payout settlement.
+
+A batch is recorded in ``payout_batches`` before anything is touched, and
+every write it makes is keyed to the batch id, so a batch that dies halfway
+is finished by submitting the same ``batch_id`` again:
+
+1. One ``bulk_write`` claims the selected payouts that are still pending,
+   stamping them with ``batch_id``.  Whatever carries the stamp afterwards
+   is this batch's work, whether claimed now or by an earlier attempt.
+2. Amounts are summed per driver and dealer in memory and applied with one
+   ``$inc`` each.  Every application is first recorded in
+   ``payout_batch_applications`` under a unique (batch, target, recipient)
+   key, and only recipients this attempt recorded are incremented, so
+   retries never credit twice.  Dashboard counters and analytics rollups are
+   settled the same way, upserting buckets that do not exist yet.  A payout
+   whose driver or dealer has no document is reported as a failure of the
+   batch.
+3. The ledger entry is closed with the result, which later submissions of
+   the same ``batch_id`` simply return.
+"""
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import cache
+import counters
+import events
+import rollups
+import transitions
+from models import PayoutBatchCreate, PayoutBatchFailure, PayoutBatchResult, PayoutStatus
+
+PAYOUT_BATCH_MAX_SIZE = int(os.environ.get("PAYOUT_BATCH_MAX_SIZE", 5000))
+
+BATCHES_COLLECTION = "payout_batches"
+APPLICATIONS_COLLECTION = "payout_batch_applications"
+DUPLICATE_KEY_ERROR = 11000
+
+# Why _apply_once may have left a recipient uncredited
+NOT_FOUND = "not found; total_payouts not credited"
+INTERRUPTED = "was being credited when an earlier attempt stopped; check total_payouts"
+
+OPEN = "OPEN"
+COMPLETED = "COMPLETED"
+
+
+async def _select(db, request: PayoutBatchCreate) -> List[str]:
+    if request.payout_ids is not None:
+        if len(request.payout_ids) > PAYOUT_BATCH_MAX_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"At most {PAYOUT_BATCH_MAX_SIZE} payouts per batch"
+            )
+        return list(dict.fromkeys(request.payout_ids))
+
+    query = {"status": PayoutStatus.PENDING.value}
+    for field in ("driver_id", "dealer_id", "city"):
+        value = getattr(request, field)
+        if value is not None:
+            query[field] = value
+    if request.created_before is not None:
+        query["created_at"] = {"$lt": request.created_before}
+    cursor = db.payouts.find(query, {"_id": 0, "id": 1}).sort([("created_at", 1), ("id", 1)])
+    return [doc["id"] async for doc in cursor.limit(PAYOUT_BATCH_MAX_SIZE)]
+
+
+async def _open_batch(db, request: PayoutBatchCreate, admin_id: str) -> dict:
+    if request.batch_id:
+        existing = await db[BATCHES_COLLECTION].find_one({"id": request.batch_id}, {"_id": 0})
+        if existing:
+            return existing
+
+    batch = {
+        "id": request.batch_id or str(uuid.uuid4()),
+        "admin_id": admin_id,
+        "payout_ids": await _select(db, request),
+        "status": OPEN,
+        "processed_at": datetime.now(timezone.utc),
+        "created_at": datetime.now(timezone.utc)
+    }
+    try:
+        await db[BATCHES_COLLECTION].insert_one(dict(batch))
+    except DuplicateKeyError:
+        # A concurrent submission with the same batch_id got there first
+        return await db[BATCHES_COLLECTION].find_one({"id": batch["id"]}, {"_id": 0})
+    return batch
+
+
+async def _claim(db, batch: dict) -> None:
+    pending = transitions.sources_for(transitions.PAYOUT_TRANSITIONS, PayoutStatus.PROCESSED)
+    processed = {
+        "status": PayoutStatus.PROCESSED.value,
+        "processed_at": batch["processed_at"],
+        "admin_id": batch["admin_id"],
+        "batch_id": batch["id"]
+    }
+    ops = [
+        UpdateOne({"id": payout_id, "status": {"$in": pending}}, {"$set": processed})
+        for payout_id in batch["payout_ids"]
+    ]
+    if ops:
+        await db.payouts.bulk_write(ops, ordered=False)
+
+
+async def _apply_once(
+    db, target: str, key: str, increments: Dict[str, dict], batch_id: str, upsert: bool = False
+) -> Dict[str, str]:
+    """Apply ``increments`` to ``db[target]`` once per batch.
+
+    Returns the recipients that may be uncredited, with the reason
+    (``NOT_FOUND`` or ``INTERRUPTED``).  With ``upsert`` missing documents
+    are created instead, as ``counters.record_changes`` and
+    ``rollups.apply_deltas`` do.
+
+    The ledger entry goes in before the ``$inc``, so a crash between the two
+    leaves the entry unconfirmed and the increment possibly unapplied; the
+    retry reports it instead of guessing.
+    """
+    collection = db[target]
+    uncredited = {}
+    if not upsert:
+        existing = {doc[key] async for doc in collection.find({key: {"$in": list(increments)}}, {key: 1})}
+        uncredited = {recipient: NOT_FOUND for recipient in increments if recipient not in existing}
+        increments = {recipient: inc for recipient, inc in increments.items() if recipient in existing}
+    if not increments:
+        return uncredited
+
+    now = datetime.now(timezone.utc)
+    entries = [
+        {
+            "batch_id": batch_id,
+            "target": target,
+            "recipient": recipient,
+            "increments": inc,
+            "applied": False,
+            "created_at": now
+        }
+        for recipient, inc in increments.items()
+    ]
+    recorded = list(increments)
+    try:
+        await db[APPLICATIONS_COLLECTION].insert_many(entries, ordered=False)
+    except BulkWriteError as exc:
+        errors = exc.details["writeErrors"]
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        # Recorded by an earlier attempt of this batch
+        duplicates = {error["index"] for error in errors}
+        seen = {recipient for index, recipient in enumerate(increments) if index in duplicates}
+        recorded = [recipient for recipient in increments if recipient not in seen]
+        async for entry in db[APPLICATIONS_COLLECTION].find(
+            {"batch_id": batch_id, "target": target, "recipient": {"$in": list(seen)}, "applied": False},
+            {"_id": 0, "recipient": 1}
+        ):
+            uncredited[entry["recipient"]] = INTERRUPTED
+
+    if recorded:
+        await collection.bulk_write(
+            [UpdateOne({key: recipient}, {"$inc": increments[recipient]}, upsert=upsert) for recipient in recorded],
+            ordered=False
+        )
+        await db[APPLICATIONS_COLLECTION].update_many(
+            {"batch_id": batch_id, "target": target, "recipient": {"$in": recorded}}, {"$set": {"applied": True}}
+        )
+    return uncredited
+
+
+async def process_batch(db, request: PayoutBatchCreate, admin_id: str) -> PayoutBatchResult:
+    batch = await _open_batch(db, request, admin_id)
+    if batch["status"] == COMPLETED:
+        return PayoutBatchResult(**batch["result"])
+
+    await _claim(db, batch)
+    claimed = await db.payouts.find({"batch_id": batch["id"]}, {"_id": 0}).to_list(None)
+
+    drivers, dealers = defaultdict(float), defaultdict(float)
+    counter_deltas = defaultdict(lambda: defaultdict(float))
+    rollup_deltas = []
+    for payout in claimed:
+        events.publish_payout(events.PAYOUT_UPDATED, payout)
+        if payout.get("driver_id"):
+            drivers[payout["driver_id"]] += payout["driver_amount"]
+        if payout.get("dealer_id"):
+            dealers[payout["dealer_id"]] += payout["dealer_amount"]
+        before = {**payout, "status": PayoutStatus.PENDING.value}
+        for cid, fields in counters.counter_deltas(counters.payout_contributions, before, payout).items():
+            for field, amount in fields.items():
+                counter_deltas[cid][field] += amount
+        rollup_deltas.append(rollups.rollup_deltas(rollups.payout_rollup, before, payout))
+
+    uncredited_drivers = await _apply_once(
+        db, "drivers", "id", {d: {"total_payouts": amount} for d, amount in drivers.items()}, batch["id"]
+    )
+    await cache.document_cache.invalidate(cache.DRIVERS, *drivers)
+    uncredited_dealers = await _apply_once(
+        db, "dealers", "id", {d: {"total_payouts": amount} for d, amount in dealers.items()}, batch["id"]
+    )
+    # Counters and rollups can be rebuilt from the payouts, so an interrupted credit is not a batch failure
+    await _apply_once(
+        db, counters.COUNTERS_COLLECTION, "_id", {cid: dict(inc) for cid, inc in counter_deltas.items()}, batch["id"],
+        upsert=True
+    )
+    await _apply_once(
+        db, rollups.ROLLUPS_COLLECTION, "_id", rollups.merge_deltas(rollup_deltas), batch["id"], upsert=True
+    )
+
+    claimed_ids = {payout["id"] for payout in claimed}
+    unclaimed = [payout_id for payout_id in batch["payout_ids"] if payout_id not in claimed_ids]
+    statuses = {
+        doc["id"]: doc["status"]
+        async for doc in db.payouts.find({"id": {"$in": unclaimed}}, {"_id": 0, "id": 1, "status": 1})
+    } if unclaimed else {}
+    failures = [
+        PayoutBatchFailure(
+            payout_id=payout_id,
+            reason=f"Payout is {statuses[payout_id]}" if payout_id in statuses else "Payout not found"
+        )
+        for payout_id in unclaimed
+    ]
+    # The payout is paid but its recipient's total may not have been credited
+    failures.extend(
+        PayoutBatchFailure(
+            payout_id=payout["id"], reason=f"{role} {payout[field]} {uncredited[payout[field]]}"
+        )
+        for payout in claimed
+        for role, field, uncredited in (
+            ("Driver", "driver_id", uncredited_drivers), ("Dealer", "dealer_id", uncredited_dealers)
+        )
+        if payout.get(field) in uncredited
+    )
+
+    result = PayoutBatchResult(
+        batch_id=batch["id"],
+        processed=len(claimed),
+        driver_total=sum(drivers.values()),
+        dealer_total=sum(dealers.values()),
+        failures=failures
+    )
+    await db[BATCHES_COLLECTION].update_one(
+        {"id": batch["id"]},
+        {"$set": {"status": COMPLETED, "result": result.model_dump(), "completed_at": datetime.now(timezone.utc)}}
+    )
+    return result
@@ -0,0 +1,123 @@
+"""Fares and payout splits driven by a versioned rate table.
+
+Each ``RateTable`` is immutable once published; changing prices means
+adding a new version to ``RATE_TABLES`` and pointing
+``PRICING_RATE_VERSION`` at it, so bookings and quotes can always be
+explained by the version they record.  An unknown ``PRICING_RATE_VERSION``
+stops the server at import.
+
+A fare is ``(base + km * per_km + days * per_day)`` scaled by the vehicle
+type and zone (trip city) surge multipliers; anything not listed in the
+table prices at 1.0.  ``quote_batch`` prices whole columns with NumPy and
+the scalar helpers used by the booking routes go through the same code.
+"""
+import os
+from typing import Dict, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+
+class RateTable(NamedTuple):
+    version: str
+    base_fare: float
+    per_km_rate: float
+    per_day_rate: float
+    admin_commission_percent: float
+    # Share of the post-commission amount that goes to the driver's dealer
+    dealer_share_percent: float
+    dealer_commission_percent: float
+    vehicle_multipliers: Dict[str, float] = {}
+    zone_multipliers: Dict[str, float] = {}
+
+
+RATE_TABLES: Dict[str, RateTable] = {
+    "2024-01": RateTable(
+        version="2024-01",
+        base_fare=50.0,
+        per_km_rate=5.0,
+        per_day_rate=200.0,
+        admin_commission_percent=10.0,
+        dealer_share_percent=22.0,
+        dealer_commission_percent=15.0,
+    ),
+}
+
+PRICING_RATE_VERSION = os.environ.get("PRICING_RATE_VERSION", max(RATE_TABLES))
+QUOTE_BATCH_MAX_ROWS = int(os.environ.get("QUOTE_BATCH_MAX_ROWS", 10_000))
+
+# Every booking prices against the active table, so refuse to start without one
+if PRICING_RATE_VERSION not in RATE_TABLES:
+    raise ValueError(
+        f"Unknown PRICING_RATE_VERSION {PRICING_RATE_VERSION!r}; published versions are {', '.join(sorted(RATE_TABLES))}"
+    )
+
+
+def rate_table(version: Optional[str] = None) -> RateTable:
+    """The table for ``version``, or the active one; ``KeyError`` if unknown."""
+    return RATE_TABLES[version or PRICING_RATE_VERSION]
+
+
+def _vehicle_key(vehicle_type) -> Optional[str]:
+    return getattr(vehicle_type, "value", vehicle_type)
+
+
+def _zone_key(zone: Optional[str]) -> Optional[str]:
+    return zone.strip().lower() if zone else None
+
+
+def _multipliers(values: Sequence, table: Dict[str, float], key) -> np.ndarray:
+    if not table:
+        return np.ones(len(values))
+    # Look each distinct value up once and broadcast back over the rows
+    keys = [key(value) for value in values]
+    distinct = {k: table.get(k, 1.0) for k in set(keys)}
+    return np.fromiter((distinct[k] for k in keys), dtype=float, count=len(keys))
+
+
+def payout_splits(fare: np.ndarray, with_dealer: np.ndarray, table: RateTable) -> Dict[str, np.ndarray]:
+    admin_commission = fare * (table.admin_commission_percent / 100)
+    remaining = fare - admin_commission
+    dealer_amount = np.where(with_dealer, remaining * (table.dealer_share_percent / 100), 0.0)
+    return {
+        "admin_commission": admin_commission,
+        "dealer_amount": dealer_amount,
+        "dealer_commission": dealer_amount * (table.dealer_commission_percent / 100),
+        "driver_amount": remaining - dealer_amount,
+    }
+
+
+def quote_batch(
+    estimated_km: Sequence[float],
+    total_days: Sequence[int],
+    vehicle_types: Sequence,
+    zones: Sequence[Optional[str]],
+    with_dealer: Sequence[bool],
+    table: RateTable
+) -> Dict[str, np.ndarray]:
+    """Price every row at once; returns one array per output column."""
+    km = np.asarray(estimated_km, dtype=float)
+    days = np.asarray(total_days, dtype=float)
+    surge = (
+        _multipliers(vehicle_types, table.vehicle_multipliers, _vehicle_key)
+        * _multipliers(zones, table.zone_multipliers, _zone_key)
+    )
+    fare = (table.base_fare + km * table.per_km_rate + days * table.per_day_rate) * surge
+    return {"fare": fare, **payout_splits(fare, np.asarray(with_dealer, dtype=bool), table)}
+
+
+def calculate_booking_price(
+    estimated_km: float,
+    total_days: int,
+    vehicle_type=None,
+    zone: Optional[str] = None,
+    table: Optional[RateTable] = None
+) -> float:
+    table = table or rate_table()
+    quote = quote_batch([estimated_km], [total_days], [vehicle_type], [zone], [False], table)
+    return float(quote["fare"][0])
+
+
+def generate_payout(booking_price: float, dealer_id: Optional[str] = None, table: Optional[RateTable] = None) -> dict:
+    table = table or rate_table()
+    splits = payout_splits(np.array([booking_price]), np.array([bool(dealer_id)]), table)
+    return {"booking_price": booking_price, **{name: float(values[0]) for name, values in splits.items()}}
@@ -0,0 +1,103 @@
+"""Resolve the caller to their driver or dealer profile.
+
+Most routes only need the caller's driver or dealer id to scope a query.
+Tokens from login and register carry ``driver_id``/``dealer_id`` claims, so
+those requests resolve without touching Mongo.  Tokens minted before the
+profile existed fall back to a lookup that is cached in-process; misses are
+cached only briefly and are cleared when the profile is created, so a new
+driver is recognised on the next request.
+"""
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from models import UserRole
+
+PROFILE_CACHE_TTL_SECONDS = float(os.environ.get("PROFILE_CACHE_TTL_SECONDS", 300))
+PROFILE_MISS_TTL_SECONDS = float(os.environ.get("PROFILE_MISS_TTL_SECONDS", 5))
+PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get("PROFILE_CACHE_MAX_ENTRIES", 100_000))
+
+DRIVER_PROJECTION = {"_id": 0, "id": 1, "dealer_id": 1}
+DEALER_PROJECTION = {"_id": 0, "id": 1}
+
+_MISSING = object()
+
+
+class ProfileCache:
+    """TTL cache of ``(collection, user_id) -> profile summary or None``."""
+
+    def __init__(self, ttl: float, miss_ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.max_entries = max_entries
+        self._entries: Dict[Tuple[str, str], Tuple[float, Optional[dict]]] = {}
+
+    def get(self, collection: str, user_id: str):
+        entry = self._entries.get((collection, user_id))
+        if entry is None:
+            return _MISSING
+        expires_at, profile = entry
+        if expires_at < time.monotonic():
+            self._entries.pop((collection, user_id), None)
+            return _MISSING
+        return profile
+
+    def set(self, collection: str, user_id: str, profile: Optional[dict]) -> None:
+        if len(self._entries) >= self.max_entries:
+            self._evict()
+        ttl = self.ttl if profile is not None else self.miss_ttl
+        self._entries[(collection, user_id)] = (time.monotonic() + ttl, profile)
+
+    def invalidate(self, collection: str, user_id: str) -> None:
+        self._entries.pop((collection, user_id), None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._entries.items() if expires_at < now]:
+            del self._entries[key]
+        while len(self._entries) >= self.max_entries:
+            # Dicts keep insertion order, so this drops the oldest entry
+            del self._entries[next(iter(self._entries))]
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_TTL_SECONDS, PROFILE_MISS_TTL_SECONDS, PROFILE_CACHE_MAX_ENTRIES)
+
+
+async def _lookup(db, collection: str, user_id: str, projection: dict) -> Optional[dict]:
+    profile = profile_cache.get(collection, user_id)
+    if profile is _MISSING:
+        profile = await db[collection].find_one({"user_id": user_id}, projection)
+        profile_cache.set(collection, user_id, profile)
+    return profile
+
+
+async def resolve_driver(db, current_user: dict) -> Optional[dict]:
+    """Return ``{"id", "dealer_id"}`` for the caller's driver profile, if any."""
+    if current_user.get("driver_id"):
+        return {"id": current_user["driver_id"], "dealer_id": current_user.get("dealer_id")}
+    return await _lookup(db, "drivers", current_user["user_id"], DRIVER_PROJECTION)
+
+
+async def resolve_dealer(db, current_user: dict) -> Optional[dict]:
+    """Return ``{"id"}`` for the caller's dealer profile, if any."""
+    if current_user["role"] == UserRole.DEALER.value and current_user.get("dealer_id"):
+        return {"id": current_user["dealer_id"]}
+    return await _lookup(db, "dealers", current_user["user_id"], DEALER_PROJECTION)
+
+
+async def profile_claims(db, user_id: str, role: str) -> dict:
+    """Look up the profile ids to embed in a freshly issued token."""
+    if role == UserRole.DRIVER.value:
+        driver = await db.drivers.find_one({"user_id": user_id}, DRIVER_PROJECTION)
+        profile_cache.set("drivers", user_id, driver)
+        if driver:
+            return {"driver_id": driver["id"], "dealer_id": driver.get("dealer_id")}
+    elif role == UserRole.DEALER.value:
+        dealer = await db.dealers.find_one({"user_id": user_id}, DEALER_PROJECTION)
+        profile_cache.set("dealers", user_id, dealer)
+        if dealer:
+            return {"dealer_id": dealer["id"]}
+    return {}
@@ -0,0 +1,367 @@
+"""Per-principal rate limits and admission control.
+
+Every request is sorted into a route class:
+
+* ``booking`` – creating, accepting and moving bookings, and paying for them
+* ``auth`` – login and registration, which spend bcrypt time
+* ``analytics`` – the stats and analytics dashboards
+* ``export`` – the admin exports, which stream for a long time
+* ``default`` – everything else
+
+Each class has token buckets per client IP and per user id (from the
+bearer token), refilling at ``*_rate`` tokens a second up to ``*_burst``.
+A request finding its bucket empty gets a 429 with ``Retry-After`` set to
+when the next token arrives.
+
+Admitted requests then need a slot: at most ``ADMISSION_MAX_CONCURRENT``
+run at once per worker, and at most ``concurrency`` from any one class.
+When there is no slot, requests wait in a queue of at most ``queue`` per
+class for up to ``ADMISSION_QUEUE_TIMEOUT_SECONDS``.  Freed slots go to the
+waiter with the lowest ``priority`` number, so bookings are served before
+analytics.  A request that finds its queue full, or times out waiting,
+gets a 503 with ``Retry-After``.
+
+Defaults are in ``ROUTE_CLASSES``; any field can be overridden with
+``RATE_LIMIT_<CLASS>_<FIELD>``, e.g. ``RATE_LIMIT_AUTH_IP_RATE=0.5``.  A rate
+of 0 turns that bucket off.
+
+Rate limiting is off unless ``RATE_LIMIT_ENABLED=true``.  Per-IP buckets
+also need to know where the client address comes from, since behind a
+load balancer every request arrives from the same peer and one shared
+bucket would throttle the whole deployment:
+
+* ``RATE_LIMIT_CLIENT_ADDRESS=peer`` – clients connect directly;
+* ``RATE_LIMIT_CLIENT_ADDRESS=forwarded`` – behind
+  ``RATE_LIMIT_TRUSTED_PROXIES`` proxies (default 1) that each append to
+  ``X-Forwarded-For``; the address the outermost one saw is used, so
+  entries a client adds itself are ignored.
+
+Left unset, only the per-user buckets and admission control apply.
+
+Buckets live in the worker (``RATE_LIMIT_BACKEND=local``), so each worker
+enforces the limits on its own.  With ``shared`` they are kept in a store
+every worker consults; ``LocalSharedStore`` stands in for it, and anything
+with the same async ``take`` can replace it, such as a script in a
+networked store.  Concurrency caps are always per worker.
+
+The SSE stream and WebSockets hold their connections open and have their
+own caps, so they are not counted here.
+"""
+import asyncio
+import heapq
+import math
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from itertools import count
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+import metrics
+from auth import authenticate_token
+from settings import env_bool
+
+RATE_LIMIT_ENABLED = env_bool("RATE_LIMIT_ENABLED")
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "local").lower()
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100_000))
+RATE_LIMIT_CLIENT_ADDRESS = os.environ.get("RATE_LIMIT_CLIENT_ADDRESS", "").lower()
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get("RATE_LIMIT_TRUSTED_PROXIES", 1))
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", 256))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", 2.0))
+ADMISSION_RETRY_AFTER_SECONDS = 1
+
+BOOKING = "booking"
+AUTH = "auth"
+ANALYTICS = "analytics"
+EXPORT = "export"
+DEFAULT = "default"
+
+
+class RouteLimits(NamedTuple):
+    priority: int
+    concurrency: int
+    queue: int
+    ip_rate: float
+    ip_burst: float
+    user_rate: float
+    user_burst: float
+
+
+ROUTE_CLASSES: Dict[str, RouteLimits] = {
+    BOOKING: RouteLimits(priority=0, concurrency=128, queue=256, ip_rate=20, ip_burst=60, user_rate=5, user_burst=20),
+    DEFAULT: RouteLimits(priority=1, concurrency=128, queue=256, ip_rate=50, ip_burst=100, user_rate=20, user_burst=50),
+    AUTH: RouteLimits(priority=2, concurrency=16, queue=32, ip_rate=0.5, ip_burst=10, user_rate=0, user_burst=0),
+    ANALYTICS: RouteLimits(priority=3, concurrency=8, queue=16, ip_rate=5, ip_burst=10, user_rate=1, user_burst=5),
+    EXPORT: RouteLimits(priority=3, concurrency=2, queue=0, ip_rate=0.1, ip_burst=2, user_rate=0.05, user_burst=2),
+}
+
+# First match wins; a class of None skips limiting entirely
+ROUTES: List[Tuple[Optional[frozenset], "re.Pattern", Optional[str]]] = [
+    (None, re.compile(r"^/api/bookings/stream$"), None),
+    (frozenset({"POST"}), re.compile(r"^/api/auth/(login|register)$"), AUTH),
+    (frozenset({"POST", "PATCH"}), re.compile(r"^/api/(bookings|payments)(/|$)"), BOOKING),
+    (None, re.compile(r"^/api/admin/exports/"), EXPORT),
+    (frozenset({"GET"}), re.compile(r"^/api/(admin/(stats|analytics)|(drivers|dealers|customer)/stats)$"), ANALYTICS),
+]
+
+
+def route_limits(route_class: str, defaults: RouteLimits) -> RouteLimits:
+    prefix = f"RATE_LIMIT_{route_class.upper()}"
+    overrides = {}
+    for field, default in defaults._asdict().items():
+        value = os.environ.get(f"{prefix}_{field.upper()}")
+        if value:
+            overrides[field] = RouteLimits.__annotations__[field](value)
+    return defaults._replace(**overrides)
+
+
+def classify(method: str, path: str) -> Optional[str]:
+    for methods, pattern, route_class in ROUTES:
+        if (methods is None or method in methods) and pattern.match(path):
+            return route_class
+    return DEFAULT
+
+
+class LocalBucketStore:
+    """Token buckets in this worker, least recently used dropped first."""
+
+    shared = False
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def _now(self) -> float:
+        return time.monotonic()
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """Take one token; returns 0, or the seconds until one is available."""
+        now = self._now()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class LocalSharedStore(LocalBucketStore):
+    """In-process stand-in for a networked bucket store shared by workers."""
+
+    shared = True
+
+    def _now(self) -> float:
+        # Workers share no monotonic clock
+        return time.time()
+
+
+class Admission:
+    """Concurrency slots per worker, handed to waiters by priority."""
+
+    def __init__(self, max_concurrent: int, limits: Dict[str, RouteLimits], queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.limits = limits
+        self.queue_timeout = queue_timeout
+        self.total = 0
+        self.active: Dict[str, int] = defaultdict(int)
+        self.queued: Dict[str, int] = defaultdict(int)
+        # (priority, arrival, route_class, future); abandoned entries are skipped
+        self._waiters: List[tuple] = []
+        self._arrival = count()
+
+    def _has_room(self, route_class: str) -> bool:
+        return self.total < self.max_concurrent and self.active[route_class] < self.limits[route_class].concurrency
+
+    def _grant(self, route_class: str) -> None:
+        self.total += 1
+        self.active[route_class] += 1
+
+    async def acquire(self, route_class: str) -> bool:
+        """Take a slot, waiting if need be; ``False`` means shed the request."""
+        if self._has_room(route_class):
+            self._grant(route_class)
+            return True
+        limits = self.limits[route_class]
+        if self.queued[route_class] >= limits.queue:
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (limits.priority, next(self._arrival), route_class, future))
+        self.queued[route_class] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            if future.cancel():
+                self.queued[route_class] -= 1
+            else:
+                self.release(route_class)
+            raise
+        if future.cancel():
+            # Still waiting when time ran out
+            self.queued[route_class] -= 1
+            return False
+        return True
+
+    def release(self, route_class: str) -> None:
+        self.total -= 1
+        self.active[route_class] -= 1
+        capped = []
+        while self._waiters and self.total < self.max_concurrent:
+            entry = heapq.heappop(self._waiters)
+            _, _, waiting_class, future = entry
+            if future.cancelled():
+                continue
+            if self.active[waiting_class] >= self.limits[waiting_class].concurrency:
+                capped.append(entry)
+                continue
+            self.queued[waiting_class] -= 1
+            self._grant(waiting_class)
+            future.set_result(None)
+        for entry in capped:
+            heapq.heappush(self._waiters, entry)
+
+
+def client_ip(scope) -> Optional[str]:
+    """The address per-IP buckets are keyed on, or ``None`` when not configured."""
+    if RATE_LIMIT_CLIENT_ADDRESS == "forwarded":
+        hops = [
+            hop.strip()
+            for name, value in scope["headers"] if name == b"x-forwarded-for"
+            for hop in value.decode("latin-1").split(",") if hop.strip()
+        ]
+        if len(hops) >= RATE_LIMIT_TRUSTED_PROXIES:
+            return hops[-RATE_LIMIT_TRUSTED_PROXIES]
+        return None
+    if RATE_LIMIT_CLIENT_ADDRESS == "peer":
+        client = scope.get("client")
+        return client[0] if client else None
+    return None
+
+
+def user_id(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer" or not token:
+                return None
+            try:
+                return authenticate_token(token)["user_id"]
+            except HTTPException:
+                # Left for the route to reject
+                return None
+    return None
+
+
+class RateLimiter:
+    def __init__(self, store, limits: Dict[str, RouteLimits], admission: Admission):
+        self.store = store
+        self.limits = limits
+        self.admission = admission
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"admitted": 0, "rate_limited": 0, "shed": 0}
+        )
+
+    async def wait_for_tokens(self, route_class: str, scope) -> float:
+        """0 if both buckets had a token, else the longer wait before retrying."""
+        limits = self.limits[route_class]
+        wait = 0.0
+        address = client_ip(scope) if limits.ip_rate else None
+        if address:
+            wait = await self.store.take(f"{route_class}:ip:{address}", limits.ip_rate, limits.ip_burst)
+        if limits.user_rate and not wait:
+            principal = user_id(scope)
+            if principal:
+                wait = await self.store.take(f"{route_class}:user:{principal}", limits.user_rate, limits.user_burst)
+        return wait
+
+    def refuse(self, route_class: str, reason: str, status: int, detail: str, retry_after: float):
+        self.stats[route_class][reason] += 1
+        metrics.REQUESTS_SHED.inc((("class", route_class), ("reason", reason)))
+        return JSONResponse(
+            {"detail": detail}, status_code=status, headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    def metrics(self) -> dict:
+        return {
+            "backend": RATE_LIMIT_BACKEND,
+            "client_address": RATE_LIMIT_CLIENT_ADDRESS or None,
+            "buckets": len(self.store),
+            "max_concurrent": self.admission.max_concurrent,
+            "active": self.admission.total,
+            "classes": {
+                route_class: {
+                    **limits._asdict(),
+                    **self.stats[route_class],
+                    "active": self.admission.active[route_class],
+                    "queued": self.admission.queued[route_class],
+                }
+                for route_class, limits in self.limits.items()
+            }
+        }
+
+
+class RateLimitMiddleware:
+    """Pure ASGI so a slot is held until a streamed response finishes."""
+
+    def __init__(self, app, limiter: Optional[RateLimiter] = None):
+        self.app = app
+        self.limiter = limiter or rate_limiter
+
+    async def __call__(self, scope, receive, send):
+        route_class = classify(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self.limiter
+        wait = await limiter.wait_for_tokens(route_class, scope)
+        if wait:
+            response = limiter.refuse(route_class, "rate_limited", 429, "Too many requests", wait)
+            await response(scope, receive, send)
+            return
+        if not await limiter.admission.acquire(route_class):
+            response = limiter.refuse(
+                route_class, "shed", 503, "Server is busy, please retry", ADMISSION_RETRY_AFTER_SECONDS
+            )
+            await response(scope, receive, send)
+            return
+
+        limiter.stats[route_class]["admitted"] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.admission.release(route_class)
+
+
+if RATE_LIMIT_CLIENT_ADDRESS not in ("", "peer", "forwarded"):
+    raise ValueError(f"Unknown RATE_LIMIT_CLIENT_ADDRESS {RATE_LIMIT_CLIENT_ADDRESS!r}")
+if RATE_LIMIT_TRUSTED_PROXIES < 1:
+    raise ValueError("RATE_LIMIT_TRUSTED_PROXIES must be at least 1")
+
+
+def _make_store():
+    if RATE_LIMIT_BACKEND == "shared":
+        return LocalSharedStore(RATE_LIMIT_MAX_KEYS)
+    if RATE_LIMIT_BACKEND == "local":
+        return LocalBucketStore(RATE_LIMIT_MAX_KEYS)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND {RATE_LIMIT_BACKEND!r}")
+
+
+_limits = {route_class: route_limits(route_class, defaults) for route_class, defaults in ROUTE_CLASSES.items()}
+rate_limiter = RateLimiter(
+    _make_store(), _limits, Admission(ADMISSION_MAX_CONCURRENT, _limits, ADMISSION_QUEUE_TIMEOUT_SECONDS)
+)
@@ -0,0 +1,333 @@
+"""Time-bucketed booking and revenue rollups for analytics.
+
+Every booking, payment and payout contributes a few metrics to one *cell*
+(its ``city`` and ``vehicle_type``) of the bucket its ``created_at`` falls
+in.  Buckets are kept at three levels, hour, day and month, in the
+``analytics_rollups`` collection, keyed ``"<level>:<period>"`` with one
+nested counter per cell and metric::
+
+    {"_id": "day:2024-03-07", "cells": {"Pune|SEDAN": {"revenue": 1840.0, ...}}}
+
+Write paths apply the difference between a document's contributions
+before and after the write, as ``counters`` does, with one ``$inc`` per
+bucket.  A query decomposes its range into whole months, whole days and
+leftover hours, as coarse as the requested granularity allows, so a year
+by month reads about a hundred documents and a year by day a few hundred.
+
+Revenue follows ``/api/admin/stats``: a booking's ``final_price`` once its
+``payment_status`` is COMPLETED, in the booking's hour.  ``payments`` counts
+payment records whatever their status.
+
+Payments and payouts carry the booking's ``city`` and ``vehicle_type``;
+records written before those were denormalized land in the ``-`` cell.
+Amounts are attributed to the hour the record was created, including
+``paid_out``, which follows the payout's status.
+
+``python rollups.py backfill`` rebuilds every bucket from the source and
+archive collections; run it once after deploying, and while writes are
+quiet, since it replaces buckets wholesale.
+"""
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import ReplaceOne, UpdateOne
+
+from archive import archive_collection
+from models import PaymentStatus, PayoutStatus
+
+ROLLUPS_COLLECTION = "analytics_rollups"
+
+HOUR = "hour"
+DAY = "day"
+WEEK = "week"
+MONTH = "month"
+GRANULARITIES = (HOUR, DAY, WEEK, MONTH)
+DIMENSIONS = ("city", "vehicle_type")
+METRICS = (
+    "bookings", "paid_bookings", "revenue", "payments", "payouts", "admin_commission", "dealer_commission", "paid_out"
+)
+COUNT_METRICS = {"bookings", "paid_bookings", "payments", "payouts"}
+
+ANALYTICS_HOURLY_MAX_DAYS = int(os.environ.get("ANALYTICS_HOURLY_MAX_DAYS", 31))
+ANALYTICS_DEFAULT_DAYS = 30
+UNKNOWN = "-"
+
+PERIOD_FORMATS = {HOUR: "%Y-%m-%dT%H", DAY: "%Y-%m-%d", MONTH: "%Y-%m"}
+
+Rollup = Dict[str, float]
+Deltas = Dict[str, Dict[str, float]]
+
+
+def _value(value):
+    return getattr(value, "value", value)
+
+
+def _created_at(doc: dict) -> datetime:
+    created_at = doc["created_at"]
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return created_at
+
+
+def period_start(level: str, moment: datetime) -> datetime:
+    if level == HOUR:
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if level == DAY:
+        return day
+    if level == WEEK:
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def _next_month(start: datetime) -> datetime:
+    return start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+
+
+def bucket_id(level: str, start: datetime) -> str:
+    return f"{level}:{start.strftime(PERIOD_FORMATS[level])}"
+
+
+def parse_bucket_id(bid: str) -> Tuple[str, datetime]:
+    level, period = bid.split(":", 1)
+    return level, datetime.strptime(period, PERIOD_FORMATS[level])
+
+
+def _key_part(value) -> str:
+    # Cell names become field paths, so they cannot contain "." or "$"
+    value = _value(value)
+    if value is None or value == "":
+        return UNKNOWN
+    return str(value).replace(".", "_").replace("$", "_").replace("|", "_")
+
+
+def cell(doc: dict) -> str:
+    return "|".join(_key_part(doc.get(dimension)) for dimension in DIMENSIONS)
+
+
+def booking_rollup(booking: dict) -> Rollup:
+    # Revenue is the price of paid bookings, as ``/api/admin/stats`` reports it
+    paid = _value(booking.get("payment_status")) == PaymentStatus.COMPLETED.value
+    return {
+        "bookings": 1,
+        "paid_bookings": 1 if paid else 0,
+        "revenue": booking.get("final_price", 0.0) if paid else 0.0
+    }
+
+
+def payment_rollup(payment: dict) -> Rollup:
+    return {"payments": 1}
+
+
+def payout_rollup(payout: dict) -> Rollup:
+    processed = _value(payout["status"]) == PayoutStatus.PROCESSED.value
+    return {
+        "payouts": 1,
+        "admin_commission": payout.get("admin_commission", 0.0),
+        "dealer_commission": payout.get("dealer_commission", 0.0),
+        "paid_out": payout.get("driver_amount", 0.0) + payout.get("dealer_amount", 0.0) if processed else 0.0
+    }
+
+
+def rollup_deltas(rollup: Callable[[dict], Rollup], before: Optional[dict], after: Optional[dict]) -> Deltas:
+    """Per-bucket ``$inc`` paths that turn ``before``'s contribution into ``after``'s."""
+    deltas = defaultdict(lambda: defaultdict(float))
+    for doc, sign in ((after, 1), (before, -1)):
+        if not doc:
+            continue
+        created_at = _created_at(doc)
+        prefix = f"cells.{cell(doc)}"
+        for metric, amount in rollup(doc).items():
+            for level in (HOUR, DAY, MONTH):
+                deltas[bucket_id(level, period_start(level, created_at))][f"{prefix}.{metric}"] += sign * amount
+    return {
+        bid: {path: amount for path, amount in paths.items() if amount}
+        for bid, paths in deltas.items()
+        if any(paths.values())
+    }
+
+
+async def record_change(
+    db,
+    rollup: Callable[[dict], Rollup],
+    before: Optional[dict] = None,
+    after: Optional[dict] = None
+) -> None:
+    await record_changes(db, rollup, [(before, after)])
+
+
+async def record_changes(
+    db,
+    rollup: Callable[[dict], Rollup],
+    changes: Iterable[Tuple[Optional[dict], Optional[dict]]]
+) -> None:
+    """Apply many ``(before, after)`` changes with one ``$inc`` per bucket."""
+    await apply_deltas(db, merge_deltas(rollup_deltas(rollup, before, after) for before, after in changes))
+
+
+def merge_deltas(many: Iterable[Deltas]) -> Deltas:
+    totals = defaultdict(lambda: defaultdict(float))
+    for deltas in many:
+        for bid, paths in deltas.items():
+            for path, amount in paths.items():
+                totals[bid][path] += amount
+    return {bid: dict(paths) for bid, paths in totals.items()}
+
+
+async def apply_deltas(db, deltas: Deltas) -> None:
+    ops = [UpdateOne({"_id": bid}, {"$inc": paths}, upsert=True) for bid, paths in deltas.items() if paths]
+    if ops:
+        await db[ROLLUPS_COLLECTION].bulk_write(ops, ordered=False)
+
+
+def plan_buckets(granularity: str, start: datetime, end: datetime) -> List[str]:
+    """Fewest stored buckets that exactly cover ``[start, end)`` at ``granularity``."""
+    use_months = granularity == MONTH
+    use_days = granularity != HOUR
+    ids = []
+    cursor = start
+    while cursor < end:
+        if use_months and cursor == period_start(MONTH, cursor) and _next_month(cursor) <= end:
+            ids.append(bucket_id(MONTH, cursor))
+            cursor = _next_month(cursor)
+        elif use_days and cursor == period_start(DAY, cursor) and cursor + timedelta(days=1) <= end:
+            ids.append(bucket_id(DAY, cursor))
+            cursor += timedelta(days=1)
+        else:
+            ids.append(bucket_id(HOUR, cursor))
+            cursor += timedelta(hours=1)
+    return ids
+
+
+def _metrics(values: Dict[str, float]) -> Dict[str, float]:
+    return {
+        metric: int(round(values.get(metric, 0))) if metric in COUNT_METRICS else values.get(metric, 0.0)
+        for metric in METRICS
+    }
+
+
+def _naive_utc(moment: datetime) -> datetime:
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+async def query(
+    db,
+    granularity: str,
+    date_from: Optional[datetime],
+    date_to: Optional[datetime],
+    group_by: List[str]
+) -> dict:
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(GRANULARITIES)}")
+    unknown = [dimension for dimension in group_by if dimension not in DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"group_by accepts {', '.join(DIMENSIONS)}")
+
+    # Ranges are whole hours: from rounds down, to (exclusive) rounds up
+    end = _naive_utc(date_to) if date_to else datetime.utcnow()
+    end_hour = period_start(HOUR, end)
+    end = end_hour if end_hour == end else end_hour + timedelta(hours=1)
+    start = period_start(HOUR, _naive_utc(date_from) if date_from else end - timedelta(days=ANALYTICS_DEFAULT_DAYS))
+    if start >= end:
+        raise HTTPException(status_code=400, detail="from must be before to")
+    if granularity == HOUR and end - start > timedelta(days=ANALYTICS_HOURLY_MAX_DAYS):
+        raise HTTPException(
+            status_code=400, detail=f"Hourly analytics cover at most {ANALYTICS_HOURLY_MAX_DAYS} days"
+        )
+
+    ids = plan_buckets(granularity, start, end)
+    periods = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+    read = 0
+    async for doc in db[ROLLUPS_COLLECTION].find({"_id": {"$in": ids}}, {"cells": 1}):
+        read += 1
+        _, bucket_start = parse_bucket_id(doc["_id"])
+        period = period_start(granularity, bucket_start)
+        for cell_key, metrics in (doc.get("cells") or {}).items():
+            values = dict(zip(DIMENSIONS, cell_key.split("|")))
+            group = tuple(values[dimension] for dimension in group_by)
+            for metric, amount in metrics.items():
+                periods[period][group][metric] += amount
+
+    totals = defaultdict(float)
+    buckets = []
+    for period in sorted(periods):
+        groups = []
+        for group, values in sorted(periods[period].items()):
+            groups.append({**dict(zip(group_by, group)), **_metrics(values)})
+            for metric, amount in values.items():
+                totals[metric] += amount
+        buckets.append({"period": period, "groups": groups})
+
+    return {
+        "granularity": granularity,
+        "from": start,
+        "to": end,
+        "group_by": group_by,
+        "buckets": buckets,
+        "totals": _metrics(totals),
+        "buckets_read": read
+    }
+
+
+BACKFILL_SOURCES = (
+    ("bookings", booking_rollup, {
+        "created_at": 1, "city": 1, "vehicle_type": 1, "final_price": 1, "payment_status": 1
+    }),
+    ("payments", payment_rollup, {"created_at": 1, "city": 1, "vehicle_type": 1}),
+    ("payouts", payout_rollup, {
+        "created_at": 1, "city": 1, "vehicle_type": 1, "status": 1, "admin_commission": 1,
+        "dealer_commission": 1, "driver_amount": 1, "dealer_amount": 1
+    }),
+)
+
+
+def _nest(paths: Dict[str, float]) -> dict:
+    cells = defaultdict(dict)
+    for path, amount in paths.items():
+        _, cell_key, metric = path.split(".")
+        cells[cell_key][metric] = amount
+    return dict(cells)
+
+
+async def backfill(db, batch_size: int = 1000) -> int:
+    """Rebuild every bucket from the source collections; returns buckets written."""
+    totals = defaultdict(lambda: defaultdict(float))
+    for collection, rollup, projection in BACKFILL_SOURCES:
+        for source in (collection, archive_collection(collection)):
+            cursor = db[source].find({}, {"_id": 0, **projection}).batch_size(batch_size)
+            async for doc in cursor:
+                for bid, paths in rollup_deltas(rollup, None, doc).items():
+                    for path, amount in paths.items():
+                        totals[bid][path] += amount
+
+    # Buckets nothing contributes to any more are emptied rather than left stale
+    async for doc in db[ROLLUPS_COLLECTION].find({}, {"_id": 1}):
+        totals.setdefault(doc["_id"], defaultdict(float))
+
+    ops = [ReplaceOne({"_id": bid}, {"_id": bid, "cells": _nest(paths)}, upsert=True) for bid, paths in totals.items()]
+    for start in range(0, len(ops), batch_size):
+        await db[ROLLUPS_COLLECTION].bulk_write(ops[start:start + batch_size], ordered=False)
+    return len(ops)
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    from database import client, db
+
+    parser = argparse.ArgumentParser(description="Maintain analytics rollups")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    written = asyncio.run(backfill(db, batch_size=args.batch_size))
+    print(f"Rebuilt {written} rollup buckets")
+    client.close()
@@ -1,10 +1,14 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
-import os
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from pydantic import ValidationError
+import json
 import logging
+import time
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 from typing import List, Optional
@@ -12,61 +16,69 @@ from typing import List, Optional
 from models import (
     User, UserCreate, UserLogin, UserResponse, UserRole,
     Dealer, DealerCreate, Driver, DriverCreate, VehicleType,
+    DriverLocationUpdate, NearbyDriver, GeoPoint,
     Trip, TripCreate, TripStatus,
     Booking, BookingCreate, BookingStatus, PaymentStatus,
-    Payment, PaymentCreate, PaymentMethod,
-    Payout, PayoutStatus, DashboardStats
+    Payment, PaymentCreate, PaymentMethod, PaymentBulkCreate, PaymentBulkResult,
+    Payout, PayoutStatus, PayoutBatchCreate, PayoutBatchResult,
+    QuoteBatchRequest, QuoteBatchResult, DashboardStats
 )
 from auth import (
-    hash_password, verify_password, create_access_token,
-    get_current_user, require_role, security
+    create_access_token, get_current_user, require_role, security, optional_security,
+    password_hasher, token_cache, authenticate, revoke_token, revoke_user
 )
+import database
+from database import client, db, dashboard_db, export_db, list_db
+import archive
+import cache
+import counters
+import events
+import exports
+import idempotency
+import indexes
+import metrics
+import pagination
+import payment_ingest
+import payout_batches
+import pricing
+import profiles
+import ratelimit
+import rollups
+import transitions
+from dispatch import dispatcher, DISPATCH_ENABLED
+from locations import (
+    location_ingestor, location_store,
+    DRIVER_LOCATION_MAX_AGE_SECONDS, DRIVER_LOCATION_HOT_MATCHING
+)
+from pagination import MAX_PAGE_SIZE
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
 # Create the main app
 app = FastAPI()
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Pricing constants
-BASE_FARE = 50.0
-PER_KM_RATE = 5.0
-PER_DAY_RATE = 200.0
-ADMIN_COMMISSION_PERCENT = 10.0
-DEALER_COMMISSION_PERCENT = 15.0
-
-def calculate_booking_price(estimated_km: float, total_days: int) -> float:
-    return BASE_FARE + (estimated_km * PER_KM_RATE) + (total_days * PER_DAY_RATE)
-
-def generate_payout(booking_price: float, dealer_id: Optional[str] = None) -> dict:
-    admin_commission = booking_price * (ADMIN_COMMISSION_PERCENT / 100)
-    remaining = booking_price - admin_commission
-    
-    if dealer_id:
-        dealer_total = remaining * 0.22  # Dealer gets 22% of remaining
-        dealer_commission = dealer_total * (DEALER_COMMISSION_PERCENT / 100)
-        driver_amount = remaining - dealer_total
-        dealer_amount = dealer_total
-    else:
-        dealer_amount = 0.0
-        dealer_commission = 0.0
-        driver_amount = remaining
-    
-    return {
-        "booking_price": booking_price,
-        "admin_commission": admin_commission,
-        "dealer_amount": dealer_amount,
-        "dealer_commission": dealer_commission,
-        "driver_amount": driver_amount
-    }
+# Nearest-driver search limits
+MAX_SEARCH_RADIUS_M = 50_000.0
+MAX_NEAREST_DRIVERS = 100
+
+def created_at_range(date_from: Optional[datetime], date_to: Optional[datetime]) -> dict:
+    """Build a half-open ``[from, to)`` filter on ``created_at``."""
+    bounds = {}
+    if date_from:
+        bounds["$gte"] = to_stored_timestamp(date_from)
+    if date_to:
+        bounds["$lt"] = to_stored_timestamp(date_to)
+    return {"created_at": bounds} if bounds else {}
+
+def to_stored_timestamp(value: datetime) -> datetime:
+    # Timestamps are stored as BSON dates in UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
 
 # ============= AUTH ROUTES =============
 
@@ -80,29 +92,33 @@ async def register(user_data: UserCreate):
     # Create user
     user_dict = user_data.model_dump()
     password = user_dict.pop("password")
-    user_dict["password_hash"] = hash_password(password)
+    user_dict["password_hash"] = await password_hasher.hash(password)
     
     user = User(**user_dict)
-    user_doc = user.model_dump()
-    user_doc['created_at'] = user_doc['created_at'].isoformat()
-    user_doc['updated_at'] = user_doc['updated_at'].isoformat()
+    user_doc = user.to_mongo()
     
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration for the same email
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create role-specific profile
+    dealer_id = None
     if user.role == UserRole.DEALER:
         dealer = Dealer(
             user_id=user.id,
             company_name=f"{user.name}'s Fleet"
         )
-        dealer_doc = dealer.model_dump()
-        dealer_doc['created_at'] = dealer_doc['created_at'].isoformat()
+        dealer_doc = dealer.to_mongo()
         await db.dealers.insert_one(dealer_doc)
+        profiles.profile_cache.invalidate("dealers", user.id)
+        dealer_id = dealer.id
     elif user.role == UserRole.DRIVER:
         # Driver profile will be created separately with vehicle info
         pass
     
-    token = create_access_token(user.id, user.email, user.role.value)
+    token = create_access_token(user.id, user.email, user.role.value, dealer_id=dealer_id)
     
     return {
         "token": token,
@@ -122,16 +138,32 @@ async def login(credentials: UserLogin):
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    if not verify_password(credentials.password, user["password_hash"]):
+    valid, new_hash = await password_hasher.verify_and_update(credentials.password, user["password_hash"])
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # Cost factor changed since this hash was made; upgrade it in place
+        await db.users.update_one(
+            {"id": user["id"], "password_hash": user["password_hash"]},
+            {"$set": {"password_hash": new_hash}}
+        )
     
-    token = create_access_token(user["id"], user["email"], user["role"])
+    claims = await profiles.profile_claims(db, user["id"], user["role"])
+    token = create_access_token(user["id"], user["email"], user["role"], **claims)
     
     return {
         "token": token,
         "user": UserResponse(**user)
     }
 
+@api_router.post("/auth/logout")
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    current_user: dict = Depends(get_current_user)
+):
+    await revoke_token(db, credentials.credentials, current_user["exp"])
+    return {"message": "Logged out"}
+
 @api_router.get("/auth/me", response_model=UserResponse)
 async def get_me(current_user: dict = Depends(get_current_user)):
     user = await db.users.find_one({"id": current_user["user_id"]}, {"_id": 0})
@@ -144,141 +176,345 @@ async def get_me(current_user: dict = Depends(get_current_user)):
 @api_router.post("/trips", response_model=Trip)
 async def create_trip(trip_data: TripCreate, current_user: dict = Depends(get_current_user)):
     trip = Trip(user_id=current_user["user_id"], **trip_data.model_dump())
-    trip_doc = trip.model_dump()
-    trip_doc['created_at'] = trip_doc['created_at'].isoformat()
+    trip_doc = trip.to_mongo()
     
     await db.trips.insert_one(trip_doc)
+    await counters.record_change(db, counters.trip_contributions, after=trip_doc)
     return trip
 
 @api_router.get("/trips", response_model=List[Trip])
-async def get_trips(current_user: dict = Depends(get_current_user)):
-    trips = await db.trips.find({"user_id": current_user["user_id"]}, {"_id": 0}).to_list(100)
-    for trip in trips:
-        if isinstance(trip['created_at'], str):
-            trip['created_at'] = datetime.fromisoformat(trip['created_at'])
-    return trips
+async def get_trips(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    include_archived: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    query = {"user_id": current_user["user_id"]}
+    sources = archive.sources(list_db, "trips", include_archived)
+    if pagination.wants_ndjson(request):
+        return pagination.stream_ndjson(sources, query, Trip, cursor, limit)
+    
+    trips = await pagination.paginate(sources, query, Trip, response, cursor, limit)
+    return pagination.render(trips, Trip, response)
 
 @api_router.get("/trips/{trip_id}", response_model=Trip)
-async def get_trip(trip_id: str, current_user: dict = Depends(get_current_user)):
-    trip = await db.trips.find_one({"id": trip_id, "user_id": current_user["user_id"]}, {"_id": 0})
-    if not trip:
+async def get_trip(trip_id: str, include_archived: bool = False, current_user: dict = Depends(get_current_user)):
+    trip = await cache.document_cache.get(
+        cache.TRIPS, trip_id, lambda: db.trips.find_one({"id": trip_id}, {"_id": 0})
+    )
+    if not trip and include_archived:
+        trip = await archive.find_one(db, "trips", {"id": trip_id}, include_archived)
+    if not trip or trip["user_id"] != current_user["user_id"]:
         raise HTTPException(status_code=404, detail="Trip not found")
-    if isinstance(trip['created_at'], str):
-        trip['created_at'] = datetime.fromisoformat(trip['created_at'])
-    return Trip(**trip)
+    return Trip.from_mongo(trip)
 
 @api_router.patch("/trips/{trip_id}", response_model=Trip)
 async def update_trip(trip_id: str, status: TripStatus, current_user: dict = Depends(get_current_user)):
-    result = await db.trips.update_one(
+    previous, trip = await transitions.transition(
+        db.trips,
         {"id": trip_id, "user_id": current_user["user_id"]},
-        {"$set": {"status": status.value}}
+        status,
+        transitions.TRIP_TRANSITIONS,
+        not_found="Trip not found"
     )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Trip not found")
-    
-    trip = await db.trips.find_one({"id": trip_id}, {"_id": 0})
-    if isinstance(trip['created_at'], str):
-        trip['created_at'] = datetime.fromisoformat(trip['created_at'])
-    return Trip(**trip)
+    await cache.document_cache.invalidate(cache.TRIPS, trip_id)
+    await counters.record_change(db, counters.trip_contributions, previous, trip)
+    return Trip.from_mongo(trip)
 
 # ============= DRIVER ROUTES =============
 
 @api_router.post("/drivers", response_model=Driver)
 async def create_driver_profile(driver_data: DriverCreate, current_user: dict = Depends(get_current_user)):
     driver = Driver(**driver_data.model_dump())
-    driver_doc = driver.model_dump()
-    driver_doc['created_at'] = driver_doc['created_at'].isoformat()
+    driver_doc = driver.to_mongo()
     
     await db.drivers.insert_one(driver_doc)
+    # Tokens issued before this profile existed resolve it on their next request
+    profiles.profile_cache.invalidate("drivers", driver.user_id)
     return driver
 
-@api_router.get("/drivers/available", response_model=List[Driver])
-async def get_available_drivers(vehicle_type: Optional[VehicleType] = None):
+@api_router.get("/drivers/available", response_model=List[NearbyDriver])
+async def get_available_drivers(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    vehicle_type: Optional[VehicleType] = None,
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    radius: float = Query(5000.0, gt=0, le=MAX_SEARCH_RADIUS_M),
+    k: int = Query(10, ge=1, le=MAX_NEAREST_DRIVERS)
+):
     query = {"is_active": True}
     if vehicle_type:
         query["vehicle_type"] = vehicle_type.value
     
-    drivers = await db.drivers.find(query, {"_id": 0}).to_list(100)
-    for driver in drivers:
-        if isinstance(driver['created_at'], str):
-            driver['created_at'] = datetime.fromisoformat(driver['created_at'])
-    return drivers
+    if (lat is None) != (lng is None):
+        raise HTTPException(status_code=400, detail="lat and lng must be given together")
+    if lat is not None:
+        return await find_nearest_drivers(query, lat, lng, radius, k)
+    
+    if pagination.wants_ndjson(request):
+        return pagination.stream_ndjson(list_db.drivers, query, Driver, cursor, limit)
+    
+    drivers = await pagination.paginate(list_db.drivers, query, Driver, response, cursor, limit)
+    return pagination.render(drivers, NearbyDriver, response)
+
+async def find_nearest_drivers(query: dict, lat: float, lng: float, radius: float, k: int) -> List[dict]:
+    if DRIVER_LOCATION_HOT_MATCHING:
+        return await find_nearest_drivers_in_memory(query, lat, lng, radius, k)
+    if DRIVER_LOCATION_MAX_AGE_SECONDS:
+        # Drivers who stopped reporting are treated as offline
+        cutoff = datetime.utcnow() - timedelta(seconds=DRIVER_LOCATION_MAX_AGE_SECONDS)
+        query = {**query, "location_updated_at": {"$gte": cutoff}}
+    return await db.drivers.aggregate([
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [lng, lat]},
+            "distanceField": "distance_m",
+            "maxDistance": radius,
+            "query": query,
+            "spherical": True
+        }},
+        {"$limit": k},
+        {"$project": {"_id": 0}}
+    ]).to_list(k)
+
+async def find_nearest_drivers_in_memory(query: dict, lat: float, lng: float, radius: float, k: int) -> List[dict]:
+    hits = location_store.nearest(lat, lng, radius, k, query.get("vehicle_type"))
+    if not hits:
+        return []
+    drivers = await db.drivers.find(
+        {**query, "id": {"$in": [driver_id for _, driver_id in hits]}}, {"_id": 0}
+    ).to_list(len(hits))
+    by_id = {driver["id"]: driver for driver in drivers}
+    return [
+        {**by_id[driver_id], "distance_m": distance}
+        for distance, driver_id in hits
+        if driver_id in by_id
+    ]
+
+@api_router.put("/drivers/location")
+async def update_driver_location(
+    location: DriverLocationUpdate,
+    current_user: dict = Depends(require_role([UserRole.DRIVER]))
+):
+    driver = await profiles.resolve_driver(db, current_user)
+    if not driver:
+        raise HTTPException(status_code=404, detail="Driver profile not found")
+    
+    profile = await db.drivers.find_one_and_update(
+        {"id": driver["id"]},
+        {"$set": {
+            "location": {"type": "Point", "coordinates": [location.lng, location.lat]},
+            "location_updated_at": datetime.utcnow()
+        }},
+        projection={"_id": 0, "vehicle_type": 1, "is_active": 1}
+    )
+    await cache.document_cache.invalidate(cache.DRIVERS, driver["id"])
+    if profile and profile.get("is_active"):
+        location_store.update(driver["id"], location.lng, location.lat, time.time(), profile["vehicle_type"])
+    return {"message": "Location updated"}
+
+@api_router.websocket("/drivers/location/ws")
+async def driver_location_socket(websocket: WebSocket, token: str):
+    """Stream ``{"lat": .., "lng": ..}`` frames; positions are written in batches."""
+    try:
+        current_user = await authenticate(db, token)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    driver = await profiles.resolve_driver(db, current_user) if current_user["role"] == UserRole.DRIVER.value else None
+    profile = driver and await db.drivers.find_one({"id": driver["id"]}, {"_id": 0, "vehicle_type": 1, "is_active": 1})
+    if not profile:
+        await websocket.close(code=4403)
+        return
+    
+    await websocket.accept()
+    # Inactive drivers are persisted but never offered for matching
+    vehicle_type = profile["vehicle_type"] if profile.get("is_active") else None
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            try:
+                frame = DriverLocationUpdate.model_validate(json.loads(raw))
+            except (ValueError, ValidationError):
+                await websocket.send_json({"type": "error", "detail": "Expected {\"lat\": float, \"lng\": float}"})
+                continue
+            if not location_ingestor.offer(driver["id"], frame.lng, frame.lat, vehicle_type):
+                await websocket.send_json({
+                    "type": "backpressure",
+                    "retry_after_ms": int(location_ingestor.flush_interval * 1000)
+                })
+    except WebSocketDisconnect:
+        pass
 
 @api_router.get("/drivers/profile")
 async def get_driver_profile(current_user: dict = Depends(get_current_user)):
-    driver = await db.drivers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+    driver = await profiles.resolve_driver(db, current_user)
+    if driver:
+        driver = await cache.document_cache.get(
+            cache.DRIVERS, driver["id"], lambda: db.drivers.find_one({"id": driver["id"]}, {"_id": 0})
+        )
     if not driver:
         raise HTTPException(status_code=404, detail="Driver profile not found")
-    if isinstance(driver['created_at'], str):
-        driver['created_at'] = datetime.fromisoformat(driver['created_at'])
     return driver
 
 @api_router.get("/drivers/stats")
 async def get_driver_stats(current_user: dict = Depends(get_current_user)):
-    driver = await db.drivers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+    driver = await profiles.resolve_driver(db, current_user)
     if not driver:
         raise HTTPException(status_code=404, detail="Driver profile not found")
     
-    bookings = await db.bookings.find({"driver_id": driver["id"]}, {"_id": 0}).to_list(1000)
-    
-    total_bookings = len(bookings)
-    completed = len([b for b in bookings if b["status"] == BookingStatus.COMPLETED.value])
-    active = len([b for b in bookings if b["status"] in [BookingStatus.ACCEPTED.value, BookingStatus.IN_PROGRESS.value]])
+    stats = await counters.get_counters(dashboard_db, counters.DRIVER, driver["id"])
     
     return DashboardStats(
-        total_bookings=total_bookings,
-        active_trips=active,
-        total_earnings=driver["total_earnings"],
-        pending_payouts=driver["total_earnings"] - driver["total_payouts"]
+        total_bookings=stats.get("total_bookings", 0),
+        active_trips=stats.get("active_trips", 0),
+        total_earnings=stats.get("total_earnings", 0.0),
+        pending_payouts=stats.get("total_earnings", 0.0) - stats.get("total_paid_out", 0.0)
+    )
+
+# ============= QUOTE ROUTES =============
+
+@api_router.post("/quotes/batch", response_model=QuoteBatchResult)
+async def quote_batch(request: QuoteBatchRequest, current_user: dict = Depends(get_current_user)):
+    rows = request.rows
+    if len(rows) > pricing.QUOTE_BATCH_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"At most {pricing.QUOTE_BATCH_MAX_ROWS} rows per request")
+    try:
+        rates = pricing.rate_table(request.rate_version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown rate version")
+    
+    columns = pricing.quote_batch(
+        [row.estimated_km for row in rows],
+        [row.total_days for row in rows],
+        [row.vehicle_type for row in rows],
+        [row.zone for row in rows],
+        [row.with_dealer for row in rows],
+        rates
     )
+    names = list(columns)
+    quotes = [dict(zip(names, values)) for values in zip(*(columns[name].tolist() for name in names))]
+    return {"rate_version": rates.version, "quotes": quotes}
 
 # ============= BOOKING ROUTES =============
 
 @api_router.post("/bookings", response_model=Booking)
 async def create_booking(booking_data: BookingCreate, current_user: dict = Depends(get_current_user)):
+    if (booking_data.pickup_lat is None) != (booking_data.pickup_lng is None):
+        raise HTTPException(status_code=400, detail="pickup_lat and pickup_lng must be given together")
+    pickup_point = None
+    if booking_data.pickup_lat is not None:
+        pickup_point = GeoPoint(coordinates=[booking_data.pickup_lng, booking_data.pickup_lat])
+    
+    # Denormalize the trip city so revenue can be sliced without a join
+    trip = await db.trips.find_one({"id": booking_data.trip_id}, {"_id": 0, "city": 1})
+    city = trip.get("city") if trip else None
+    
     # Calculate price
-    final_price = calculate_booking_price(booking_data.estimated_km, booking_data.total_days)
+    rates = pricing.rate_table()
+    final_price = pricing.calculate_booking_price(
+        booking_data.estimated_km, booking_data.total_days, booking_data.vehicle_type, city, rates
+    )
     
     booking = Booking(
         user_id=current_user["user_id"],
+        base_fare=rates.base_fare,
+        per_km_rate=rates.per_km_rate,
+        per_day_rate=rates.per_day_rate,
         final_price=final_price,
-        **booking_data.model_dump()
+        rate_version=rates.version,
+        city=city,
+        pickup_point=pickup_point,
+        **booking_data.model_dump(exclude={"pickup_lat", "pickup_lng"})
     )
-    booking_doc = booking.model_dump()
-    booking_doc['created_at'] = booking_doc['created_at'].isoformat()
+    booking_doc = booking.to_mongo()
     
     await db.bookings.insert_one(booking_doc)
+    await counters.record_change(db, counters.booking_contributions, after=booking_doc)
+    await rollups.record_change(db, rollups.booking_rollup, after=booking_doc)
+    events.publish_booking(events.BOOKING_CREATED, booking_doc)
     return booking
 
 @api_router.get("/bookings", response_model=List[Booking])
-async def get_bookings(current_user: dict = Depends(get_current_user)):
+async def get_bookings(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    include_archived: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
     query = {"user_id": current_user["user_id"]}
     
     if current_user["role"] == UserRole.DRIVER.value:
-        driver = await db.drivers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+        driver = await profiles.resolve_driver(db, current_user)
         if driver:
             query = {"driver_id": driver["id"]}
     elif current_user["role"] == UserRole.DEALER.value:
-        dealer = await db.dealers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+        dealer = await profiles.resolve_dealer(db, current_user)
         if dealer:
             query = {"dealer_id": dealer["id"]}
     elif current_user["role"] == UserRole.ADMIN.value:
         query = {}
     
-    bookings = await db.bookings.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for booking in bookings:
-        if isinstance(booking['created_at'], str):
-            booking['created_at'] = datetime.fromisoformat(booking['created_at'])
-    return bookings
+    sources = archive.sources(list_db, "bookings", include_archived)
+    if pagination.wants_ndjson(request):
+        return pagination.stream_ndjson(sources, query, Booking, cursor, limit)
+    
+    bookings = await pagination.paginate(sources, query, Booking, response, cursor, limit)
+    return pagination.render(bookings, Booking, response)
+
+@api_router.get("/bookings/stream")
+async def stream_booking_events(
+    token: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Server-Sent Events for the bookings and payouts the caller can see.
+
+    ``EventSource`` cannot set headers, so the token may also be passed as
+    ``?token=``.
+    """
+    if credentials is not None:
+        token = credentials.credentials
+    if token is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    current_user = await authenticate(db, token)
+    
+    driver = dealer = None
+    if current_user["role"] == UserRole.DRIVER.value:
+        driver = await profiles.resolve_driver(db, current_user)
+    elif current_user["role"] == UserRole.DEALER.value:
+        dealer = await profiles.resolve_dealer(db, current_user)
+    keys = events.subscriber_keys(current_user, driver, dealer)
+    
+    subscriber = events.hub.subscribe(keys)
+    if subscriber is None:
+        raise HTTPException(
+            status_code=503, detail="Too many event subscribers", headers={"Retry-After": "30"}
+        )
+    # Replay is read after subscribing so nothing falls between the two
+    backlog = events.hub.replay_after(last_event_id, keys) if last_event_id else []
+    return StreamingResponse(
+        events.stream(subscriber, backlog),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @api_router.get("/bookings/{booking_id}", response_model=Booking)
-async def get_booking(booking_id: str, current_user: dict = Depends(get_current_user)):
-    booking = await db.bookings.find_one({"id": booking_id}, {"_id": 0})
+async def get_booking(booking_id: str, include_archived: bool = False, current_user: dict = Depends(get_current_user)):
+    booking = await cache.document_cache.get(
+        cache.BOOKINGS, booking_id, lambda: db.bookings.find_one({"id": booking_id}, {"_id": 0})
+    )
+    if not booking and include_archived:
+        booking = await archive.find_one(db, "bookings", {"id": booking_id}, include_archived)
     if not booking:
         raise HTTPException(status_code=404, detail="Booking not found")
-    if isinstance(booking['created_at'], str):
-        booking['created_at'] = datetime.fromisoformat(booking['created_at'])
-    return Booking(**booking)
+    return Booking.from_mongo(booking)
 
 @api_router.patch("/bookings/{booking_id}/assign")
 async def assign_driver(
@@ -292,49 +528,37 @@ async def assign_driver(
         raise HTTPException(status_code=404, detail="Driver not found")
     
     # Update booking
-    result = await db.bookings.update_one(
+    previous, booking = await transitions.transition(
+        db.bookings,
         {"id": booking_id},
-        {
-            "$set": {
-                "driver_id": driver_id,
-                "dealer_id": driver.get("dealer_id"),
-                "status": BookingStatus.ACCEPTED.value
-            }
-        }
+        BookingStatus.ACCEPTED,
+        transitions.BOOKING_TRANSITIONS,
+        changes={"driver_id": driver_id, "dealer_id": driver.get("dealer_id")},
+        not_found="Booking not found"
     )
-    
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Booking not found")
-    
-    booking = await db.bookings.find_one({"id": booking_id}, {"_id": 0})
-    if isinstance(booking['created_at'], str):
-        booking['created_at'] = datetime.fromisoformat(booking['created_at'])
-    return Booking(**booking)
+    await cache.document_cache.invalidate(cache.BOOKINGS, booking_id)
+    await counters.record_change(db, counters.booking_contributions, previous, booking)
+    events.publish_booking(events.BOOKING_UPDATED, booking)
+    return Booking.from_mongo(booking)
 
 @api_router.patch("/bookings/{booking_id}/accept")
 async def accept_booking(booking_id: str, current_user: dict = Depends(get_current_user)):
-    driver = await db.drivers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+    driver = await profiles.resolve_driver(db, current_user)
     if not driver:
         raise HTTPException(status_code=404, detail="Driver profile not found")
     
-    result = await db.bookings.update_one(
-        {"id": booking_id, "status": BookingStatus.PENDING.value},
-        {
-            "$set": {
-                "driver_id": driver["id"],
-                "dealer_id": driver.get("dealer_id"),
-                "status": BookingStatus.ACCEPTED.value
-            }
-        }
+    previous, booking = await transitions.transition(
+        db.bookings,
+        {"id": booking_id},
+        BookingStatus.ACCEPTED,
+        transitions.BOOKING_TRANSITIONS,
+        changes={"driver_id": driver["id"], "dealer_id": driver.get("dealer_id")},
+        not_found="Booking not found"
     )
-    
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Booking not found or already assigned")
-    
-    booking = await db.bookings.find_one({"id": booking_id}, {"_id": 0})
-    if isinstance(booking['created_at'], str):
-        booking['created_at'] = datetime.fromisoformat(booking['created_at'])
-    return Booking(**booking)
+    await cache.document_cache.invalidate(cache.BOOKINGS, booking_id)
+    await counters.record_change(db, counters.booking_contributions, previous, booking)
+    events.publish_booking(events.BOOKING_UPDATED, booking)
+    return Booking.from_mongo(booking)
 
 @api_router.patch("/bookings/{booking_id}/status")
 async def update_booking_status(
@@ -342,114 +566,188 @@ async def update_booking_status(
     status: BookingStatus,
     current_user: dict = Depends(get_current_user)
 ):
-    result = await db.bookings.update_one(
+    if status == BookingStatus.ACCEPTED:
+        # Acceptance also records the driver, so it has its own routes
+        raise HTTPException(status_code=400, detail="Use the accept or assign routes to accept a booking")
+    
+    previous, booking = await transitions.transition(
+        db.bookings,
         {"id": booking_id},
-        {"$set": {"status": status.value}}
+        status,
+        transitions.BOOKING_TRANSITIONS,
+        not_found="Booking not found"
     )
-    
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Booking not found")
-    
-    booking = await db.bookings.find_one({"id": booking_id}, {"_id": 0})
+    await cache.document_cache.invalidate(cache.BOOKINGS, booking_id)
+    await counters.record_change(db, counters.booking_contributions, previous, booking)
+    events.publish_booking(events.BOOKING_UPDATED, booking)
     
     # If completed, generate payout
     if status == BookingStatus.COMPLETED and booking["payment_status"] == PaymentStatus.COMPLETED.value:
         existing_payout = await db.payouts.find_one({"booking_id": booking_id}, {"_id": 0})
         if not existing_payout:
-            payout_data = generate_payout(booking["final_price"], booking.get("dealer_id"))
+            payout_data = pricing.generate_payout(
+                booking["final_price"], booking.get("dealer_id"), pricing.rate_table(booking.get("rate_version"))
+            )
             payout = Payout(
                 booking_id=booking_id,
                 driver_id=booking.get("driver_id"),
                 dealer_id=booking.get("dealer_id"),
+                city=booking.get("city"),
+                vehicle_type=booking.get("vehicle_type"),
                 **payout_data
             )
-            payout_doc = payout.model_dump()
-            payout_doc['created_at'] = payout_doc['created_at'].isoformat()
-            await db.payouts.insert_one(payout_doc)
+            payout_doc = payout.to_mongo()
+            try:
+                await db.payouts.insert_one(payout_doc)
+            except DuplicateKeyError:
+                # A concurrent completion already generated this payout
+                pass
+            else:
+                await counters.record_change(db, counters.payout_contributions, after=payout_doc)
+                await rollups.record_change(db, rollups.payout_rollup, after=payout_doc)
+                events.publish_payout(events.PAYOUT_CREATED, payout_doc)
     
-    if isinstance(booking['created_at'], str):
-        booking['created_at'] = datetime.fromisoformat(booking['created_at'])
-    return Booking(**booking)
+    return Booking.from_mongo(booking)
 
 # ============= PAYMENT ROUTES =============
 
 @api_router.post("/payments", response_model=Payment)
-async def create_payment(payment_data: PaymentCreate, current_user: dict = Depends(get_current_user)):
-    payment = Payment(user_id=current_user["user_id"], **payment_data.model_dump())
-    payment_doc = payment.model_dump()
-    payment_doc['created_at'] = payment_doc['created_at'].isoformat()
-    
-    await db.payments.insert_one(payment_doc)
+async def create_payment(
+    payment_data: PaymentCreate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: dict = Depends(get_current_user)
+):
+    user_id = current_user["user_id"]
+    if idempotency_key is not None:
+        replay = await idempotency.begin(db, user_id, idempotency_key, "POST /payments", payment_data.model_dump())
+        if replay is not None:
+            return replay
     
-    # Update booking payment status
-    await db.bookings.update_one(
-        {"id": payment.booking_id},
-        {"$set": {"payment_status": PaymentStatus.COMPLETED.value}}
+    payment_booking = await cache.document_cache.get(
+        cache.BOOKINGS, payment_data.booking_id,
+        lambda: db.bookings.find_one({"id": payment_data.booking_id}, {"_id": 0})
+    ) or {}
+    payment = Payment(
+        user_id=user_id,
+        city=payment_booking.get("city"),
+        vehicle_type=payment_booking.get("vehicle_type"),
+        **payment_data.model_dump()
     )
+    payment_doc = payment.to_mongo()
+    
+    try:
+        if payment.transaction_id and await archive.archived_transactions(db, [payment.transaction_id]):
+            raise HTTPException(status_code=409, detail="Payment with this transaction_id already recorded")
+        try:
+            await db.payments.insert_one(payment_doc)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="Payment with this transaction_id already recorded")
+        await counters.record_change(db, counters.payment_contributions, after=payment_doc)
+        await rollups.record_change(db, rollups.payment_rollup, after=payment_doc)
+        
+        # Update booking payment status
+        previous = await db.bookings.find_one_and_update(
+            {"id": payment.booking_id},
+            {"$set": {"payment_status": PaymentStatus.COMPLETED.value}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        await cache.document_cache.invalidate(cache.BOOKINGS, payment.booking_id)
+        if previous:
+            booking = {**previous, "payment_status": PaymentStatus.COMPLETED.value}
+            await rollups.record_change(db, rollups.booking_rollup, previous, booking)
+            events.publish_booking(events.BOOKING_UPDATED, booking)
+    except Exception:
+        if idempotency_key is not None:
+            await idempotency.release(db, user_id, idempotency_key)
+        raise
     
+    if idempotency_key is not None:
+        await idempotency.complete(db, user_id, idempotency_key, payment.model_dump())
     return payment
 
+@api_router.post("/payments/bulk", response_model=PaymentBulkResult)
+async def create_payments_bulk(
+    batch: PaymentBulkCreate,
+    current_user: dict = Depends(require_role([UserRole.ADMIN]))
+):
+    """Ingest gateway records; replays are deduplicated on ``transaction_id``."""
+    return await payment_ingest.ingest(db, batch)
+
 @api_router.get("/payments", response_model=List[Payment])
-async def get_payments(current_user: dict = Depends(get_current_user)):
+async def get_payments(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    include_archived: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
     query = {"user_id": current_user["user_id"]}
     
     if current_user["role"] == UserRole.ADMIN.value:
         query = {}
     
-    payments = await db.payments.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for payment in payments:
-        if isinstance(payment['created_at'], str):
-            payment['created_at'] = datetime.fromisoformat(payment['created_at'])
-    return payments
+    sources = archive.sources(list_db, "payments", include_archived)
+    if pagination.wants_ndjson(request):
+        return pagination.stream_ndjson(sources, query, Payment, cursor, limit)
+    
+    payments = await pagination.paginate(sources, query, Payment, response, cursor, limit)
+    return pagination.render(payments, Payment, response)
 
 # ============= PAYOUT ROUTES (ADMIN) =============
 
 @api_router.get("/payouts", response_model=List[Payout])
-async def get_payouts(current_user: dict = Depends(require_role([UserRole.ADMIN, UserRole.DEALER, UserRole.DRIVER]))):
+async def get_payouts(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    include_archived: bool = False,
+    current_user: dict = Depends(require_role([UserRole.ADMIN, UserRole.DEALER, UserRole.DRIVER]))
+):
     query = {}
     
     if current_user["role"] == UserRole.DEALER.value:
-        dealer = await db.dealers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+        dealer = await profiles.resolve_dealer(db, current_user)
         if dealer:
             query = {"dealer_id": dealer["id"]}
     elif current_user["role"] == UserRole.DRIVER.value:
-        driver = await db.drivers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+        driver = await profiles.resolve_driver(db, current_user)
         if driver:
             query = {"driver_id": driver["id"]}
     
-    payouts = await db.payouts.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for payout in payouts:
-        if isinstance(payout['created_at'], str):
-            payout['created_at'] = datetime.fromisoformat(payout['created_at'])
-    return payouts
+    sources = archive.sources(list_db, "payouts", include_archived)
+    if pagination.wants_ndjson(request):
+        return pagination.stream_ndjson(sources, query, Payout, cursor, limit)
+    
+    payouts = await pagination.paginate(sources, query, Payout, response, cursor, limit)
+    return pagination.render(payouts, Payout, response)
 
 @api_router.patch("/payouts/{payout_id}/process")
 async def process_payout(
     payout_id: str,
     current_user: dict = Depends(require_role([UserRole.ADMIN]))
 ):
-    result = await db.payouts.update_one(
+    previous, payout = await transitions.transition(
+        db.payouts,
         {"id": payout_id},
-        {
-            "$set": {
-                "status": PayoutStatus.PROCESSED.value,
-                "processed_at": datetime.now(timezone.utc).isoformat(),
-                "admin_id": current_user["user_id"]
-            }
-        }
+        PayoutStatus.PROCESSED,
+        transitions.PAYOUT_TRANSITIONS,
+        changes={"processed_at": datetime.now(timezone.utc), "admin_id": current_user["user_id"]},
+        not_found="Payout not found"
     )
-    
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Payout not found")
+    await counters.record_change(db, counters.payout_contributions, previous, payout)
+    await rollups.record_change(db, rollups.payout_rollup, previous, payout)
+    events.publish_payout(events.PAYOUT_UPDATED, payout)
     
     # Update driver/dealer payout totals
-    payout = await db.payouts.find_one({"id": payout_id}, {"_id": 0})
-    
     if payout.get("driver_id"):
         await db.drivers.update_one(
             {"id": payout["driver_id"]},
             {"$inc": {"total_payouts": payout["driver_amount"]}}
         )
+        await cache.document_cache.invalidate(cache.DRIVERS, payout["driver_id"])
     
     if payout.get("dealer_id"):
         await db.dealers.update_one(
@@ -459,80 +757,244 @@ async def process_payout(
     
     return {"message": "Payout processed successfully"}
 
+@api_router.post("/payouts/process-batch", response_model=PayoutBatchResult)
+async def process_payout_batch(
+    batch: PayoutBatchCreate,
+    current_user: dict = Depends(require_role([UserRole.ADMIN]))
+):
+    """Settle many payouts at once; resubmit the same ``batch_id`` to resume."""
+    return await payout_batches.process_batch(db, batch, current_user["user_id"])
+
 # ============= DEALER ROUTES =============
 
 @api_router.get("/dealers/drivers", response_model=List[Driver])
-async def get_dealer_drivers(current_user: dict = Depends(require_role([UserRole.DEALER]))):
-    dealer = await db.dealers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+async def get_dealer_drivers(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(require_role([UserRole.DEALER]))
+):
+    dealer = await profiles.resolve_dealer(db, current_user)
     if not dealer:
         raise HTTPException(status_code=404, detail="Dealer profile not found")
     
-    drivers = await db.drivers.find({"dealer_id": dealer["id"]}, {"_id": 0}).to_list(100)
-    for driver in drivers:
-        if isinstance(driver['created_at'], str):
-            driver['created_at'] = datetime.fromisoformat(driver['created_at'])
-    return drivers
+    query = {"dealer_id": dealer["id"]}
+    if pagination.wants_ndjson(request):
+        return pagination.stream_ndjson(list_db.drivers, query, Driver, cursor, limit)
+    
+    drivers = await pagination.paginate(list_db.drivers, query, Driver, response, cursor, limit)
+    return pagination.render(drivers, Driver, response)
 
 @api_router.get("/dealers/stats")
 async def get_dealer_stats(current_user: dict = Depends(require_role([UserRole.DEALER]))):
-    dealer = await db.dealers.find_one({"user_id": current_user["user_id"]}, {"_id": 0})
+    dealer = await profiles.resolve_dealer(db, current_user)
     if not dealer:
         raise HTTPException(status_code=404, detail="Dealer profile not found")
     
-    drivers = await db.drivers.find({"dealer_id": dealer["id"]}, {"_id": 0}).to_list(1000)
-    bookings = await db.bookings.find({"dealer_id": dealer["id"]}, {"_id": 0}).to_list(1000)
-    
-    active_bookings = len([b for b in bookings if b["status"] in [BookingStatus.ACCEPTED.value, BookingStatus.IN_PROGRESS.value]])
+    stats = await counters.get_counters(dashboard_db, counters.DEALER, dealer["id"])
     
     return DashboardStats(
-        total_bookings=len(bookings),
-        active_trips=active_bookings,
-        total_earnings=dealer["total_earnings"],
-        pending_payouts=dealer["total_earnings"] - dealer["total_payouts"]
+        total_bookings=stats.get("total_bookings", 0),
+        active_trips=stats.get("active_trips", 0),
+        total_earnings=stats.get("total_earnings", 0.0),
+        pending_payouts=stats.get("total_earnings", 0.0) - stats.get("total_paid_out", 0.0)
     )
 
 # ============= ADMIN ROUTES =============
 
 @api_router.get("/admin/stats")
-async def get_admin_stats(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
-    bookings = await db.bookings.find({}, {"_id": 0}).to_list(10000)
-    users = await db.users.find({}, {"_id": 0}).to_list(10000)
-    payouts = await db.payouts.find({}, {"_id": 0}).to_list(10000)
+async def get_admin_stats(
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    city: Optional[str] = None,
+    include_archived: Optional[bool] = None,
+    current_user: dict = Depends(require_role([UserRole.ADMIN]))
+):
+    # Lifetime totals, like the dashboard counters, include archived rows
+    # unless ``include_archived=false`` asks for the hot collections alone
+    if include_archived is None:
+        include_archived = archive.archive_queryable()
+    created_filter = created_at_range(date_from, date_to)
+    scoped_filter = {**created_filter, **({"city": city} if city else {})}
+    active_statuses = [BookingStatus.ACCEPTED.value, BookingStatus.IN_PROGRESS.value]
     
-    total_revenue = sum(b["final_price"] for b in bookings if b["payment_status"] == PaymentStatus.COMPLETED.value)
-    admin_earnings = sum(p["admin_commission"] for p in payouts)
-    pending_payouts = len([p for p in payouts if p["status"] == PayoutStatus.PENDING.value])
+    stats = {
+        "total_bookings": 0,
+        "total_revenue": 0.0,
+        "admin_earnings": 0.0,
+        "pending_payouts": 0,
+        "active_bookings": 0
+    }
+    # Archived rows are in a second collection with the same shape; sum both
+    for bookings in archive.sources(dashboard_db, "bookings", include_archived):
+        booking_totals = await bookings.aggregate([
+            {"$match": scoped_filter},
+            {"$facet": {
+                "counts": [
+                    {"$group": {
+                        "_id": None,
+                        "total_bookings": {"$sum": 1},
+                        "active_bookings": {"$sum": {"$cond": [{"$in": ["$status", active_statuses]}, 1, 0]}}
+                    }}
+                ],
+                "revenue": [
+                    {"$match": {"payment_status": PaymentStatus.COMPLETED.value}},
+                    {"$group": {"_id": None, "total_revenue": {"$sum": "$final_price"}}}
+                ]
+            }}
+        ]).to_list(1)
+        facets = booking_totals[0] if booking_totals else {}
+        counts = (facets.get("counts") or [{}])[0]
+        revenue = (facets.get("revenue") or [{}])[0]
+        stats["total_bookings"] += counts.get("total_bookings", 0)
+        stats["active_bookings"] += counts.get("active_bookings", 0)
+        stats["total_revenue"] += revenue.get("total_revenue", 0.0)
     
+    for payouts in archive.sources(dashboard_db, "payouts", include_archived):
+        payout_totals = await payouts.aggregate([
+            {"$match": scoped_filter},
+            {"$group": {
+                "_id": None,
+                "admin_earnings": {"$sum": "$admin_commission"},
+                "pending_payouts": {"$sum": {"$cond": [{"$eq": ["$status", PayoutStatus.PENDING.value]}, 1, 0]}}
+            }}
+        ]).to_list(1)
+        totals = payout_totals[0] if payout_totals else {}
+        stats["admin_earnings"] += totals.get("admin_earnings", 0.0)
+        stats["pending_payouts"] += totals.get("pending_payouts", 0)
+    
+    # Users carry no city, so only the date range applies to them
+    total_users = await dashboard_db.users.count_documents(created_filter)
+    
+    return {"total_users": total_users, **stats}
+
+@api_router.get("/admin/analytics")
+async def get_admin_analytics(
+    granularity: str = rollups.DAY,
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    group_by: Optional[str] = None,
+    current_user: dict = Depends(require_role([UserRole.ADMIN]))
+):
+    """Bookings, revenue and commissions per period from the hourly rollups."""
+    dimensions = [dimension.strip() for dimension in (group_by or "").split(",") if dimension.strip()]
+    return await rollups.query(dashboard_db, granularity, date_from, date_to, dimensions)
+
+@api_router.get("/admin/exports/{collection}")
+async def export_records(
+    collection: str,
+    fmt: str = Query(exports.CSV, alias="format"),
+    gzip: bool = False,
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    status: Optional[str] = None,
+    city: Optional[str] = None,
+    user_id: Optional[str] = None,
+    driver_id: Optional[str] = None,
+    dealer_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    include_archived: bool = False,
+    current_user: dict = Depends(require_role([UserRole.ADMIN]))
+):
+    """Stream a filtered export; resume a broken download with the last row's cursor."""
+    filters = {"status": status, "city": city, "user_id": user_id, "driver_id": driver_id, "dealer_id": dealer_id}
+    return exports.stream_export(
+        export_db, collection, fmt, created_at_range(date_from, date_to), filters,
+        cursor=cursor, limit=limit, include_archived=include_archived, gzip=gzip
+    )
+
+@api_router.get("/admin/indexes/explain")
+async def explain_indexes(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    report = await indexes.explain_report(db)
+    return {
+        "flagged": len([row for row in report if row["issues"]]),
+        "queries": report
+    }
+
+@api_router.get("/admin/auth/metrics")
+async def get_auth_metrics(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
     return {
-        "total_users": len(users),
-        "total_bookings": len(bookings),
-        "total_revenue": total_revenue,
-        "admin_earnings": admin_earnings,
-        "pending_payouts": pending_payouts,
-        "active_bookings": len([b for b in bookings if b["status"] in [BookingStatus.ACCEPTED.value, BookingStatus.IN_PROGRESS.value]])
+        "password_hashing": password_hasher.metrics(),
+        "token_cache": token_cache.metrics()
     }
 
+@api_router.get("/admin/ratelimit/metrics")
+async def get_ratelimit_metrics(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    return ratelimit.rate_limiter.metrics()
+
+@api_router.get("/admin/dispatch/metrics")
+async def get_dispatch_metrics(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    return dispatcher.metrics()
+
+@api_router.post("/admin/dispatch/run")
+async def run_dispatch_batch(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    return await dispatcher.run_once(db)
+
+@api_router.get("/admin/locations/metrics")
+async def get_location_metrics(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    return location_ingestor.metrics()
+
+@api_router.get("/admin/events/metrics")
+async def get_event_metrics(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    return events.hub.metrics()
+
+@api_router.get("/admin/database/settings")
+async def get_database_settings(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    return database.read_settings()
+
+@api_router.get("/admin/archive/metrics")
+async def get_archive_metrics(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    return {**archive.archiver.metrics(), "eligible": await archive.archiver.pending_counts(db)}
+
+@api_router.get("/admin/cache/metrics")
+async def get_cache_metrics(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    return cache.document_cache.metrics()
+
+@api_router.get("/metrics", include_in_schema=False)
+async def get_metrics(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """Prometheus text exposition; scrapers send ``METRICS_TOKEN``, admins their JWT."""
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if not metrics.is_scrape_token(credentials.credentials):
+        current_user = await authenticate(db, credentials.credentials)
+        if current_user["role"] != UserRole.ADMIN.value:
+            raise HTTPException(status_code=403, detail="Insufficient permissions")
+    return PlainTextResponse(metrics.render(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+@api_router.post("/admin/users/{user_id}/revoke-tokens")
+async def revoke_user_tokens(user_id: str, current_user: dict = Depends(require_role([UserRole.ADMIN]))):
+    await revoke_user(db, user_id)
+    return {"message": "Tokens revoked"}
+
 @api_router.get("/admin/users", response_model=List[UserResponse])
-async def get_all_users(current_user: dict = Depends(require_role([UserRole.ADMIN]))):
-    users = await db.users.find({}, {"_id": 0}).to_list(1000)
-    return [UserResponse(**u) for u in users]
+async def get_all_users(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(require_role([UserRole.ADMIN]))
+):
+    if pagination.wants_ndjson(request):
+        return pagination.stream_ndjson(list_db.users, {}, UserResponse, cursor, limit)
+    
+    users = await pagination.paginate(list_db.users, {}, UserResponse, response, cursor, limit or MAX_PAGE_SIZE)
+    return pagination.render(users, UserResponse, response)
 
 # ============= CUSTOMER DASHBOARD =============
 
 @api_router.get("/customer/stats")
 async def get_customer_stats(current_user: dict = Depends(get_current_user)):
-    trips = await db.trips.find({"user_id": current_user["user_id"]}, {"_id": 0}).to_list(1000)
-    bookings = await db.bookings.find({"user_id": current_user["user_id"]}, {"_id": 0}).to_list(1000)
-    payments = await db.payments.find({"user_id": current_user["user_id"]}, {"_id": 0}).to_list(1000)
-    
-    active_trips = len([t for t in trips if t["status"] == TripStatus.ACTIVE.value])
-    total_spent = sum(p["amount"] for p in payments if p["status"] == PaymentStatus.COMPLETED.value)
+    stats = await counters.get_counters(dashboard_db, counters.CUSTOMER, current_user["user_id"])
     
     return DashboardStats(
-        total_bookings=len(bookings),
-        active_trips=active_trips,
+        total_bookings=stats.get("total_bookings", 0),
+        active_trips=stats.get("active_trips", 0),
         total_earnings=0.0,
-        pending_payouts=total_spent
+        pending_payouts=stats.get("total_spent", 0.0)
     )
 
 # Health check
@@ -543,6 +1005,13 @@ async def root():
 # Include the router in the main app
 app.include_router(api_router)
 
+# Added first so the metrics middleware also sees refused requests
+if ratelimit.RATE_LIMIT_ENABLED:
+    app.add_middleware(ratelimit.RateLimitMiddleware)
+
+if metrics.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -550,6 +1019,7 @@ app.add_middleware(
     # allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[pagination.NEXT_CURSOR_HEADER],
 )
 
 # Configure logging
@@ -559,6 +1029,34 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def ensure_db_indexes():
+    await indexes.ensure_indexes(db)
+
+@app.on_event("startup")
+async def start_location_ingestor():
+    location_ingestor.start(db)
+
+@app.on_event("startup")
+async def start_dispatcher():
+    if DISPATCH_ENABLED:
+        dispatcher.start(db)
+
+@app.on_event("startup")
+async def start_change_stream_relay():
+    if events.EVENTS_CHANGE_STREAMS:
+        events.change_stream_relay.start(db)
+
+@app.on_event("startup")
+async def start_archiver():
+    if archive.ARCHIVE_ENABLED:
+        archive.archiver.start(db)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await archive.archiver.stop()
+    await events.change_stream_relay.stop()
+    await dispatcher.stop()
+    await location_ingestor.stop(db)
     client.close()
+    password_hasher.shutdown()
@@ -0,0 +1,17 @@
+"""Parsing helpers for settings read from the environment."""
+import os
+
+TRUE_VALUES = frozenset({"1", "true", "yes", "on"})
+FALSE_VALUES = frozenset({"0", "false", "no", "off"})
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    """``name`` as a flag; unset or empty means ``default``, anything unrecognised is an error."""
+    value = os.environ.get(name, "").strip().lower()
+    if not value:
+        return default
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f"{name} must be one of {', '.join(sorted(TRUE_VALUES | FALSE_VALUES))}, not {value!r}")
@@ -1,2 +1,5 @@
+# Deployments export metrics; set METRICS_ENABLED=false to opt out
+export METRICS_ENABLED="${METRICS_ENABLED:-true}"
+
 echo "Starting uvicorn on port ${PORT} (reload enabled)..."
 exec uvicorn server:app --host 0.0.0.0 --port "${PORT}" 
@@ -0,0 +1,79 @@
+"""Status state machines and atomic, single round-trip transitions.
+
+Each collection with a ``status`` field has a table of legal moves.  A
+transition is one ``find_one_and_update`` whose filter only matches the
+document while it is in a legal source state, so two racing writers cannot
+both win and an illegal move never reaches the database.  It returns the
+document as it was before the update; the after image is that plus the
+fields the update set, so nothing beyond the new values is written.
+"""
+from enum import Enum
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+from models import BookingStatus, TripStatus, PayoutStatus
+
+Transitions = Dict[Enum, FrozenSet[Enum]]
+
+BOOKING_TRANSITIONS: Transitions = {
+    BookingStatus.PENDING: frozenset({BookingStatus.ACCEPTED, BookingStatus.CANCELLED}),
+    BookingStatus.ACCEPTED: frozenset({BookingStatus.IN_PROGRESS, BookingStatus.CANCELLED}),
+    BookingStatus.IN_PROGRESS: frozenset({BookingStatus.COMPLETED}),
+    BookingStatus.COMPLETED: frozenset(),
+    BookingStatus.CANCELLED: frozenset(),
+}
+
+TRIP_TRANSITIONS: Transitions = {
+    TripStatus.ACTIVE: frozenset({TripStatus.COMPLETED, TripStatus.CANCELLED}),
+    TripStatus.COMPLETED: frozenset(),
+    TripStatus.CANCELLED: frozenset(),
+}
+
+PAYOUT_TRANSITIONS: Transitions = {
+    PayoutStatus.PENDING: frozenset({PayoutStatus.PROCESSED, PayoutStatus.FAILED}),
+    PayoutStatus.PROCESSED: frozenset(),
+    PayoutStatus.FAILED: frozenset(),
+}
+
+
+def sources_for(transitions: Transitions, target: Enum) -> List[str]:
+    """Statuses from which ``target`` may be reached."""
+    return sorted(source.value for source, targets in transitions.items() if target in targets)
+
+
+async def transition(
+    collection,
+    query: dict,
+    target: Enum,
+    transitions: Transitions,
+    changes: Optional[dict] = None,
+    not_found: str = "Not found"
+) -> Tuple[dict, dict]:
+    """Move the document matching ``query`` to ``target`` in one round trip.
+
+    ``changes`` are extra fields written with the status.
+
+    Returns ``(previous, current)``.  Raises 404 when nothing matches
+    ``query`` and 409 when the document's current status does not allow the
+    move.
+    """
+    changes = changes or {}
+    previous = await collection.find_one_and_update(
+        {**query, "status": {"$in": sources_for(transitions, target)}},
+        {"$set": {"status": target.value, **changes}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if previous is None:
+        existing = await collection.find_one(query, {"_id": 0, "status": 1})
+        if not existing:
+            raise HTTPException(status_code=404, detail=not_found)
+        raise HTTPException(
+            status_code=409,
+            detail=f"Cannot change status from {existing['status']} to {target.value}"
+        )
+
+    current = {**previous, "status": target.value, **changes}
+    return previous, current
@@ -0,0 +1,161 @@
+"""Compare batched dispatch against first-come assignment.
+
+Simulates a city where bookings arrive in dispatch windows and drivers go
+busy for a few windows after each pickup.  Every strategy sees the same
+arrivals and fleet:
+
+* ``first-come-random`` – any free driver takes the booking, like today's
+  "first driver to call accept" behaviour.
+* ``first-come-nearest`` – bookings in arrival order each grab the nearest
+  free driver.
+* ``batched`` – ``dispatch.solve_assignment`` over the whole window.
+
+Reports assignment quality (pickup distance, expired bookings) and solver
+throughput.  Runs fully in memory.
+
+Usage::
+
+    python benchmarks/bench_dispatch.py --bookings 10000 --drivers 2000
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from dispatch import build_cost_matrix, solve_assignment  # noqa: E402
+
+CENTER_LAT, CENTER_LNG = 12.9716, 77.5946
+SPREAD_DEG = 0.15
+VEHICLE_TYPES = ["SEDAN", "SUV", "HATCHBACK", "LUXURY"]
+
+
+def point(rng):
+    return {
+        "type": "Point",
+        "coordinates": [
+            CENTER_LNG + rng.uniform(-SPREAD_DEG, SPREAD_DEG),
+            CENTER_LAT + rng.uniform(-SPREAD_DEG, SPREAD_DEG),
+        ],
+    }
+
+
+def make_workload(args):
+    rng = np.random.default_rng(args.seed)
+    dealers = [f"dealer-{i}" for i in range(args.dealers)]
+    drivers = [{
+        "id": f"driver-{i}",
+        "vehicle_type": VEHICLE_TYPES[rng.integers(len(VEHICLE_TYPES))],
+        "dealer_id": dealers[rng.integers(len(dealers))],
+        "location": point(rng),
+    } for i in range(args.drivers)]
+    bookings = [{
+        "id": f"booking-{i}",
+        "arrival_window": i // args.arrivals_per_window,
+        "pickup_point": point(rng),
+        # Most riders take any car; some ask for a specific type or dealer
+        "vehicle_type": VEHICLE_TYPES[rng.integers(len(VEHICLE_TYPES))] if rng.random() < 0.3 else None,
+        "preferred_dealer_id": dealers[rng.integers(len(dealers))] if rng.random() < 0.2 else None,
+    } for i in range(args.bookings)]
+    return bookings, drivers
+
+
+def first_come(rng, nearest):
+    def assign(pending, free):
+        pairs = []
+        taken = np.zeros(len(free), dtype=bool)
+        for row in range(len(pending)):
+            cost = build_cost_matrix([pending[row]], free)[0]
+            cost[taken] = np.inf
+            feasible = np.flatnonzero(np.isfinite(cost))
+            if not len(feasible):
+                continue
+            col = feasible[np.argmin(cost[feasible])] if nearest else rng.choice(feasible)
+            taken[col] = True
+            pairs.append((row, int(col)))
+        return pairs
+    return assign
+
+
+def batched(pending, free):
+    return solve_assignment(build_cost_matrix(pending, free))
+
+
+def simulate(strategy, bookings, drivers, args):
+    rng = np.random.default_rng(args.seed + 1)
+    busy_until = {d["id"]: -1 for d in drivers}
+    fleet = {d["id"]: dict(d) for d in drivers}
+    pending, pickups, expired = [], [], 0
+    windows = bookings[-1]["arrival_window"] + args.max_wait_windows + 1
+    next_booking = 0
+    solve_seconds = 0.0
+    decided = 0
+
+    for window in range(windows):
+        while next_booking < len(bookings) and bookings[next_booking]["arrival_window"] == window:
+            pending.append(bookings[next_booking])
+            next_booking += 1
+        free = [fleet[d] for d, until in busy_until.items() if until < window]
+        if pending and free:
+            started = time.perf_counter()
+            pairs = strategy(pending, free)
+            solve_seconds += time.perf_counter() - started
+            decided += len(pending)
+            cost = build_cost_matrix(pending, free, affinity_km=0.0)
+            assigned_rows = set()
+            for row, col in pairs:
+                pickups.append(cost[row, col])
+                driver = free[col]
+                busy_until[driver["id"]] = window + args.trip_windows
+                driver["location"] = point(rng)
+                assigned_rows.add(row)
+            pending = [b for i, b in enumerate(pending) if i not in assigned_rows]
+        still_waiting = [b for b in pending if window - b["arrival_window"] < args.max_wait_windows]
+        expired += len(pending) - len(still_waiting)
+        pending = still_waiting
+
+    pickups = np.array(pickups)
+    return {
+        "assigned": int(len(pickups)),
+        "expired": int(expired + len(pending)),
+        "mean_pickup_km": round(float(pickups.mean()), 3) if len(pickups) else None,
+        "p95_pickup_km": round(float(np.percentile(pickups, 95)), 3) if len(pickups) else None,
+        "solve_seconds": round(solve_seconds, 3),
+        "bookings_per_second": round(decided / solve_seconds) if solve_seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bookings", type=int, default=10000)
+    parser.add_argument("--drivers", type=int, default=2000)
+    parser.add_argument("--dealers", type=int, default=20)
+    parser.add_argument("--arrivals-per-window", type=int, default=200, help="bookings arriving per 2s window")
+    parser.add_argument("--trip-windows", type=int, default=5)
+    parser.add_argument("--max-wait-windows", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    bookings, drivers = make_workload(args)
+    results = {}
+    for name, strategy in (
+        ("first-come-random", first_come(np.random.default_rng(args.seed + 2), nearest=False)),
+        ("first-come-nearest", first_come(None, nearest=True)),
+        ("batched", batched),
+    ):
+        results[name] = simulate(strategy, bookings, drivers, args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, result in results.items():
+        print(f"{name:<20} " + " ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Benchmark nearest-available-driver search.
+
+Seeds a throwaway database with online drivers scattered around a city,
+applies the index registry and times the same ``$geoNear`` pipeline that
+``GET /api/drivers/available?lat=&lng=`` runs.  ``--hot-store`` times the
+in-process grid from ``locations.py`` instead and needs no database.
+
+Usage::
+
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/bench_nearest_drivers.py --drivers 20000
+    python benchmarks/bench_nearest_drivers.py --hot-store --drivers 20000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+
+import indexes  # noqa: E402
+from locations import HotLocationStore  # noqa: E402
+from models import VehicleType  # noqa: E402
+
+# Roughly central Bengaluru; drivers are spread over a ~30 km square
+CENTER_LAT, CENTER_LNG = 12.9716, 77.5946
+SPREAD_DEG = 0.15
+
+
+def random_point():
+    return (
+        CENTER_LNG + random.uniform(-SPREAD_DEG, SPREAD_DEG),
+        CENTER_LAT + random.uniform(-SPREAD_DEG, SPREAD_DEG),
+    )
+
+
+async def seed(db, count: int, batch_size: int = 5000) -> None:
+    await db.drivers.drop()
+    await indexes.ensure_indexes(db)
+    now = datetime.utcnow()
+    vehicle_types = [v.value for v in VehicleType]
+    for start in range(0, count, batch_size):
+        docs = []
+        for _ in range(min(batch_size, count - start)):
+            lng, lat = random_point()
+            docs.append({
+                "id": str(uuid.uuid4()),
+                "user_id": str(uuid.uuid4()),
+                "license_number": "BENCH",
+                "license_expiry": "2030-01-01",
+                "vehicle_number": "BENCH",
+                "vehicle_type": random.choice(vehicle_types),
+                "is_active": random.random() < 0.9,
+                "location": {"type": "Point", "coordinates": [lng, lat]},
+                "location_updated_at": now,
+                "created_at": now,
+            })
+        await db.drivers.insert_many(docs, ordered=False)
+
+
+async def nearest(db, lat: float, lng: float, radius: float, k: int, vehicle_type=None):
+    query = {"is_active": True}
+    if vehicle_type:
+        query["vehicle_type"] = vehicle_type
+    return await db.drivers.aggregate([
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [lng, lat]},
+            "distanceField": "distance_m",
+            "maxDistance": radius,
+            "query": query,
+            "spherical": True,
+        }},
+        {"$limit": k},
+        {"$project": {"_id": 0}},
+    ]).to_list(k)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report(label: str, latencies, found: int, args) -> None:
+    print(
+        f"{label:<22} queries={args.queries} k={args.k} radius={args.radius:.0f}m "
+        f"avg_found={found / args.queries:.1f} "
+        f"p50={percentile(latencies, 50):.3f}ms p95={percentile(latencies, 95):.3f}ms "
+        f"p99={percentile(latencies, 99):.3f}ms mean={statistics.mean(latencies):.3f}ms"
+    )
+
+
+def bench_hot_store(args) -> None:
+    store = HotLocationStore(cell_degrees=0.01, max_age=300)
+    now = time.time()
+    vehicle_types = [v.value for v in VehicleType]
+    for _ in range(args.drivers):
+        lng, lat = random_point()
+        store.update(str(uuid.uuid4()), lng, lat, now, random.choice(vehicle_types))
+
+    for vehicle_type in (None, VehicleType.SEDAN.value):
+        latencies = []
+        found = 0
+        for _ in range(args.queries):
+            lng, lat = random_point()
+            started = time.perf_counter()
+            found += len(store.nearest(lat, lng, args.radius, args.k, vehicle_type, now=now))
+            latencies.append((time.perf_counter() - started) * 1000)
+        report(f"hot-store type={vehicle_type or 'any'}", latencies, found, args)
+
+
+async def main(args) -> None:
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    db = client[args.db]
+    if not args.skip_seed:
+        started = time.perf_counter()
+        await seed(db, args.drivers)
+        print(f"seeded {args.drivers} drivers in {time.perf_counter() - started:.1f}s")
+
+    for vehicle_type in (None, VehicleType.SEDAN.value):
+        latencies = []
+        found = 0
+        for _ in range(args.queries):
+            lng, lat = random_point()
+            started = time.perf_counter()
+            result = await nearest(db, lat, lng, args.radius, args.k, vehicle_type)
+            latencies.append((time.perf_counter() - started) * 1000)
+            found += len(result)
+        report(f"geoNear type={vehicle_type or 'any'}", latencies, found, args)
+    client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drivers", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--radius", type=float, default=5000.0)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--db", default="taxibook_bench")
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--hot-store", action="store_true", help="benchmark the in-process grid instead")
+    args = parser.parse_args()
+    if args.hot_store:
+        bench_hot_store(args)
+    else:
+        asyncio.run(main(args))
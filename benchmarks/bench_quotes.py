@@ -0,0 +1,127 @@
+"""Measure batch quote throughput against the per-booking scalar path.
+
+Prices the same random rows three ways:
+
+* ``scalar`` – ``calculate_booking_price`` + ``generate_payout`` per row,
+  the way a client looping over the single-booking flow would.
+* ``vectorized`` – ``pricing.quote_batch`` over whole columns.
+* ``endpoint`` – ``POST /api/quotes/batch`` in-process, including request
+  validation and response serialization (needs the backend dependencies
+  and ``--endpoint``).
+
+Usage::
+
+    python benchmarks/bench_quotes.py --rows 10000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import pricing  # noqa: E402
+
+VEHICLE_TYPES = [None, "SEDAN", "SUV", "HATCHBACK", "LUXURY"]
+ZONES = [None, "Bengaluru", "Mumbai", "Pune", "Delhi"]
+
+
+def make_rows(count, seed):
+    rng = np.random.default_rng(seed)
+    return [{
+        "estimated_km": float(rng.uniform(1, 400)),
+        "total_days": int(rng.integers(1, 8)),
+        "vehicle_type": VEHICLE_TYPES[rng.integers(len(VEHICLE_TYPES))],
+        "zone": ZONES[rng.integers(len(ZONES))],
+        "with_dealer": bool(rng.integers(2)),
+    } for _ in range(count)]
+
+
+def run_scalar(rows, table):
+    for row in rows:
+        fare = pricing.calculate_booking_price(
+            row["estimated_km"], row["total_days"], row["vehicle_type"], row["zone"], table
+        )
+        pricing.generate_payout(fare, "dealer" if row["with_dealer"] else None, table)
+
+
+def run_vectorized(rows, table):
+    pricing.quote_batch(
+        [row["estimated_km"] for row in rows],
+        [row["total_days"] for row in rows],
+        [row["vehicle_type"] for row in rows],
+        [row["zone"] for row in rows],
+        [row["with_dealer"] for row in rows],
+        table,
+    )
+
+
+async def run_endpoint(rows, repeat):
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "bench")
+    import httpx
+    import server
+    from auth import create_access_token
+
+    token = create_access_token("bench-user", "bench@example.com", "CUSTOMER")
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = await client.post(
+                "/api/quotes/batch",
+                json={"rows": rows},
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            timings.append(time.perf_counter() - started)
+            response.raise_for_status()
+    return min(timings)
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--endpoint", action="store_true", help="also time the HTTP route in-process")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows, args.seed)
+    table = pricing.rate_table()
+    results = {
+        "rows": args.rows,
+        "rate_version": table.version,
+        "scalar_seconds": best_of(lambda: run_scalar(rows, table), args.repeat),
+        "vectorized_seconds": best_of(lambda: run_vectorized(rows, table), args.repeat),
+    }
+    if args.endpoint:
+        results["endpoint_seconds"] = asyncio.run(run_endpoint(rows, args.repeat))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.rows} rows, rate table {table.version}")
+    for name in ("scalar", "vectorized", "endpoint"):
+        seconds = results.get(f"{name}_seconds")
+        if seconds is not None:
+            print(f"  {name:<11} {seconds * 1000:9.2f} ms total  {seconds / args.rows * 1e6:8.2f} us/row")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Compare default and fast JSON serialization for list pages.
+
+Builds pages of stored-shape documents for each list model and times:
+
+* ``default`` – what FastAPI does with ``response_model=List[Model]``:
+  validate every dict, dump it in JSON mode, then ``json.dumps``.
+* ``fast`` – ``pagination.render`` with ``FAST_JSON_RESPONSES`` on: fill
+  defaults and encode the trusted documents with orjson.
+
+``--route`` additionally times both paths end to end through a throwaway
+FastAPI app served in-process, which includes routing and response
+construction but no database.
+
+Usage::
+
+    python benchmarks/bench_serialization.py --rows 100
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from fastapi import FastAPI, Response  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import pagination  # noqa: E402
+from models import Booking, Driver, GeoPoint, Payment, PaymentMethod, Payout, Trip  # noqa: E402
+
+
+def stored(model_instance, model):
+    # The shape Motor hands back: projected fields, enums as plain strings
+    doc = model_instance.model_dump(include=set(pagination.projection_for(model)) - {"_id"})
+    return {name: getattr(value, "value", value) for name, value in doc.items()}
+
+
+def make_docs(rows):
+    return {
+        "Booking": (Booking, [stored(Booking(
+            trip_id=f"trip-{i}", user_id="user", pickup_location="A", dropoff_location="B",
+            booking_date="2024-01-01", city="Pune", final_price=300.0 + i,
+            pickup_point=GeoPoint(coordinates=[77.59, 12.97])
+        ), Booking) for i in range(rows)]),
+        "Trip": (Trip, [stored(Trip(
+            user_id="user", city="Pune", base_location="A", start_date="x", end_date="y"
+        ), Trip) for _ in range(rows)]),
+        "Payment": (Payment, [stored(Payment(
+            booking_id=f"booking-{i}", user_id="user", amount=300.0, method=PaymentMethod.CARD
+        ), Payment) for i in range(rows)]),
+        "Payout": (Payout, [stored(Payout(
+            booking_id=f"booking-{i}", booking_price=300.0, admin_commission=30.0, driver_amount=270.0
+        ), Payout) for i in range(rows)]),
+        "Driver": (Driver, [stored(Driver(
+            user_id="user", license_number="L", license_expiry="2030", vehicle_number="V",
+            vehicle_type="SEDAN", location=GeoPoint(coordinates=[77.59, 12.97])
+        ), Driver) for _ in range(rows)]),
+    }
+
+
+def default_encode(adapter, docs):
+    return json.dumps(adapter.dump_python(adapter.validate_python(docs), mode="json")).encode()
+
+
+def fast_encode(model, docs):
+    return pagination.render(docs, model, Response()).body
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+async def time_routes(model, docs, repeat):
+    import httpx
+
+    app = FastAPI()
+
+    @app.get("/default", response_model=List[model])
+    async def default_route():
+        return docs
+
+    @app.get("/fast", response_model=List[model])
+    async def fast_route(response: Response):
+        return pagination.render(docs, model, response)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        results = {}
+        for path in ("/default", "/fast"):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                (await client.get(path)).raise_for_status()
+                timings.append(time.perf_counter() - started)
+            results[path.strip("/")] = min(timings)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--route", action="store_true", help="also time a full request in-process")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    pagination.FAST_JSON_RESPONSES = True
+    results = {}
+    for name, (model, docs) in make_docs(args.rows).items():
+        adapter = TypeAdapter(List[model])
+        # Both paths must produce the same payload
+        assert json.loads(default_encode(adapter, docs)) == json.loads(fast_encode(model, docs)), name
+        result = {
+            "default_seconds": best_of(lambda: default_encode(adapter, docs), args.repeat),
+            "fast_seconds": best_of(lambda: fast_encode(model, docs), args.repeat),
+        }
+        if args.route:
+            routes = asyncio.run(time_routes(model, docs, args.repeat))
+            result["route_default_seconds"] = routes["default"]
+            result["route_fast_seconds"] = routes["fast"]
+        results[name] = result
+
+    if args.json:
+        print(json.dumps({"rows": args.rows, "models": results}, indent=2))
+        return
+    print(f"{args.rows}-row pages, best of {args.repeat}")
+    for name, result in results.items():
+        line = (
+            f"  {name:<8} encode: default {result['default_seconds'] * 1e6:8.1f} us"
+            f"  fast {result['fast_seconds'] * 1e6:8.1f} us"
+            f"  ({result['default_seconds'] / result['fast_seconds']:.1f}x)"
+        )
+        if args.route:
+            line += (
+                f"   route: default {result['route_default_seconds'] * 1e6:8.1f} us"
+                f"  fast {result['route_fast_seconds'] * 1e6:8.1f} us"
+            )
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+"""Seeded load test of the real FastAPI app.
+
+Seeds a database with customers, dealers, drivers, trips, bookings and
+payouts, then runs concurrent async clients through the booking lifecycle
+against ``server.app`` in-process:
+
+    register -> login -> create trip -> book -> accept -> start -> pay
+    -> complete -> find payout -> process payout
+
+plus the dashboard reads each actor makes along the way.  Latency is
+recorded per route and reported as p50/p95/p99 and requests per second;
+``--output`` writes the same numbers as JSON and ``--compare`` diffs a run
+against an earlier file, so two commits can be compared on one machine.
+
+The database is a throwaway one on ``--mongo-url``, dropped afterwards
+unless ``--keep``.  Without ``--mongo-url`` an in-process stand-in
+(``mongomock_motor``, install separately) is used; it is synchronous and
+unindexed, so treat its numbers as application CPU cost rather than
+database latency.
+
+``--secondary-reads dashboard`` (or ``all``, adding the list routes) routes
+those reads to secondaries with ``--max-staleness``; run it against the
+replica set from ``benchmarks/replica_set.sh`` and ``--compare`` with a
+primary-only run.  With ``all`` a lagging secondary can hide a payout the
+flow just created, which shows up as a failed flow.
+
+Usage::
+
+    python benchmarks/load_test.py --flows 200 --concurrency 20
+    python benchmarks/load_test.py --mongo-url mongodb://localhost:27017 --output after.json --compare before.json
+    python benchmarks/load_test.py --mongo-url "mongodb://localhost:27017/?replicaSet=rs0" \
+        --secondary-reads dashboard --compare primary.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+BACKEND = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND))
+
+PASSWORD = "load-test-password"
+CITIES = ["Bengaluru", "Mumbai", "Pune", "Delhi", "Chennai"]
+VEHICLE_TYPES = ["SEDAN", "SUV", "HATCHBACK", "LUXURY"]
+SEED_BATCH_SIZE = 1000
+
+
+def configure_environment(args):
+    """Point the backend at the target database before it is imported."""
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = args.db_name
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    # Background workers would compete with the measured requests
+    os.environ["DISPATCH_ENABLED"] = "false"
+    # Per-user limits and admission control only: every simulated client
+    # shares one address, so per-IP buckets would throttle the run itself
+    if args.rate_limits:
+        os.environ["RATE_LIMIT_ENABLED"] = "true"
+        os.environ.pop("RATE_LIMIT_CLIENT_ADDRESS", None)
+        # One admin account checks the dashboard after every flow
+        os.environ["RATE_LIMIT_ANALYTICS_USER_RATE"] = "0"
+    route_classes = {"dashboard": ["DASHBOARD"], "all": ["DASHBOARD", "LIST"]}.get(args.secondary_reads, [])
+    for route_class in route_classes:
+        os.environ[f"MONGO_{route_class}_READ_PREFERENCE"] = "secondaryPreferred"
+        os.environ[f"MONGO_{route_class}_MAX_STALENESS_SECONDS"] = str(args.max_staleness)
+
+
+def use_stand_in():
+    """Swap every backend module's database handles for an in-process mongomock one."""
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("No --mongo-url given and mongomock_motor is not installed")
+
+    db = AsyncMongoMockClient()[os.environ["DB_NAME"]]
+    for module in list(sys.modules.values()):
+        if str(getattr(module, "__file__", "")).startswith(str(BACKEND)):
+            for name in ("db", "dashboard_db", "list_db", "export_db"):
+                if hasattr(module, name):
+                    setattr(module, name, db)
+    return db
+
+
+async def insert_chunked(collection, docs):
+    for start in range(0, len(docs), SEED_BATCH_SIZE):
+        await collection.insert_many(docs[start:start + SEED_BATCH_SIZE], ordered=False)
+
+
+async def seed(db, args, rng):
+    """Bulk-insert the starting data set; returns tokens for the seeded actors."""
+    import counters
+    from auth import create_access_token, pwd_context
+    from models import (
+        Booking, BookingStatus, Dealer, Driver, GeoPoint, PaymentStatus, Payout,
+        Trip, User, UserRole
+    )
+    import pricing
+
+    password_hash = pwd_context.hash(PASSWORD)
+
+    def user(role, index):
+        return User(
+            name=f"{role.value.lower()}-{index}",
+            email=f"{role.value.lower()}-{index}@load.test",
+            password_hash=password_hash,
+            role=role,
+        )
+
+    admin = user(UserRole.ADMIN, 0)
+    customers = [user(UserRole.CUSTOMER, i) for i in range(args.users)]
+    dealer_users = [user(UserRole.DEALER, i) for i in range(args.dealers)]
+    driver_users = [user(UserRole.DRIVER, i) for i in range(args.drivers)]
+    dealers = [Dealer(user_id=u.id, company_name=f"{u.name} fleet") for u in dealer_users]
+    drivers = [Driver(
+        user_id=u.id,
+        dealer_id=dealers[i % len(dealers)].id if dealers else None,
+        license_number=f"L-{i}",
+        license_expiry="2030-01-01",
+        vehicle_number=f"V-{i}",
+        vehicle_type=VEHICLE_TYPES[i % len(VEHICLE_TYPES)],
+        location=GeoPoint(coordinates=[77.59 + rng.uniform(-0.1, 0.1), 12.97 + rng.uniform(-0.1, 0.1)]),
+        location_updated_at=datetime.now(timezone.utc),
+    ) for i, u in enumerate(driver_users)]
+
+    trips = [Trip(
+        user_id=customer.id,
+        city=CITIES[i % len(CITIES)],
+        base_location="Seed",
+        start_date="2024-01-01",
+        end_date="2024-01-02",
+    ) for i, customer in enumerate(customers)]
+
+    bookings, payouts = [], []
+    for i in range(args.bookings if trips else 0):
+        trip = trips[rng.randrange(len(trips))]
+        driver = drivers[rng.randrange(len(drivers))] if drivers else None
+        km, days = rng.uniform(1, 300), rng.randint(1, 5)
+        completed = i < args.payouts and driver is not None
+        status = BookingStatus.COMPLETED if completed else rng.choice(list(BookingStatus))
+        assigned = driver is not None and status != BookingStatus.PENDING
+        booking = Booking(
+            trip_id=trip.id,
+            user_id=trip.user_id,
+            driver_id=driver.id if assigned else None,
+            dealer_id=driver.dealer_id if assigned else None,
+            estimated_km=km,
+            total_days=days,
+            final_price=pricing.calculate_booking_price(km, days, zone=trip.city),
+            pickup_location="Seed",
+            dropoff_location="Seed",
+            booking_date="2024-01-01",
+            city=trip.city,
+            status=status,
+            payment_status=PaymentStatus.COMPLETED if completed else PaymentStatus.PENDING,
+        )
+        bookings.append(booking)
+        if completed:
+            payouts.append(Payout(
+                booking_id=booking.id,
+                driver_id=booking.driver_id,
+                dealer_id=booking.dealer_id,
+                city=booking.city,
+                **pricing.generate_payout(booking.final_price, booking.dealer_id),
+            ))
+
+    for collection, models in (
+        ("users", [admin, *customers, *dealer_users, *driver_users]),
+        ("dealers", dealers),
+        ("drivers", drivers),
+        ("trips", trips),
+        ("bookings", bookings),
+        ("payouts", payouts),
+    ):
+        await insert_chunked(db[collection], [model.to_mongo() for model in models])
+    await counters.rebuild_counters(db)
+
+    return {
+        "admin": create_access_token(admin.id, admin.email, admin.role.value),
+        "drivers": [
+            create_access_token(u.id, u.email, u.role.value, driver_id=d.id, dealer_id=d.dealer_id)
+            for u, d in zip(driver_users, drivers)
+        ],
+        "seeded": {
+            "users": 1 + len(customers) + len(dealer_users) + len(driver_users),
+            "dealers": len(dealers),
+            "drivers": len(drivers),
+            "trips": len(trips),
+            "bookings": len(bookings),
+            "payouts": len(payouts),
+        },
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def call(self, client, route, method, url, token=None, expect=200, **kwargs):
+        headers = kwargs.pop("headers", {})
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        started = time.perf_counter()
+        response = await client.request(method, url, headers=headers, **kwargs)
+        self.latencies[route].append(time.perf_counter() - started)
+        if response.status_code != expect:
+            self.errors[route] += 1
+            raise FlowError(f"{route} -> {response.status_code}: {response.text[:200]}")
+        return response.json() if response.content else None
+
+
+class FlowError(Exception):
+    pass
+
+
+async def booking_flow(client, rec, tokens, rng, flow_id):
+    email = f"flow-{flow_id}-{uuid.uuid4().hex[:8]}@load.test"
+    await rec.call(client, "POST /api/auth/register", "POST", "/api/auth/register", json={
+        "name": f"flow-{flow_id}", "email": email, "password": PASSWORD, "role": "CUSTOMER"
+    })
+    login = await rec.call(client, "POST /api/auth/login", "POST", "/api/auth/login", json={
+        "email": email, "password": PASSWORD
+    })
+    customer = login["token"]
+    driver = tokens["drivers"][rng.randrange(len(tokens["drivers"]))]
+
+    trip = await rec.call(client, "POST /api/trips", "POST", "/api/trips", customer, json={
+        "city": rng.choice(CITIES), "base_location": "Load", "start_date": "2024-01-01", "end_date": "2024-01-02"
+    })
+    booking = await rec.call(client, "POST /api/bookings", "POST", "/api/bookings", customer, json={
+        "trip_id": trip["id"], "estimated_km": rng.uniform(1, 300), "total_days": rng.randint(1, 5),
+        "pickup_location": "Load", "dropoff_location": "Load", "booking_date": "2024-01-01",
+        "pickup_lat": 12.97, "pickup_lng": 77.59,
+    })
+    booking_id = booking["id"]
+    await rec.call(client, "GET /api/bookings", "GET", "/api/bookings", customer)
+    await rec.call(client, "PATCH /api/bookings/{id}/accept", "PATCH", f"/api/bookings/{booking_id}/accept", driver)
+    await rec.call(client, "PATCH /api/bookings/{id}/status", "PATCH",
+                   f"/api/bookings/{booking_id}/status", driver, params={"status": "IN_PROGRESS"})
+    await rec.call(client, "POST /api/payments", "POST", "/api/payments", customer,
+                   headers={"Idempotency-Key": f"flow-{flow_id}"},
+                   json={"booking_id": booking_id, "amount": booking["final_price"], "method": "CARD"})
+    await rec.call(client, "PATCH /api/bookings/{id}/status", "PATCH",
+                   f"/api/bookings/{booking_id}/status", driver, params={"status": "COMPLETED"})
+    await rec.call(client, "GET /api/customer/stats", "GET", "/api/customer/stats", customer)
+    await rec.call(client, "GET /api/drivers/stats", "GET", "/api/drivers/stats", driver)
+
+    payouts = await rec.call(client, "GET /api/payouts", "GET", "/api/payouts", driver)
+    payout = next((p for p in payouts if p["booking_id"] == booking_id), None)
+    if payout is None:
+        raise FlowError("payout for the completed booking not on the driver's first page")
+    await rec.call(client, "PATCH /api/payouts/{id}/process", "PATCH",
+                   f"/api/payouts/{payout['id']}/process", tokens["admin"])
+    await rec.call(client, "GET /api/admin/stats", "GET", "/api/admin/stats", tokens["admin"])
+
+
+async def run_load(app, tokens, args):
+    import httpx
+
+    rec = Recorder()
+    failures = []
+    next_flow = iter(range(args.flows))
+
+    async def worker(worker_id):
+        rng = random.Random(args.seed * 1000 + worker_id)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load.test", timeout=60) as client:
+            for flow_id in next_flow:
+                try:
+                    await booking_flow(client, rec, tokens, rng, flow_id)
+                except FlowError as exc:
+                    failures.append(str(exc))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+    return rec, failures, time.perf_counter() - started
+
+
+def summarize(rec, elapsed):
+    routes = {}
+    for route, samples in sorted(rec.latencies.items()):
+        ms = np.asarray(samples) * 1000
+        routes[route] = {
+            "requests": len(samples),
+            "errors": rec.errors.get(route, 0),
+            "rps": len(samples) / elapsed,
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "mean_ms": float(ms.mean()),
+        }
+    total = sum(len(s) for s in rec.latencies.values())
+    all_ms = np.concatenate([np.asarray(s) for s in rec.latencies.values()]) * 1000 if total else np.zeros(1)
+    return routes, {
+        "requests": total,
+        "errors": sum(rec.errors.values()),
+        "rps": total / elapsed,
+        "p50_ms": float(np.percentile(all_ms, 50)),
+        "p95_ms": float(np.percentile(all_ms, 95)),
+        "p99_ms": float(np.percentile(all_ms, 99)),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result, baseline=None):
+    print(f"commit {result['commit']}  backend {result['backend']}  "
+          f"{result['flows']['completed']}/{result['flows']['requested']} flows in {result['elapsed_seconds']:.2f}s")
+    header = f"{'route':<34}{'reqs':>7}{'err':>5}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    if baseline:
+        header += f"{'p95 vs base':>13}"
+    print(header)
+    rows = list(result["routes"].items()) + [("TOTAL", result["total"])]
+    for route, stats in rows:
+        line = (f"{route:<34}{stats['requests']:>7}{stats['errors']:>5}{stats['rps']:>9.1f}"
+                f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+        if baseline:
+            base = baseline["total"] if route == "TOTAL" else baseline["routes"].get(route)
+            if base and base["p95_ms"]:
+                line += f"{(stats['p95_ms'] / base['p95_ms'] - 1) * 100:>+12.1f}%"
+        print(line)
+    for failure in result["failures"][:5]:
+        print(f"  failed flow: {failure}")
+
+
+async def main_async(args):
+    configure_environment(args)
+    import server
+    # One INFO line per request would swamp the report
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    if args.mongo_url:
+        import indexes
+        db = server.db
+        await db.client.drop_database(args.db_name)
+        await indexes.ensure_indexes(db)
+        backend = "mongodb"
+    else:
+        db = use_stand_in()
+        backend = "stand-in"
+
+    try:
+        seed_started = time.perf_counter()
+        tokens = await seed(db, args, rng)
+        seed_seconds = time.perf_counter() - seed_started
+        if not tokens["drivers"]:
+            sys.exit("At least one driver is needed to run booking flows")
+
+        rec, failures, elapsed = await run_load(server.app, tokens, args)
+    finally:
+        if args.mongo_url and not args.keep:
+            await server.db.client.drop_database(args.db_name)
+        server.password_hasher.shutdown()
+
+    routes, total = summarize(rec, elapsed)
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "backend": backend,
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "mongo_url")},
+        "seeded": tokens["seeded"],
+        "seed_seconds": seed_seconds,
+        "elapsed_seconds": elapsed,
+        "flows": {"requested": args.flows, "completed": args.flows - len(failures)},
+        "failures": failures,
+        "routes": routes,
+        "total": total,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-url", help="MongoDB to seed; omit for the in-process stand-in")
+    parser.add_argument("--db-name", default=f"load_test_{os.getpid()}")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded database afterwards")
+    parser.add_argument("--users", type=int, default=1000, help="seeded customers")
+    parser.add_argument("--dealers", type=int, default=20)
+    parser.add_argument("--drivers", type=int, default=200)
+    parser.add_argument("--bookings", type=int, default=5000)
+    parser.add_argument("--payouts", type=int, default=2000, help="seeded completed bookings with payouts")
+    parser.add_argument("--flows", type=int, default=200, help="booking lifecycles to run")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent clients")
+    parser.add_argument("--bcrypt-rounds", type=int, help="override BCRYPT_ROUNDS for the run")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--secondary-reads", choices=["dashboard", "all"],
+                        help="send these read-only route classes to secondaryPreferred")
+    parser.add_argument("--max-staleness", type=int, default=90, help="maxStalenessSeconds for --secondary-reads")
+    parser.add_argument("--rate-limits", action="store_true", help="turn on per-user rate limits and admission control")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="earlier --output file to diff against")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    print_report(result, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
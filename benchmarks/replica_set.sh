@@ -0,0 +1,44 @@
+#!/usr/bin/env bash
+# Start a throwaway three-node replica set (rs0) on localhost:27017-27019
+# for the load test:
+#
+#   benchmarks/replica_set.sh start
+#   python benchmarks/load_test.py --mongo-url "mongodb://localhost:27017/?replicaSet=rs0" ...
+#   benchmarks/replica_set.sh stop
+#
+# Needs mongod and mongosh on PATH.  Data lives under $RS_DIR (default
+# /tmp/urbancab-rs) and is removed by "stop".
+set -euo pipefail
+
+RS_DIR="${RS_DIR:-/tmp/urbancab-rs}"
+PORTS=(27017 27018 27019)
+
+start() {
+    for port in "${PORTS[@]}"; do
+        mkdir -p "$RS_DIR/$port"
+        mongod --replSet rs0 --port "$port" --bind_ip localhost \
+            --dbpath "$RS_DIR/$port" --logpath "$RS_DIR/$port.log" --fork
+    done
+    mongosh --quiet --port "${PORTS[0]}" --eval '
+        rs.initiate({_id: "rs0", members: [
+            {_id: 0, host: "localhost:27017", priority: 2},
+            {_id: 1, host: "localhost:27018"},
+            {_id: 2, host: "localhost:27019"}
+        ]});
+        while (!db.hello().isWritablePrimary) { sleep(500); }
+        print("rs0 ready");
+    '
+}
+
+stop() {
+    for port in "${PORTS[@]}"; do
+        mongod --dbpath "$RS_DIR/$port" --shutdown || true
+    done
+    rm -rf "$RS_DIR"
+}
+
+case "${1:-}" in
+    start) start ;;
+    stop) stop ;;
+    *) echo "usage: $0 start|stop" >&2; exit 2 ;;
+esac
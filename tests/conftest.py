@@ -0,0 +1,90 @@
+"""Shared fixtures: the FastAPI app served over httpx against mongomock_motor.
+
+The app is driven through ``httpx.ASGITransport``, which does not run the
+lifespan, so no indexes are built and no background workers start.
+"""
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tests")
+# The minimum bcrypt allows; hashing cost is not under test
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+# Off by default; the middleware and listener are only installed at import
+os.environ.setdefault("METRICS_ENABLED", "true")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+import auth  # noqa: E402
+import cache  # noqa: E402
+import database  # noqa: E402
+import indexes  # noqa: E402
+import server  # noqa: E402
+
+from tests.helpers import bearer, register  # noqa: E402
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(monkeypatch):
+    mock_db = AsyncMongoMockClient()[os.environ["DB_NAME"]]
+    # Only the indexes behaviour depends on; mongomock ignores partial filters,
+    # so the rest of the registry would reject valid documents
+    for collection in ("payout_batch_applications",):
+        await mock_db[collection].create_indexes(indexes.INDEXES[collection])
+    for module in (server, database):
+        for name in ("db", "dashboard_db", "list_db", "export_db"):
+            monkeypatch.setattr(module, name, mock_db)
+    monkeypatch.setattr(cache, "document_cache", cache.DocumentCache(cache._make_backend()))
+    monkeypatch.setattr(auth, "token_cache", auth.TokenCache(auth.TOKEN_CACHE_MAX_ENTRIES, auth.TOKEN_CACHE_TTL_SECONDS))
+    return mock_db
+
+
+@pytest.fixture
+def app():
+    return server.app
+
+
+@pytest.fixture
+async def client(db, app):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+        yield http
+
+
+@pytest.fixture
+async def accounts(client):
+    """An admin, a customer with an active trip, and a driver with a profile."""
+    admin = await register(client, "admin", "ADMIN")
+    customer = await register(client, "customer", "CUSTOMER")
+    driver = await register(client, "driver", "DRIVER")
+    response = await client.post(
+        "/api/drivers",
+        json={
+            "user_id": driver["user"]["id"],
+            "license_number": "DL-1",
+            "license_expiry": "2030-01-01",
+            "vehicle_number": "MH-12-0001",
+            "vehicle_type": "SEDAN"
+        },
+        headers=bearer(driver["token"])
+    )
+    assert response.status_code == 200, response.text
+    response = await client.post(
+        "/api/trips",
+        json={"city": "Pune", "base_location": "Station", "start_date": "2026-01-01", "end_date": "2026-01-02"},
+        headers=bearer(customer["token"])
+    )
+    assert response.status_code == 200, response.text
+    return {
+        "admin": admin["token"],
+        "customer": customer["token"],
+        "driver": driver["token"],
+        "trip_id": response.json()["id"]
+    }
@@ -0,0 +1,32 @@
+"""Request helpers shared by the API tests."""
+
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def register(client, name: str, role: str) -> dict:
+    """Register a user; returns ``{"token": .., "user": {..}}``."""
+    response = await client.post(
+        "/api/auth/register",
+        json={"name": name, "email": f"{name}@example.com", "password": "secret", "role": role}
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def create_booking(client, accounts, **fields) -> dict:
+    response = await client.post(
+        "/api/bookings",
+        json={
+            "trip_id": accounts["trip_id"],
+            "estimated_km": 10,
+            "pickup_location": "Station",
+            "dropoff_location": "Airport",
+            "booking_date": "2026-01-01",
+            **fields
+        },
+        headers=bearer(accounts["customer"])
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
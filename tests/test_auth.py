@@ -0,0 +1,40 @@
+import pytest
+
+import auth
+from tests.helpers import bearer, register
+
+pytestmark = pytest.mark.anyio
+
+
+def _restart_worker(monkeypatch):
+    """A worker that has never seen the revocation, e.g. after a restart."""
+    monkeypatch.setattr(auth, "token_cache", auth.TokenCache(auth.TOKEN_CACHE_MAX_ENTRIES, auth.TOKEN_CACHE_TTL_SECONDS))
+
+
+async def test_logged_out_token_stays_revoked_on_other_workers(client, db, monkeypatch):
+    customer = await register(client, "customer", "CUSTOMER")
+    assert (await client.post("/api/auth/logout", headers=bearer(customer["token"]))).status_code == 200
+    assert (await client.get("/api/auth/me", headers=bearer(customer["token"]))).status_code == 401
+
+    _restart_worker(monkeypatch)
+    response = await client.get("/api/auth/me", headers=bearer(customer["token"]))
+
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Token has been revoked"
+    assert await db[auth.REVOKED_TOKENS_COLLECTION].count_documents({}) == 1
+
+
+async def test_revoked_user_must_sign_in_again(client, monkeypatch):
+    admin = await register(client, "admin", "ADMIN")
+    customer = await register(client, "customer", "CUSTOMER")
+    assert (await client.get("/api/auth/me", headers=bearer(customer["token"]))).status_code == 200
+
+    response = await client.post(
+        f"/api/admin/users/{customer['user']['id']}/revoke-tokens", headers=bearer(admin["token"])
+    )
+    assert response.status_code == 200
+    _restart_worker(monkeypatch)
+
+    assert (await client.get("/api/auth/me", headers=bearer(customer["token"]))).status_code == 401
+    login = await client.post("/api/auth/login", json={"email": "customer@example.com", "password": "secret"})
+    assert (await client.get("/api/auth/me", headers=bearer(login.json()["token"]))).status_code == 200
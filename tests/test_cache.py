@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import cache
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(params=["local", "shared"])
+def document_cache(request):
+    if request.param == "shared":
+        backend = cache.SharedBackend(cache.LocalSharedStore(100), ttl=30)
+    else:
+        backend = cache.LocalBackend(ttl=30, max_entries=100)
+    return cache.DocumentCache(backend)
+
+
+async def test_fill_started_before_an_invalidation_is_not_stored(document_cache):
+    loading, release = asyncio.Event(), asyncio.Event()
+
+    async def slow_loader():
+        loading.set()
+        await release.wait()
+        return {"id": "b1", "status": "PENDING"}
+
+    fill = asyncio.create_task(document_cache.get(cache.BOOKINGS, "b1", slow_loader))
+    await loading.wait()
+    # The write lands, and invalidates, while the read is still in flight
+    await document_cache.invalidate(cache.BOOKINGS, "b1")
+    release.set()
+    assert (await fill)["status"] == "PENDING"
+
+    async def fresh_loader():
+        return {"id": "b1", "status": "ACCEPTED"}
+
+    assert (await document_cache.get(cache.BOOKINGS, "b1", fresh_loader))["status"] == "ACCEPTED"
+    assert document_cache.stats[cache.BOOKINGS]["skipped_stores"] == 1
+
+
+async def test_fill_after_an_invalidation_is_stored(document_cache):
+    await document_cache.invalidate(cache.BOOKINGS, "b1")
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        return {"id": "b1"}
+
+    await document_cache.get(cache.BOOKINGS, "b1", loader)
+    await document_cache.get(cache.BOOKINGS, "b1", loader)
+
+    assert len(loads) == 1
+    assert document_cache.stats[cache.BOOKINGS]["hits"] == 1
+
+
+async def test_forgotten_invalidations_still_block_older_fills(document_cache, monkeypatch):
+    monkeypatch.setattr(cache, "INVALIDATION_HISTORY", 2)
+    loading, release = asyncio.Event(), asyncio.Event()
+
+    async def slow_loader():
+        loading.set()
+        await release.wait()
+        return {"id": "b1", "status": "PENDING"}
+
+    fill = asyncio.create_task(document_cache.get(cache.BOOKINGS, "b1", slow_loader))
+    await loading.wait()
+    # b1's invalidation is pushed out of the bounded history by later ones
+    await document_cache.invalidate(cache.BOOKINGS, "b1")
+    await document_cache.invalidate(cache.BOOKINGS, "b2", "b3")
+    release.set()
+    await fill
+
+    assert document_cache.stats[cache.BOOKINGS]["skipped_stores"] == 1
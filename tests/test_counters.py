@@ -0,0 +1,68 @@
+import pytest
+
+import counters
+from tests.helpers import bearer, create_booking
+
+pytestmark = pytest.mark.anyio
+
+
+def _nonzero(doc: dict) -> dict:
+    # Increments leave fields at 0 where a rebuild never writes them; readers treat both as 0
+    values = {field: _nonzero(value) if isinstance(value, dict) else value for field, value in doc.items()}
+    return {field: value for field, value in values.items() if value not in (0, {})}
+
+
+async def _snapshot(db) -> dict:
+    docs = db[counters.COUNTERS_COLLECTION].find({})
+    return {doc["_id"]: _nonzero(doc) async for doc in docs}
+
+
+async def _advance(client, accounts, booking_id: str, *statuses: str) -> None:
+    for status in statuses:
+        response = await client.patch(
+            f"/api/bookings/{booking_id}/status", params={"status": status}, headers=bearer(accounts["driver"])
+        )
+        assert response.status_code == 200, response.text
+
+
+async def test_incremental_counters_match_rebuild(client, db, accounts):
+    completed = []
+    for _ in range(3):
+        booking = await create_booking(client, accounts)
+        response = await client.patch(f"/api/bookings/{booking['id']}/accept", headers=bearer(accounts["driver"]))
+        assert response.status_code == 200, response.text
+        await _advance(client, accounts, booking["id"], "IN_PROGRESS")
+        response = await client.post(
+            "/api/payments",
+            json={"booking_id": booking["id"], "amount": booking["final_price"], "method": "CARD"},
+            headers=bearer(accounts["customer"])
+        )
+        assert response.status_code == 200, response.text
+        await _advance(client, accounts, booking["id"], "COMPLETED")
+        completed.append(booking["id"])
+
+    accepted = await create_booking(client, accounts)
+    await client.patch(f"/api/bookings/{accepted['id']}/accept", headers=bearer(accounts["driver"]))
+    cancelled = await create_booking(client, accounts)
+    response = await client.patch(
+        f"/api/bookings/{cancelled['id']}/status", params={"status": "CANCELLED"}, headers=bearer(accounts["customer"])
+    )
+    assert response.status_code == 200, response.text
+
+    payouts = (await client.get("/api/payouts", headers=bearer(accounts["admin"]))).json()
+    assert len(payouts) == len(completed)
+    response = await client.patch(f"/api/payouts/{payouts[0]['id']}/process", headers=bearer(accounts["admin"]))
+    assert response.status_code == 200, response.text
+    response = await client.post("/api/payouts/process-batch", json={}, headers=bearer(accounts["admin"]))
+    assert response.status_code == 200, response.text
+    response = await client.patch(
+        f"/api/trips/{accounts['trip_id']}", params={"status": "COMPLETED"}, headers=bearer(accounts["customer"])
+    )
+    assert response.status_code == 200, response.text
+
+    incremental = await _snapshot(db)
+    await counters.rebuild_counters(db)
+    rebuilt = await _snapshot(db)
+
+    assert incremental == rebuilt
+    assert incremental[counters.counter_id(counters.DRIVER, payouts[0]["driver_id"])]["active_trips"] == 1
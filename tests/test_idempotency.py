@@ -0,0 +1,52 @@
+import pytest
+
+from tests.helpers import bearer, create_booking
+
+pytestmark = pytest.mark.anyio
+
+
+async def _pay(client, accounts, key: str, **body):
+    return await client.post(
+        "/api/payments",
+        json={"method": "CARD", **body},
+        headers={**bearer(accounts["customer"]), "Idempotency-Key": key}
+    )
+
+
+async def test_replay_returns_the_stored_payment(client, db, accounts):
+    booking = await create_booking(client, accounts)
+
+    first = await _pay(client, accounts, "pay-1", booking_id=booking["id"], amount=300)
+    second = await _pay(client, accounts, "pay-1", booking_id=booking["id"], amount=300)
+
+    assert first.status_code == second.status_code == 200
+    # The stored copy went through BSON, which keeps dates to the millisecond
+    replayed, original = second.json(), first.json()
+    assert replayed.pop("created_at")[:23] == original.pop("created_at")[:23]
+    assert replayed == original
+    assert await db.payments.count_documents({}) == 1
+
+
+async def test_key_reused_with_a_different_body_is_422(client, db, accounts):
+    booking = await create_booking(client, accounts)
+    first = await _pay(client, accounts, "pay-1", booking_id=booking["id"], amount=300)
+    assert first.status_code == 200
+
+    response = await _pay(client, accounts, "pay-1", booking_id=booking["id"], amount=999)
+
+    assert response.status_code == 422
+    assert await db.payments.count_documents({}) == 1
+
+
+async def test_failed_request_releases_its_key(client, db, accounts):
+    booking = await create_booking(client, accounts)
+    await db.payments.create_index("transaction_id", unique=True, sparse=True)
+    taken = await _pay(client, accounts, "pay-1", booking_id=booking["id"], amount=300, transaction_id="gw-1")
+    assert taken.status_code == 200
+
+    duplicate = await _pay(client, accounts, "pay-2", booking_id=booking["id"], amount=300, transaction_id="gw-1")
+    assert duplicate.status_code == 409
+    retried = await _pay(client, accounts, "pay-2", booking_id=booking["id"], amount=300, transaction_id="gw-2")
+
+    assert retried.status_code == 200
+    assert retried.json()["id"] != taken.json()["id"]
@@ -0,0 +1,39 @@
+import pytest
+from pymongo.errors import AutoReconnect
+
+import locations
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def ingestor():
+    store = locations.HotLocationStore(0.01, 300)
+    return locations.LocationIngestor(store, flush_interval=1.0, max_pending=100, stale_after=30)
+
+
+async def test_failed_flush_keeps_frames_for_the_next_one(ingestor, db, monkeypatch):
+    await db.drivers.insert_many([{"id": "d1"}, {"id": "d2"}])
+    ingestor.offer("d1", 73.85, 18.52, None)
+    ingestor.offer("d2", 73.86, 18.53, None)
+
+    collection_type = type(db.drivers)
+    bulk_write = collection_type.bulk_write
+
+    async def failover(self, ops, ordered=True):
+        # A newer frame for d1 arrives while the write is in flight
+        ingestor.offer("d1", 73.90, 18.60, None)
+        raise AutoReconnect("primary stepped down")
+
+    monkeypatch.setattr(collection_type, "bulk_write", failover)
+    with pytest.raises(AutoReconnect):
+        await ingestor.flush(db)
+    assert ingestor.stats["requeued"] == 2
+    assert ingestor.metrics()["pending"] == 2
+
+    monkeypatch.setattr(collection_type, "bulk_write", bulk_write)
+    assert await ingestor.flush(db) == 2
+    d1 = await db.drivers.find_one({"id": "d1"})
+    d2 = await db.drivers.find_one({"id": "d2"})
+    assert d1["location"]["coordinates"] == [73.90, 18.60]
+    assert d2["location"]["coordinates"] == [73.86, 18.53]
@@ -0,0 +1,31 @@
+import pytest
+
+import metrics
+from tests.helpers import bearer
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_metrics_need_admin_or_scrape_token(client, accounts, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "scrape-secret")
+
+    assert (await client.get("/api/metrics")).status_code == 401
+    assert (await client.get("/api/metrics", headers=bearer("wrong"))).status_code == 401
+    assert (await client.get("/api/metrics", headers=bearer(accounts["customer"]))).status_code == 403
+    for token in (accounts["admin"], "scrape-secret"):
+        response = await client.get("/api/metrics", headers=bearer(token))
+        assert response.status_code == 200
+        assert response.headers["content-type"] == metrics.PROMETHEUS_CONTENT_TYPE
+
+
+async def test_scrape_token_is_off_unless_configured(client, accounts, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", None)
+
+    assert (await client.get("/api/metrics", headers=bearer(""))).status_code == 401
+    assert (await client.get("/api/metrics", headers=bearer(accounts["admin"]))).status_code == 200
+
+
+async def test_metrics_endpoint_is_404_when_disabled(client, accounts, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+
+    assert (await client.get("/api/metrics", headers=bearer(accounts["admin"]))).status_code == 404
@@ -0,0 +1,69 @@
+from datetime import datetime
+
+import pytest
+
+import archive
+import pagination
+from tests.helpers import bearer, create_booking
+
+pytestmark = pytest.mark.anyio
+
+
+async def _pages(client, token: str, limit: int, **params) -> list:
+    ids, cursor = [], None
+    while True:
+        response = await client.get(
+            "/api/bookings",
+            params={"limit": limit, **params, **({"cursor": cursor} if cursor else {})},
+            headers=bearer(token)
+        )
+        assert response.status_code == 200, response.text
+        ids.extend(booking["id"] for booking in response.json())
+        cursor = response.headers.get(pagination.NEXT_CURSOR_HEADER)
+        if cursor is None:
+            return ids
+
+
+@pytest.fixture
+async def same_instant(client, db, accounts):
+    """Seven bookings sharing one ``created_at``, as a bulk import would leave them."""
+    ids = [(await create_booking(client, accounts))["id"] for _ in range(7)]
+    await db.bookings.update_many({}, {"$set": {"created_at": datetime(2026, 1, 1, 12, 0, 0)}})
+    return ids
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7, 10])
+async def test_pages_cover_ties_exactly_once(client, accounts, same_instant, limit):
+    ids = await _pages(client, accounts["customer"], limit)
+
+    assert sorted(ids) == sorted(same_instant)
+    assert len(ids) == len(set(ids))
+    # Ties on created_at fall back to id, newest first
+    assert ids == sorted(same_instant, reverse=True)
+
+
+async def test_pages_cover_ties_split_across_archive(client, db, accounts, same_instant, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_TARGET", "collections")
+    archived = sorted(same_instant)[::2]
+    docs = await db.bookings.find({"id": {"$in": archived}}).to_list(None)
+    await db[archive.archive_collection("bookings")].insert_many(docs)
+    await db.bookings.delete_many({"id": {"$in": archived}})
+
+    ids = await _pages(client, accounts["customer"], 2, include_archived="true")
+
+    assert ids == sorted(same_instant, reverse=True)
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7])
+async def test_pages_cross_from_dates_to_legacy_strings(client, db, accounts, limit):
+    ids = sorted([(await create_booking(client, accounts))["id"] for _ in range(6)])
+    for index, booking_id in enumerate(ids):
+        # Half the rows still hold the ISO strings written before the migration
+        created_at = datetime(2026, 1, 1, 12, 0, index)
+        await db.bookings.update_one(
+            {"id": booking_id}, {"$set": {"created_at": created_at if index >= 3 else created_at.isoformat()}}
+        )
+
+    pages = await _pages(client, accounts["customer"], limit)
+
+    assert pages == ids[::-1]
@@ -0,0 +1,117 @@
+import pytest
+
+import counters
+import payout_batches
+import rollups
+from tests.helpers import bearer, create_booking
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def pending_payouts(client, accounts):
+    """Two completed, paid bookings, each leaving a PENDING payout for the driver."""
+    for _ in range(2):
+        booking = await create_booking(client, accounts)
+        await client.patch(f"/api/bookings/{booking['id']}/accept", headers=bearer(accounts["driver"]))
+        await client.patch(
+            f"/api/bookings/{booking['id']}/status", params={"status": "IN_PROGRESS"}, headers=bearer(accounts["driver"])
+        )
+        await client.post(
+            "/api/payments",
+            json={"booking_id": booking["id"], "amount": booking["final_price"], "method": "CARD"},
+            headers=bearer(accounts["customer"])
+        )
+        response = await client.patch(
+            f"/api/bookings/{booking['id']}/status", params={"status": "COMPLETED"}, headers=bearer(accounts["driver"])
+        )
+        assert response.status_code == 200, response.text
+    return (await client.get("/api/payouts", headers=bearer(accounts["admin"]))).json()
+
+
+async def _totals(db) -> tuple:
+    driver = await db.drivers.find_one({}, {"_id": 0, "total_payouts": 1})
+    counter_docs = await db[counters.COUNTERS_COLLECTION].find({}).to_list(None)
+    rollup_docs = await db[rollups.ROLLUPS_COLLECTION].find({}).to_list(None)
+    return driver["total_payouts"], counter_docs, rollup_docs
+
+
+async def _run_batch(client, accounts, **body):
+    response = await client.post("/api/payouts/process-batch", json=body, headers=bearer(accounts["admin"]))
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def test_rerun_of_an_interrupted_batch_does_not_credit_twice(client, db, accounts, pending_payouts):
+    first = await _run_batch(client, accounts, batch_id="batch-1")
+    assert first["processed"] == 2
+    assert first["driver_total"] == sum(payout["driver_amount"] for payout in pending_payouts)
+    applied = await _totals(db)
+    assert applied[0] == first["driver_total"]
+
+    # As if the worker died after applying but before closing the ledger entry
+    await db[payout_batches.BATCHES_COLLECTION].update_one({"id": "batch-1"}, {"$set": {"status": payout_batches.OPEN}})
+    rerun = await _run_batch(client, accounts, batch_id="batch-1")
+
+    assert rerun == first
+    assert await _totals(db) == applied
+
+
+async def test_rerun_after_a_rebuild_does_not_credit_twice(client, db, accounts, pending_payouts):
+    await _run_batch(client, accounts, batch_id="batch-1")
+    await counters.rebuild_counters(db)
+    await rollups.backfill(db)
+    rebuilt = await _totals(db)
+
+    await db[payout_batches.BATCHES_COLLECTION].update_one({"id": "batch-1"}, {"$set": {"status": payout_batches.OPEN}})
+    await _run_batch(client, accounts, batch_id="batch-1")
+
+    assert await _totals(db) == rebuilt
+
+
+async def test_recipients_keep_no_batch_bookkeeping(client, db, accounts, pending_payouts):
+    await _run_batch(client, accounts, batch_id="batch-1")
+
+    profile = await client.get("/api/drivers/profile", headers=bearer(accounts["driver"]))
+
+    assert profile.status_code == 200
+    assert not any("batch" in field for field in profile.json())
+    for collection in ("drivers", counters.COUNTERS_COLLECTION, rollups.ROLLUPS_COLLECTION):
+        async for doc in db[collection].find({}):
+            assert not any("batch" in field for field in doc), (collection, doc)
+
+
+async def test_interrupted_credit_is_reported_not_repeated(client, db, accounts, pending_payouts):
+    first = await _run_batch(client, accounts, batch_id="batch-1")
+    # As if the worker died between recording the driver credit and applying it
+    await db[payout_batches.APPLICATIONS_COLLECTION].update_many({"target": "drivers"}, {"$set": {"applied": False}})
+    await db[payout_batches.BATCHES_COLLECTION].update_one({"id": "batch-1"}, {"$set": {"status": payout_batches.OPEN}})
+
+    rerun = await _run_batch(client, accounts, batch_id="batch-1")
+
+    assert (await db.drivers.find_one({}))["total_payouts"] == first["driver_total"]
+    assert sorted(failure["payout_id"] for failure in rerun["failures"]) == sorted(p["id"] for p in pending_payouts)
+    assert all(payout_batches.INTERRUPTED in failure["reason"] for failure in rerun["failures"])
+
+
+async def test_completed_batch_returns_its_result(client, db, accounts, pending_payouts):
+    first = await _run_batch(client, accounts, batch_id="batch-1")
+
+    again = await _run_batch(client, accounts, batch_id="batch-1")
+
+    assert again == first
+    assert (await db.drivers.find_one({}))["total_payouts"] == first["driver_total"]
+
+
+async def test_missing_buckets_are_created_and_missing_recipients_reported(client, db, accounts, pending_payouts):
+    await db[counters.COUNTERS_COLLECTION].delete_many({})
+    await db[rollups.ROLLUPS_COLLECTION].delete_many({})
+    await db.drivers.delete_many({})
+
+    result = await _run_batch(client, accounts, batch_id="batch-1")
+
+    assert sorted(failure["payout_id"] for failure in result["failures"]) == sorted(p["id"] for p in pending_payouts)
+    driver_counter = counters.counter_id(counters.DRIVER, pending_payouts[0]["driver_id"])
+    counter = await db[counters.COUNTERS_COLLECTION].find_one({"_id": driver_counter})
+    assert counter["total_paid_out"] == result["driver_total"]
+    assert await db[rollups.ROLLUPS_COLLECTION].count_documents({}) > 0
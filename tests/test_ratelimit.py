@@ -0,0 +1,83 @@
+import httpx
+import pytest
+
+import ratelimit
+import server
+from tests.helpers import bearer, create_booking, register
+
+pytestmark = pytest.mark.anyio
+
+
+def _limiter(**overrides) -> ratelimit.RateLimiter:
+    """Default limits, with ``overrides`` mapping a route class to changed fields."""
+    limits = {
+        route_class: defaults._replace(**overrides.get(route_class, {}))
+        for route_class, defaults in ratelimit.ROUTE_CLASSES.items()
+    }
+    return ratelimit.RateLimiter(ratelimit.LocalBucketStore(100), limits, ratelimit.Admission(100, limits, 0.1))
+
+
+@pytest.fixture
+def limiter():
+    return _limiter(
+        booking={"user_rate": 0.01, "user_burst": 2},
+        auth={"ip_rate": 0.5, "ip_burst": 1}
+    )
+
+
+@pytest.fixture
+def app(limiter):
+    return ratelimit.RateLimitMiddleware(server.app, limiter)
+
+
+async def _login(client, **headers):
+    return await client.post("/api/auth/login", json={"email": "nobody@example.com", "password": "x"}, headers=headers)
+
+
+async def test_user_over_budget_gets_429_with_retry_after(client, accounts, limiter):
+    for _ in range(2):
+        await create_booking(client, accounts)
+
+    response = await client.post("/api/bookings", json={"trip_id": accounts["trip_id"]}, headers=bearer(accounts["customer"]))
+
+    assert response.status_code == 429
+    # One token at 0.01/s
+    assert response.headers["Retry-After"] == "100"
+    assert limiter.stats[ratelimit.BOOKING]["rate_limited"] == 1
+    other = await register(client, "other", "CUSTOMER")
+    listed = await client.get("/api/bookings", headers=bearer(other["token"]))
+    assert listed.status_code == 200
+
+
+async def test_per_ip_buckets_need_a_client_address_source(client, monkeypatch):
+    for _ in range(3):
+        assert (await _login(client)).status_code == 401
+
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_CLIENT_ADDRESS", "peer")
+    assert (await _login(client)).status_code == 401
+    response = await _login(client)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+
+
+async def test_forwarded_address_is_taken_from_the_trusted_proxy(client, monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_CLIENT_ADDRESS", "forwarded")
+    assert (await _login(client, **{"X-Forwarded-For": "203.0.113.7"})).status_code == 401
+
+    # A client-supplied entry ahead of the proxy's does not buy a fresh bucket
+    spoofed = await _login(client, **{"X-Forwarded-For": "198.51.100.1, 203.0.113.7"})
+    other = await _login(client, **{"X-Forwarded-For": "203.0.113.8"})
+
+    assert spoofed.status_code == 429
+    assert other.status_code == 401
+
+
+async def test_full_class_sheds_with_503(db):
+    limiter = _limiter(default={"concurrency": 0, "queue": 0})
+    transport = httpx.ASGITransport(app=ratelimit.RateLimitMiddleware(server.app, limiter))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/api/")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(ratelimit.ADMISSION_RETRY_AFTER_SECONDS)
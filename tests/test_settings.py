@@ -0,0 +1,31 @@
+import pytest
+
+from settings import env_bool
+
+
+@pytest.mark.parametrize("value", ["1", "true", "True", "yes", "on", " TRUE "])
+def test_truthy_values(monkeypatch, value):
+    monkeypatch.setenv("FLAG", value)
+    assert env_bool("FLAG") is True
+
+
+@pytest.mark.parametrize("value", ["0", "false", "no", "off"])
+def test_falsy_values(monkeypatch, value):
+    monkeypatch.setenv("FLAG", value)
+    assert env_bool("FLAG", True) is False
+
+
+@pytest.mark.parametrize("value", [None, ""])
+def test_unset_uses_default(monkeypatch, value):
+    if value is None:
+        monkeypatch.delenv("FLAG", raising=False)
+    else:
+        monkeypatch.setenv("FLAG", value)
+    assert env_bool("FLAG", True) is True
+    assert env_bool("FLAG") is False
+
+
+def test_unrecognised_value_is_an_error(monkeypatch):
+    monkeypatch.setenv("FLAG", "enabled")
+    with pytest.raises(ValueError, match="FLAG"):
+        env_bool("FLAG")
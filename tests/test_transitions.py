@@ -0,0 +1,65 @@
+import pytest
+
+from tests.helpers import bearer, create_booking
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_booking_cannot_skip_to_completed(client, accounts):
+    booking = await create_booking(client, accounts)
+
+    response = await client.patch(
+        f"/api/bookings/{booking['id']}/status", params={"status": "COMPLETED"}, headers=bearer(accounts["admin"])
+    )
+
+    assert response.status_code == 409
+    assert "PENDING" in response.json()["detail"]
+    stored = await client.get(f"/api/bookings/{booking['id']}", headers=bearer(accounts["customer"]))
+    assert stored.json()["status"] == "PENDING"
+
+
+async def test_accepted_booking_cannot_be_accepted_again(client, accounts):
+    booking = await create_booking(client, accounts)
+    first = await client.patch(f"/api/bookings/{booking['id']}/accept", headers=bearer(accounts["driver"]))
+    assert first.status_code == 200
+
+    second = await client.patch(f"/api/bookings/{booking['id']}/accept", headers=bearer(accounts["driver"]))
+
+    assert second.status_code == 409
+
+
+async def test_finished_booking_is_terminal(client, accounts):
+    booking = await create_booking(client, accounts)
+    await client.patch(f"/api/bookings/{booking['id']}/accept", headers=bearer(accounts["driver"]))
+    for status in ("IN_PROGRESS", "COMPLETED"):
+        response = await client.patch(
+            f"/api/bookings/{booking['id']}/status", params={"status": status}, headers=bearer(accounts["driver"])
+        )
+        assert response.status_code == 200, response.text
+
+    response = await client.patch(
+        f"/api/bookings/{booking['id']}/status", params={"status": "CANCELLED"}, headers=bearer(accounts["admin"])
+    )
+
+    assert response.status_code == 409
+
+
+async def test_unknown_booking_is_404(client, accounts):
+    response = await client.patch(
+        "/api/bookings/missing/status", params={"status": "CANCELLED"}, headers=bearer(accounts["admin"])
+    )
+
+    assert response.status_code == 404
+
+
+async def test_transition_stores_only_the_new_status(client, accounts, db):
+    booking = await create_booking(client, accounts)
+
+    response = await client.patch(f"/api/bookings/{booking['id']}/accept", headers=bearer(accounts["driver"]))
+
+    assert response.status_code == 200, response.text
+    assert response.json()["status"] == "ACCEPTED"
+    stored = await db.bookings.find_one({"id": booking["id"]}, {"_id": 0})
+    assert stored["status"] == "ACCEPTED"
+    assert stored["driver_id"] == response.json()["driver_id"]
+    assert "previous_status" not in stored